@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Throughput of the SSH ciphers and MACs that the SFTP server can use. Each
+combination encrypts and signs packets the size of SFTP data packets, the
+per-byte work of a transfer.
+
+    $ python benchmarks/ciphers.py --megabytes 64
+
+See COPYING for license information.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.conch.ssh.transport import SSHCiphers, SSHTransportBase
+
+PACKET = 32768 + 32  # an SFTP data packet with its headers
+
+
+def throughput(cipher, mac, megabytes):
+    " Returns the MB/s at which packets are encrypted and signed "
+    ciphers = SSHCiphers(cipher, cipher, mac, mac)
+    key = os.urandom(64)
+    ciphers.setKeys(key, key, key, key, key, key)
+    # Whole cipher blocks, like the padded packets of the transport
+    data = 'x' * (PACKET - PACKET % ciphers.encBlockSize)
+    packets = megabytes * 1024 * 1024 / len(data)
+    start = time.time()
+    for seq in xrange(packets):
+        ciphers.encrypt(data)
+        ciphers.makeMAC(seq, data)
+    return packets * len(data) / (time.time() - start) / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cipher benchmark")
+    parser.add_argument("--megabytes", type=int, default=64,
+                        help="data to encrypt per cipher and MAC")
+    args = parser.parse_args()
+
+    macs = SSHTransportBase.supportedMACs
+    print "%-14s" % "MB/s" + "".join("%15s" % mac for mac in macs)
+    for cipher in SSHTransportBase.supportedCiphers:
+        print "%-14s" % cipher + "".join(
+            "%15.1f" % throughput(cipher, mac, args.megabytes)
+            for mac in macs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Throughput of the HTTP backends of SwiftConnection for streaming downloads
+and uploads. A fake swift runs in a child process on localhost, so the CPU
+time of this process is the cost of the backend. Reports MB/s and MB per
+CPU second (MB/s per core).
+
+    $ python benchmarks/http_backends.py --megabytes 1024
+    $ python benchmarks/http_backends.py --backend mypackage.http.agent
+
+See COPYING for license information.
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, protocol, reactor
+from twisted.python.reflect import namedAny
+from twisted.web import resource as web_resource, server
+from twisted.web.client import FileBodyProducer, HTTPConnectionPool
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from swftp.swift import SwiftConnection
+
+CHUNK = 'x' * 65536
+
+
+class FakeAuth(web_resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(
+            'X-Storage-Url', 'http://127.0.0.1:%s/v1/AUTH_bench' %
+            request.getHost().port)
+        request.setHeader('X-Auth-Token', 'AUTH_tk_bench')
+        return ''
+
+
+class FakeObject(web_resource.Resource):
+    " Serves GETs of an object of the requested size and accepts PUTs "
+    isLeaf = True
+
+    def render_GET(self, request):
+        size = int(request.postpath[-1])
+        request.setHeader('Content-Length', str(size))
+        request.registerProducer(ObjectProducer(request, size), False)
+        return server.NOT_DONE_YET
+
+    def render_PUT(self, request):
+        request.setResponseCode(201)
+        return ''
+
+
+class ObjectProducer(object):
+    def __init__(self, request, size):
+        self.request = request
+        self.remaining = size
+
+    def resumeProducing(self):
+        if not self.remaining:
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        chunk = CHUNK[:self.remaining]
+        self.remaining -= len(chunk)
+        self.request.write(chunk)
+
+    def stopProducing(self):
+        self.remaining = 0
+
+
+def run_server():
+    root = web_resource.Resource()
+    root.putChild('auth', FakeAuth())
+    root.putChild('v1', FakeObject())
+    site = server.Site(root)
+    site.noisy = False
+    site.log = lambda request: None
+    port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    sys.stdout.write('%s\n' % port.getHost().port)
+    sys.stdout.flush()
+    reactor.run()
+
+
+class Counter(protocol.Protocol):
+    def __init__(self):
+        self.received = 0
+        self.finished = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.finished.callback(self.received)
+
+
+class RepeatedChunks(object):
+    " File-like object with size bytes, read by FileBodyProducer "
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size):
+        chunk = CHUNK[:min(size, self.remaining)]
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+@defer.inlineCallbacks
+def download(conn, size):
+    receiver = Counter()
+    yield conn.get_object('bench', 'object/%s' % size, receiver=receiver)
+    received = yield receiver.finished
+    assert received == size, received
+
+
+@defer.inlineCallbacks
+def upload(conn, size):
+    body = FileBodyProducer(RepeatedChunks(size), readSize=len(CHUNK))
+    # Like uploads from clients, which are sent chunked
+    body.length = UNKNOWN_LENGTH
+    yield conn.put_object('bench', 'object', body=body)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def run_client(args, port):
+    if args.backend:
+        SwiftConnection.http_backend = staticmethod(namedAny(args.backend))
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = args.concurrency
+    conn = SwiftConnection(
+        'http://127.0.0.1:%s/auth/v1.0' % port, 'bench', 'bench', pool=pool)
+    yield conn.authenticate()
+
+    size = args.megabytes * 1024 * 1024 / args.concurrency
+    for label, transfer in [('GET', download), ('PUT', upload)]:
+        start, cpu = time.time(), cpu_seconds()
+        yield defer.gatherResults([
+            transfer(conn, size) for _ in xrange(args.concurrency)])
+        elapsed, cpu = time.time() - start, cpu_seconds() - cpu
+        megabytes = size * args.concurrency / 1024.0 / 1024.0
+        print "%s %8.1f MB/s %8.1f MB/s per core" % (
+            label, megabytes / elapsed, megabytes / cpu)
+    yield pool.closeCachedConnections()
+
+
+class ServerProcess(protocol.ProcessProtocol):
+    def __init__(self):
+        self.port = defer.Deferred()
+
+    def outReceived(self, data):
+        if not self.port.called:
+            self.port.callback(int(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP backend benchmark")
+    parser.add_argument("--megabytes", type=int, default=1024,
+                        help="data to transfer each way")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="number of transfers at once")
+    parser.add_argument("--backend",
+                        help="dotted name of the HTTP backend "
+                             "(default: swftp.swift.twisted_agent)")
+    parser.add_argument("--server", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.server:
+        return run_server()
+    print "backend: %s, megabytes: %s, concurrency: %s" % (
+        args.backend or 'swftp.swift.twisted_agent', args.megabytes,
+        args.concurrency)
+    fake_swift = ServerProcess()
+    process = reactor.spawnProcess(
+        fake_swift, sys.executable,
+        [sys.executable, os.path.abspath(__file__), '--server'],
+        env=os.environ, childFDs={0: 'w', 1: 'r', 2: 2})
+    d = fake_swift.port.addCallback(lambda port: run_client(args, port))
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: process.signalProcess('TERM'))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Benchmarks for directory listings. Runs a large fake container listing
+through SwiftFileSystem and renders it the same way the FTP LIST and SFTP
+readdir paths do, without needing a running Swift cluster.
+
+    $ python benchmarks/listing.py --entries 1000000
+
+See COPYING for license information.
+"""
+import argparse
+import gc
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer
+
+from swftp.swiftfilesystem import SwiftFileSystem
+from swftp.ftp.server import stat_format, ListFormatter, ListingProducer
+from swftp.sftp.swiftdirectory import SwiftDirectory
+from swftp.utils import try_datetime_parse
+
+LIST_KEYS = ('size', 'directory', 'permissions', 'hardlinks', 'modified',
+             'owner', 'group')
+
+
+class FakeListingConnection(object):
+    "Serves pages of a synthetic container listing like Swift would"
+    page_size = 10000
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def get_container(self, container, prefix=None, delimiter=None,
+                      marker=None, **kwargs):
+        start = 0
+        if marker:
+            start = int(marker.rsplit('_', 1)[1]) + 1
+        end = min(start + self.page_size, self.entries)
+        page = []
+        for i in xrange(start, end):
+            page.append({
+                u'name': u'dir/object_%010d' % i,
+                u'hash': u'%032x' % i,
+                u'bytes': i,
+                u'content_type': u'application/octet-stream',
+                u'last_modified': u'2013-02-%02dT%02d:%02d:%02d.%06d' % (
+                    i % 28 + 1, i % 24, i % 60, (i / 60) % 60, i % 1000000),
+            })
+        return defer.succeed((None, page))
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(label, func, *args):
+    gc.collect()
+    start = time.time()
+    result = func(*args)
+    print "%-10s %8.2fs  max rss %8.1f MB" % (
+        label, time.time() - start, max_rss_mb())
+    return result
+
+
+def fetch(swiftfilesystem):
+    results = []
+    d = swiftfilesystem.get_full_listing('container/dir')
+    d.addCallback(results.append)
+    return results[0]
+
+
+def parse_dates(listing):
+    for props in listing.itervalues():
+        try_datetime_parse(props.last_modified)
+
+
+def render_ftp(listing):
+    for name, props in listing.iteritems():
+        stat_format(LIST_KEYS, props)
+
+
+class NullConsumer(object):
+    "Stands in for the FTP data connection and counts what is written"
+    def __init__(self):
+        self.bytes = 0
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.bytes += len(data)
+
+
+def write_ftp(listing):
+    start = time.time()
+    consumer = NullConsumer()
+    producer = ListingProducer(listing, ListFormatter().line, consumer)
+    producer.start()
+    while consumer.producer:
+        producer.resumeProducing()
+    elapsed = time.time() - start
+    print "%-10s %8.0f lines/s, %.1f MB written" % (
+        "", len(listing) / elapsed, consumer.bytes / 1024.0 / 1024.0)
+
+
+def render_sftp(swiftfilesystem, listing):
+    directory = SwiftDirectory(swiftfilesystem, 'container/dir')
+    directory.listing = listing
+    for _ in directory:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Listing benchmark")
+    parser.add_argument("--entries", type=int, default=1000000,
+                        help="number of objects in the listing")
+    args = parser.parse_args()
+
+    os.environ['TZ'] = 'GMT'
+    time.tzset()
+
+    swiftfilesystem = SwiftFileSystem(FakeListingConnection(args.entries))
+    print "entries: %s, baseline max rss %.1f MB" % (
+        args.entries, max_rss_mb())
+    listing = timed("fetch", fetch, swiftfilesystem)
+    timed("dates", parse_dates, listing)
+    timed("ftp list", render_ftp, listing)
+    timed("ftp wire", write_ftp, listing)
+    timed("sftp dir", render_sftp, swiftfilesystem, listing)
+
+
+if __name__ == "__main__":
+    main()
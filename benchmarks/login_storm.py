@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Login storm benchmark for the SFTP server. While a client process runs many
+SSH key exchanges against SwiftSSHServerTransport, the server process pumps
+a stream over a loopback connection, standing in for the data transfer of a
+connected session. Reports the throughput of that stream per 100ms window and
+the longest time the reactor was stalled, with and without key exchanges in
+threads.
+
+    $ python benchmarks/login_storm.py --logins 200 --concurrency 20
+    $ python benchmarks/login_storm.py --logins 200 --no-offload
+
+See COPYING for license information.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from twisted.conch.ssh.factory import SSHFactory
+from twisted.conch.ssh.keys import Key
+from twisted.conch.ssh.transport import SSHClientTransport
+from twisted.internet import defer, protocol, reactor, task
+
+from swftp.sftp.server import SwiftSSHServerTransport
+
+KEX = 'diffie-hellman-group14-sha1'
+CHUNK = 'x' * 65536
+WINDOW = 0.1
+
+
+class StreamSource(protocol.Protocol):
+    "Writes to the loopback connection as fast as it drains"
+    def connectionMade(self):
+        self.transport.registerProducer(self, False)
+
+    def resumeProducing(self):
+        self.transport.write(CHUNK)
+
+    def stopProducing(self):
+        pass
+
+
+class StreamSink(protocol.Protocol):
+    def dataReceived(self, data):
+        self.factory.received += len(data)
+
+
+class Monitor(object):
+    "Samples the stream throughput and how late the reactor runs timers"
+    tick = 0.01
+
+    def __init__(self, sink_factory):
+        self.sink_factory = sink_factory
+        self.windows = []
+        self.stall = 0
+        self.last = self.sink_factory.received
+        self.last_tick = time.time()
+        task.LoopingCall(self.sample).start(WINDOW, now=False)
+        task.LoopingCall(self.check).start(self.tick, now=False)
+
+    def sample(self):
+        received = self.sink_factory.received
+        self.windows.append((received - self.last) / WINDOW / 1024 / 1024)
+        self.last = received
+
+    def check(self):
+        now = time.time()
+        self.stall = max(self.stall, now - self.last_tick - self.tick)
+        self.last_tick = now
+
+    def reset(self):
+        self.windows = []
+        self.stall = 0
+
+
+class KeyExchangeClient(SSHClientTransport):
+    supportedKeyExchanges = [KEX]
+
+    def verifyHostKey(self, hostKey, fingerprint):
+        return defer.succeed(True)
+
+    def connectionSecure(self):
+        self.factory.done += 1
+        self.loseConnection()
+
+    def connectionLost(self, reason):
+        SSHClientTransport.connectionLost(self, reason)
+        self.factory.next()
+
+
+class StormFactory(protocol.ClientFactory):
+    protocol = KeyExchangeClient
+    noisy = False
+
+    def __init__(self, port, logins, concurrency):
+        self.port = port
+        self.remaining = logins
+        self.running = 0
+        self.done = 0
+        self.finished = defer.Deferred()
+        for _ in xrange(concurrency):
+            self.start()
+
+    def start(self):
+        if self.remaining:
+            self.remaining -= 1
+            self.running += 1
+            reactor.connectTCP('127.0.0.1', self.port, self)
+
+    def next(self):
+        self.running -= 1
+        self.start()
+        if not self.running:
+            self.finished.callback(self.done)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.next()
+
+
+def run_client(args):
+    start = time.time()
+    storm = StormFactory(args.port, args.logins, args.concurrency)
+    storm.finished.addCallback(lambda done: sys.stderr.write(
+        "logins: %s in %.2fs\n" % (done, time.time() - start)))
+    storm.finished.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+class ClientProcess(protocol.ProcessProtocol):
+    def __init__(self):
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+def summary(label, monitor):
+    windows = sorted(monitor.windows) or [0]
+    print "%-8s stream MB/s min %7.1f  median %7.1f  max %7.1f  " \
+        "max stall %6.1f ms" % (
+            label, windows[0], windows[len(windows) / 2], windows[-1],
+            monitor.stall * 1000)
+
+
+@defer.inlineCallbacks
+def run_server(args):
+    key = Key(rsa.generate_private_key(65537, 2048, default_backend()))
+    factory = SSHFactory()
+    factory.protocol = SwiftSSHServerTransport
+    factory.noisy = False
+    factory.publicKeys = {'ssh-rsa': key.public()}
+    factory.privateKeys = {'ssh-rsa': key}
+    SwiftSSHServerTransport.offloadKeyExchange = args.offload
+    ssh_port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    sink_factory = protocol.Factory()
+    sink_factory.protocol = StreamSink
+    sink_factory.received = 0
+    stream_port = reactor.listenTCP(0, sink_factory, interface='127.0.0.1')
+    protocol.ClientCreator(reactor, StreamSource).connectTCP(
+        '127.0.0.1', stream_port.getHost().port)
+
+    monitor = Monitor(sink_factory)
+    yield task.deferLater(reactor, 1, lambda: None)
+    summary('idle', monitor)
+    monitor.reset()
+
+    client = ClientProcess()
+    reactor.spawnProcess(client, sys.executable, [
+        sys.executable, os.path.abspath(__file__), '--client',
+        '--port=%s' % ssh_port.getHost().port,
+        '--logins=%s' % args.logins,
+        '--concurrency=%s' % args.concurrency,
+    ], env=os.environ, childFDs={0: 'w', 1: 1, 2: 2})
+    yield client.ended
+    summary('storm', monitor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login storm benchmark")
+    parser.add_argument("--logins", type=int, default=200,
+                        help="number of key exchanges")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="number of key exchanges at once")
+    parser.add_argument("--no-offload", dest="offload", action="store_false",
+                        help="compute key exchanges in the reactor thread")
+    parser.add_argument("--client", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        return run_client(args)
+    print "offload: %s, logins: %s, concurrency: %s" % (
+        args.offload, args.logins, args.concurrency)
+    run_server(args).addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -30,7 +30,8 @@ setup(
     install_requires=requires,
     entry_points={
         'console_scripts': ['swftp-ftp = swftp.ftp.service:run',
-                            'swftp-sftp = swftp.sftp.service:run'],
+                            'swftp-sftp = swftp.sftp.service:run',
+                            'swftp-fakeswift = swftp.fakeswift:run'],
     },
     package_data={
         'twisted.plugins': ['twisted/plugins/swftp_ftp.py',
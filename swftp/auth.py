@@ -2,6 +2,7 @@
 See COPYING for license information.
 """
 import urlparse
+from collections import deque
 
 from zope.interface import implements
 from twisted.internet import defer, reactor
@@ -10,6 +11,7 @@ from twisted.python import log
 from twisted.cred import checkers, error, credentials
 
 from swftp.swift import ThrottledSwiftConnection, UnAuthenticated, UnAuthorized
+from swftp.scheduler import FairScheduler
 from swftp import USER_AGENT
 
 
@@ -21,11 +23,17 @@ class SwiftBasedAuthDB(object):
 
         :param auth_url: auth endpoint for swift
         :param int global_max_concurrency: The max concurrency for the entire
-            server
+            server, shared fairly between the users
         :param int max_concurrency: The max concurrency for each
             ThrottledSwiftConnection object
+        :param int max_metadata_concurrency: The max concurrency of metadata
+            requests (HEAD, listings, DELETE...) for each
+            ThrottledSwiftConnection object. They don't count against
+            max_concurrency. 0 lets them share max_concurrency with transfers
         :param proxy: a proxy for request to swift (or None), ex.: 127.0.0.1:88
         :param bool verbose: verbose setting
+        :param dict user_weights: user -> share of the global concurrency of
+            that user relative to the others (default: 1)
     """
     implements(checkers.ICredentialsChecker)
     credentialInterfaces = (
@@ -36,21 +44,28 @@ class SwiftBasedAuthDB(object):
                  auth_url,
                  global_max_concurrency=100,
                  max_concurrency=10,
+                 max_metadata_concurrency=2,
                  timeout=260,
                  extra_headers=None,
                  proxy=None,
                  verbose=False,
                  rewrite_scheme=None,
-                 rewrite_netloc=None):
+                 rewrite_netloc=None,
+                 user_weights=None):
         self.auth_url = auth_url
         self.global_max_concurrency = global_max_concurrency
         self.max_concurrency = max_concurrency
+        self.max_metadata_concurrency = max_metadata_concurrency
         self.timeout = timeout
         self.extra_headers = extra_headers
         self.proxy = proxy
         self.verbose = verbose
         self.rewrite_scheme = rewrite_scheme
         self.rewrite_netloc = rewrite_netloc
+        self.scheduler = None
+        if global_max_concurrency:
+            self.scheduler = FairScheduler(
+                global_max_concurrency, weights=user_weights)
 
     def _rewrite_storage_url(self, connection):
         if not any((self.rewrite_scheme, self.rewrite_netloc)):
@@ -90,6 +105,7 @@ class SwiftBasedAuthDB(object):
 
         if creds is not None:
             locks = []
+            metadata_locks = None
             pool = HTTPConnectionPool(reactor, persistent=False)
             pool.cachedConnectionTimeout = self.timeout
             if self.max_concurrency:
@@ -97,10 +113,10 @@ class SwiftBasedAuthDB(object):
                 pool.maxPersistentPerHost = self.max_concurrency
                 locks.append(
                     defer.DeferredSemaphore(self.max_concurrency))
-
-            if self.global_max_concurrency:
-                locks.append(
-                    defer.DeferredSemaphore(self.global_max_concurrency))
+                if self.max_metadata_concurrency:
+                    pool.maxPersistentPerHost += self.max_metadata_concurrency
+                    metadata_locks = [
+                        defer.DeferredSemaphore(self.max_metadata_concurrency)]
 
             conn = ThrottledSwiftConnection(
                 locks, self.auth_url, creds.username, creds.password,
@@ -109,6 +125,8 @@ class SwiftBasedAuthDB(object):
                 extra_headers=self.extra_headers,
                 verbose=self.verbose)
             conn.user_agent = USER_AGENT
+            conn.scheduler = self.scheduler
+            conn.metadata_locks = metadata_locks
 
             d = conn.authenticate()
             d.addCallback(self._after_auth, conn)
@@ -121,3 +139,71 @@ def eb_failed_auth(failure):
     failure.trap(UnAuthenticated, UnAuthorized)
     log.msg(metric='auth.fail')
     return defer.fail(error.UnauthorizedLogin())
+
+
+class LoginRejected(Exception):
+    " Raised when a login is turned away because too many are in progress "
+
+
+class AdmissionControlledChecker(object):
+    """ Limits the number of authentications that are in progress at once.
+        Logins over the limit wait in a queue. They are rejected with
+        LoginRejected when the queue is full or they waited too long.
+
+        Implements twisted.cred.ICredentialsChecker
+
+    :param checker: the ICredentialsChecker that authenticates the logins
+    :param int max_in_flight: number of authentications that run at once
+    :param int max_queued: number of logins that may wait
+    :param queue_timeout: seconds a login may wait
+    :param clock: IReactorTime provider
+
+    """
+    implements(checkers.ICredentialsChecker)
+
+    def __init__(self, checker, max_in_flight=50, max_queued=500,
+                 queue_timeout=30, clock=reactor):
+        self.checker = checker
+        self.credentialInterfaces = checker.credentialInterfaces
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.in_flight = 0
+        self.queue = deque()  # [deferred, time queued, timeout call]
+
+    def requestAvatarId(self, c):
+        if self.in_flight < self.max_in_flight and not self.queue:
+            return self._authenticate(c)
+        if len(self.queue) >= self.max_queued:
+            log.msg(metric='auth.rejected')
+            return defer.fail(LoginRejected('Too many logins in progress'))
+
+        log.msg(metric='auth.queued')
+        entry = [defer.Deferred(), self.clock.seconds(), None]
+        entry[2] = self.clock.callLater(
+            self.queue_timeout, self._timedOut, entry)
+        self.queue.append(entry)
+        entry[0].addCallback(lambda _: self._authenticate(c))
+        return entry[0]
+
+    def _authenticate(self, c):
+        self.in_flight += 1
+        d = defer.maybeDeferred(self.checker.requestAvatarId, c)
+        d.addBoth(self._finished)
+        return d
+
+    def _finished(self, result):
+        self.in_flight -= 1
+        if self.queue and self.in_flight < self.max_in_flight:
+            d, queued, timeout = self.queue.popleft()
+            timeout.cancel()
+            log.msg(metric='auth.queue_wait_ms',
+                    count=int((self.clock.seconds() - queued) * 1000))
+            d.callback(None)
+        return result
+
+    def _timedOut(self, entry):
+        self.queue.remove(entry)
+        log.msg(metric='auth.rejected')
+        entry[0].errback(LoginRejected('Timed out waiting to log in'))
@@ -0,0 +1,47 @@
+"""
+Process-wide accounting of the memory that transfers use for buffering.
+
+See COPYING for license information.
+"""
+from twisted.internet import defer
+
+
+class BufferGovernor(object):
+    """ Keeps track of the bytes that transfers hold in memory across all
+        sessions. Transfers reserve bytes before buffering them, release them
+        once the data is passed on and pause their producer while the
+        governor is full.
+
+    :param int limit: number of bytes all transfers together may buffer
+    :param float resume_ratio: paused transfers are resumed once the usage
+        dropped below this fraction of the limit
+
+    """
+    def __init__(self, limit, resume_ratio=0.9):
+        self.limit = limit
+        self.resume_ratio = resume_ratio
+        self.used = 0
+        self._waiting = []
+
+    def full(self):
+        return self.used >= self.limit
+
+    def reserve(self, size):
+        " Accounts for bytes that are about to be buffered "
+        self.used += size
+
+    def release(self, size):
+        " Accounts for buffered bytes that were passed on "
+        self.used -= size
+        if self._waiting and self.used < self.limit * self.resume_ratio:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def waitForSpace(self):
+        " Returns a deferred that fires once paused transfers may resume "
+        if not self.full():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
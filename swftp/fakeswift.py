@@ -0,0 +1,742 @@
+"""
+A fake swift cluster that keeps everything in memory, so benchmarks and load
+tests can run on one box without any outside services. It speaks v1 auth and
+the parts of the object API that swftp and its tests use: account, container
+and object CRUD, listings (prefix, delimiter, path, marker, end_marker,
+limit), Range and conditional requests, X-Copy-From and dynamic (DLO) and
+static (SLO) large objects. Latency and bandwidth can be injected to stand in
+for a remote cluster.
+
+    $ swftp-fakeswift --port 8080 --latency 0.005 --bandwidth 104857600
+    $ swftp-fakeswift --users "test:tester=testing, test2:tester2=testing2"
+
+Without --users any username and key are accepted. The account is the part
+of the username before the colon: test:tester uses AUTH_test.
+
+See COPYING for license information.
+"""
+import hashlib
+import json
+import sys
+import time
+import uuid
+from urllib import unquote
+
+from twisted.application import internet
+from twisted.internet import reactor
+from twisted.python import log, usage
+from twisted.web import resource, server
+from twisted.web.http import datetimeToString, stringToDatetime
+
+from swftp.logging import StdOutObserver
+from swftp.ratelimit import TokenBucket
+
+CHUNK_SIZE = 65536
+LISTING_LIMIT = 10000
+
+
+class HTTPError(Exception):
+    " Ends a request with the given status code "
+    def __init__(self, code, body=''):
+        Exception.__init__(self, code)
+        self.code = code
+        self.body = body
+
+
+class FakeObject(object):
+    """ An object, or the manifest of a large object
+
+    :param str data: contents of the object
+    :param str content_type: Content-Type of the object
+    :param dict meta: X-Object-Meta-* headers, lower case
+    :param str manifest: container/prefix of the segments of a DLO
+    :param list segments: (container, object, etag, size) of the segments
+        of an SLO
+
+    """
+    def __init__(self, data='', content_type=None, meta=None, manifest=None,
+                 segments=None):
+        self.data = data
+        self.content_type = content_type or 'application/octet-stream'
+        self.meta = meta or {}
+        self.manifest = manifest
+        self.segments = segments
+        self.timestamp = time.time()
+        # What listings show, which for large objects isn't the content
+        self.etag = hashlib.md5(data).hexdigest()
+        self.bytes = len(data)
+        if segments is not None:
+            self.etag = hashlib.md5(
+                ''.join(seg[2] for seg in segments)).hexdigest()
+            self.bytes = sum(seg[3] for seg in segments)
+
+
+class FakeContainer(object):
+    def __init__(self, meta=None):
+        self.meta = meta or {}
+        self.objects = {}
+        self.timestamp = time.time()
+        self._names = None
+
+    def names(self):
+        " Object names in listing order "
+        if self._names is None:
+            self._names = sorted(self.objects)
+        return self._names
+
+    def put(self, name, obj):
+        if name not in self.objects:
+            self._names = None
+        self.objects[name] = obj
+
+    def delete(self, name):
+        del self.objects[name]
+        self._names = None
+
+    def bytes_used(self):
+        return sum(obj.bytes for obj in self.objects.itervalues())
+
+
+class FakeAccount(object):
+    def __init__(self):
+        self.meta = {}
+        self.containers = {}
+
+
+def listing(names, args):
+    """ Returns the names and subdirs ((True, subdir)) of a sorted list of
+        names that a listing with the given query args shows
+    """
+    def arg(name, default=''):
+        return args.get(name, [default])[0]
+
+    prefix = arg('prefix')
+    delimiter = arg('delimiter')
+    marker = arg('marker')
+    end_marker = arg('end_marker')
+    try:
+        limit = min(int(arg('limit', LISTING_LIMIT)), LISTING_LIMIT)
+    except ValueError:
+        raise HTTPError(412, 'Bad limit')
+    path = args.get('path')
+    if path is not None:
+        # Only the objects directly in the pseudo-directory
+        prefix = path[0].rstrip('/')
+        if prefix:
+            prefix += '/'
+        delimiter = '/'
+
+    results = []
+    for name in names:
+        if len(results) >= limit:
+            break
+        if marker and name <= marker:
+            continue
+        if end_marker and name >= end_marker:
+            break
+        if not name.startswith(prefix):
+            if name > prefix:
+                break
+            continue
+        if delimiter:
+            i = name.find(delimiter, len(prefix))
+            if i >= 0:
+                if path is not None:
+                    continue
+                subdir = name[:i + len(delimiter)]
+                if (marker and subdir <= marker) or \
+                        (results and results[-1] == (True, subdir)):
+                    continue
+                results.append((True, subdir))
+                continue
+        results.append(name)
+    return results
+
+
+def parse_range(value, size):
+    """ Returns the (start, end) of a single Range header, None if it isn't
+        one that is understood
+    """
+    units, _, spec = value.partition('=')
+    if units.strip() != 'bytes' or ',' in spec or not size:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if not suffix:
+                raise HTTPError(416)
+            return max(size - suffix, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPError(416)
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+class FakeSwiftRequest(server.Request):
+    " Reads request bodies at the bandwidth of the site "
+    def handleContentChunk(self, data):
+        server.Request.handleContentChunk(self, data)
+        swift = self.channel.site.resource
+        if swift.ingress:
+            delay = swift.ingress.consume(len(data))
+            if delay:
+                transport = self.channel.transport
+                transport.pauseProducing()
+                swift.clock.callLater(delay, transport.resumeProducing)
+
+
+class ObjectProducer(object):
+    """ Writes a byte range of the concatenated parts of an object to the
+        request in chunks, at the bandwidth of the bucket
+
+    :param request: twisted.web.server.Request
+    :param list parts: FakeObject whose data makes up the object
+    :param int start: first byte to write
+    :param int end: byte after the last one to write
+    :param bucket: TokenBucket, or None for no limit
+    :param clock: IReactorTime provider
+
+    """
+    def __init__(self, request, parts, start, end, bucket=None,
+                 clock=reactor):
+        self.request = request
+        self.parts = iter(parts)
+        self.data = ''
+        self.offset = start
+        self.remaining = end - start
+        self.bucket = bucket
+        self.clock = clock
+        self.delayed = None
+
+    def _next_chunk(self):
+        while self.offset >= len(self.data):
+            self.offset -= len(self.data)
+            self.data = next(self.parts).data
+        size = min(CHUNK_SIZE, self.remaining, len(self.data) - self.offset)
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        self.remaining -= size
+        return chunk
+
+    def resumeProducing(self):
+        if self.delayed:
+            return
+        if not self.remaining:
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        chunk = self._next_chunk()
+        delay = self.bucket.consume(len(chunk)) if self.bucket else 0
+        if delay:
+            self.delayed = self.clock.callLater(delay, self._write, chunk)
+        else:
+            self.request.write(chunk)
+
+    def _write(self, chunk):
+        self.delayed = None
+        self.request.write(chunk)
+
+    def stopProducing(self):
+        self.remaining = 0
+        if self.delayed:
+            self.delayed.cancel()
+            self.delayed = None
+
+
+class FakeSwift(resource.Resource):
+    """ The fake swift cluster, served by FakeSwiftSite
+
+    :param dict users: username -> key, None accepts any username and key
+    :param float latency: seconds to wait before answering each request
+    :param int bandwidth: bytes per second of the object data sent and
+        received, shared by all requests, 0 is unlimited
+    :param clock: IReactorTime provider
+
+    """
+    isLeaf = True
+
+    def __init__(self, users=None, latency=0, bandwidth=0, clock=reactor):
+        resource.Resource.__init__(self)
+        self.users = users
+        self.latency = latency
+        self.clock = clock
+        self.ingress = self.egress = None
+        if bandwidth:
+            self.ingress = TokenBucket(bandwidth, clock=clock)
+            self.egress = TokenBucket(bandwidth, clock=clock)
+        self.accounts = {}
+        self.tokens = {}  # token -> account
+
+    def render(self, request):
+        request.defaultContentType = None
+        request.setHeader('X-Trans-Id', 'tx%s' % uuid.uuid4().hex)
+        if self.latency:
+            request.notifyFinish().addErrback(self._lost, request)
+            self.clock.callLater(self.latency, self._respond, request)
+        else:
+            self._respond(request)
+        return server.NOT_DONE_YET
+
+    def _lost(self, failure, request):
+        request.lost = True
+
+    def _respond(self, request):
+        if getattr(request, 'lost', False):
+            return
+        try:
+            body = self.dispatch(request)
+        except HTTPError, e:
+            request.setResponseCode(e.code)
+            body = e.body
+        if body is server.NOT_DONE_YET:
+            return
+        if not request.responseHeaders.hasHeader('content-length'):
+            request.setHeader('Content-Length', str(len(body)))
+        request.write(body)
+        request.finish()
+
+    def dispatch(self, request):
+        parts = [unquote(p) for p in request.path.split('/', 4)[1:]]
+        if parts[0] == 'auth':
+            return self.auth(request)
+        if parts[0] != 'v1' or len(parts) < 2:
+            raise HTTPError(404)
+        account = self.tokens.get(request.getHeader('x-auth-token'))
+        if account is None or account != parts[1]:
+            raise HTTPError(401)
+        account = self.accounts[account]
+        if len(parts) == 2 or not parts[2]:
+            handler = 'account_%s' % request.method
+            args = (account,)
+        elif len(parts) == 3 or not parts[3]:
+            handler = 'container_%s' % request.method
+            args = (account, parts[2])
+        else:
+            handler = 'object_%s' % request.method
+            args = (account, parts[2], parts[3])
+        if not hasattr(self, handler):
+            raise HTTPError(405)
+        return getattr(self, handler)(request, *args)
+
+    def auth(self, request):
+        user = request.getHeader('x-auth-user') or \
+            request.getHeader('x-storage-user')
+        key = request.getHeader('x-auth-key') or \
+            request.getHeader('x-storage-pass')
+        if not user or (self.users is not None and
+                        self.users.get(user) != key):
+            raise HTTPError(401)
+        account = 'AUTH_%s' % user.split(':')[0]
+        if account not in self.accounts:
+            self.accounts[account] = FakeAccount()
+        token = 'AUTH_tk%s' % uuid.uuid4().hex
+        self.tokens[token] = account
+        host = request.getHeader('host') or \
+            '%s:%s' % (request.getHost().host, request.getHost().port)
+        request.setHeader('X-Storage-Url', 'http://%s/v1/%s' % (host, account))
+        request.setHeader('X-Auth-Token', token)
+        request.setHeader('X-Storage-Token', token)
+        return ''
+
+    # Account
+    def account_HEAD(self, request, account):
+        containers = account.containers.values()
+        request.setHeader(
+            'X-Account-Container-Count', str(len(containers)))
+        request.setHeader('X-Account-Object-Count', str(
+            sum(len(c.objects) for c in containers)))
+        request.setHeader('X-Account-Bytes-Used', str(
+            sum(c.bytes_used() for c in containers)))
+        set_meta(request, 'X-Account-Meta-', account.meta)
+        request.setResponseCode(204)
+        return ''
+
+    def account_GET(self, request, account):
+        self.account_HEAD(request, account)
+        request.setResponseCode(200)
+
+        def entry(name):
+            container = account.containers[name]
+            return {'name': name.decode('utf8'),
+                    'count': len(container.objects),
+                    'bytes': container.bytes_used()}
+        return format_listing(
+            request, listing(sorted(account.containers), request.args), entry)
+
+    def account_POST(self, request, account):
+        update_meta(request, 'X-Account-Meta-', account.meta)
+        request.setResponseCode(204)
+        return ''
+
+    # Container
+    def get_container(self, account, name):
+        if name not in account.containers:
+            raise HTTPError(404)
+        return account.containers[name]
+
+    def container_HEAD(self, request, account, name):
+        container = self.get_container(account, name)
+        request.setHeader(
+            'X-Container-Object-Count', str(len(container.objects)))
+        request.setHeader(
+            'X-Container-Bytes-Used', str(container.bytes_used()))
+        request.setHeader('X-Timestamp', '%.5f' % container.timestamp)
+        set_meta(request, 'X-Container-Meta-', container.meta)
+        request.setResponseCode(204)
+        return ''
+
+    def container_GET(self, request, account, name):
+        container = self.get_container(account, name)
+        self.container_HEAD(request, account, name)
+        request.setResponseCode(200)
+
+        def entry(name):
+            obj = container.objects[name]
+            return {'name': name.decode('utf8'),
+                    'hash': obj.etag,
+                    'bytes': obj.bytes,
+                    'content_type': obj.content_type,
+                    'last_modified': time.strftime(
+                        '%Y-%m-%dT%H:%M:%S', time.gmtime(obj.timestamp)) +
+                    ('%.6f' % (obj.timestamp % 1))[1:]}
+        return format_listing(
+            request, listing(container.names(), request.args), entry)
+
+    def container_PUT(self, request, account, name):
+        if len(name) > 256 or '/' in name:
+            raise HTTPError(400)
+        if name in account.containers:
+            update_meta(
+                request, 'X-Container-Meta-', account.containers[name].meta)
+            request.setResponseCode(202)
+        else:
+            container = FakeContainer()
+            update_meta(request, 'X-Container-Meta-', container.meta)
+            account.containers[name] = container
+            request.setResponseCode(201)
+        return ''
+
+    def container_POST(self, request, account, name):
+        container = self.get_container(account, name)
+        update_meta(request, 'X-Container-Meta-', container.meta)
+        request.setResponseCode(204)
+        return ''
+
+    def container_DELETE(self, request, account, name):
+        container = self.get_container(account, name)
+        if container.objects:
+            raise HTTPError(409)
+        del account.containers[name]
+        request.setResponseCode(204)
+        return ''
+
+    # Object
+    def get_object(self, account, container, name):
+        container = self.get_container(account, container)
+        if name not in container.objects:
+            raise HTTPError(404)
+        return container.objects[name]
+
+    def parts(self, account, obj):
+        " Returns the FakeObjects whose data make up the object "
+        if obj.manifest is not None:
+            container, _, prefix = obj.manifest.partition('/')
+            container = account.containers.get(container)
+            if container is None:
+                return []
+            return [container.objects[name] for name in container.names()
+                    if name.startswith(prefix)]
+        if obj.segments is not None:
+            parts = []
+            for container, name, _, _ in obj.segments:
+                try:
+                    parts.append(self.get_object(account, container, name))
+                except HTTPError:
+                    raise HTTPError(409, 'Missing segment /%s/%s' % (
+                        container, name))
+            return parts
+        return [obj]
+
+    def object_HEAD(self, request, account, container, name, body=False):
+        obj = self.get_object(account, container, name)
+        multipart_get = request.args.get('multipart-manifest') == ['get']
+        if multipart_get and obj.segments is not None:
+            manifest = json.dumps([
+                {'name': '/%s/%s' % (c.decode('utf8'), o.decode('utf8')),
+                 'hash': etag, 'bytes': size}
+                for c, o, etag, size in obj.segments])
+            parts = [FakeObject(manifest)]
+            etag = hashlib.md5(manifest).hexdigest()
+        else:
+            parts = self.parts(account, obj)
+            etag = obj.etag
+            if obj.manifest is not None:
+                etag = '"%s"' % hashlib.md5(
+                    ''.join(p.etag for p in parts)).hexdigest()
+            elif obj.segments is not None:
+                etag = '"%s"' % etag
+        size = sum(len(p.data) for p in parts)
+
+        request.setHeader('ETag', etag)
+        request.setHeader('Content-Type', obj.content_type)
+        request.setHeader('Last-Modified', datetimeToString(obj.timestamp))
+        request.setHeader('X-Timestamp', '%.5f' % obj.timestamp)
+        request.setHeader('Accept-Ranges', 'bytes')
+        set_meta(request, 'X-Object-Meta-', obj.meta)
+        if obj.manifest is not None:
+            request.setHeader('X-Object-Manifest', obj.manifest)
+        if obj.segments is not None and not multipart_get:
+            request.setHeader('X-Static-Large-Object', 'True')
+
+        if not_modified(request, etag, obj.timestamp):
+            request.setResponseCode(304)
+            request.setHeader('Content-Length', '0')
+            return ''
+
+        start, end = 0, size
+        range_header = request.getHeader('range')
+        if range_header:
+            try:
+                byte_range = parse_range(range_header, size)
+            except HTTPError:
+                request.setHeader('Content-Range', 'bytes */%s' % size)
+                raise
+            if byte_range:
+                start, end = byte_range
+                request.setResponseCode(206)
+                request.setHeader('Content-Range', 'bytes %s-%s/%s' % (
+                    start, end - 1, size))
+        request.setHeader('Content-Length', str(end - start))
+        if not body or start == end:
+            return ''
+        request.registerProducer(ObjectProducer(
+            request, parts, start, end, self.egress, self.clock), False)
+        return server.NOT_DONE_YET
+
+    def object_GET(self, request, account, container, name):
+        return self.object_HEAD(request, account, container, name, body=True)
+
+    def object_PUT(self, request, account, container_name, name):
+        container = self.get_container(account, container_name)
+        if len(name) > 1024:
+            raise HTTPError(400, 'Object name too long')
+        content_type = request.getHeader('content-type')
+        copy_from = request.getHeader('x-copy-from')
+        if copy_from:
+            src_container, _, src_name = \
+                unquote(copy_from).lstrip('/').partition('/')
+            src = self.get_object(account, src_container, src_name)
+            if request.args.get('multipart-manifest') == ['get']:
+                obj = FakeObject(
+                    src.data, content_type or src.content_type, src.meta,
+                    src.manifest, src.segments)
+            else:
+                obj = FakeObject(
+                    ''.join(p.data for p in self.parts(account, src)),
+                    content_type or src.content_type, dict(src.meta))
+        elif request.args.get('multipart-manifest') == ['put']:
+            obj = FakeObject(
+                content_type=content_type,
+                segments=self.slo_segments(account, request.content.read()))
+        else:
+            manifest = request.getHeader('x-object-manifest')
+            obj = FakeObject(
+                request.content.read(), content_type,
+                manifest=unquote(manifest) if manifest else None)
+            etag = request.getHeader('etag')
+            if etag and etag.strip('"') != obj.etag:
+                raise HTTPError(422)
+        update_meta(request, 'X-Object-Meta-', obj.meta)
+        container.put(name, obj)
+        request.setHeader('ETag', obj.etag)
+        request.setResponseCode(201)
+        return ''
+
+    def slo_segments(self, account, manifest):
+        " Checks the manifest of an SLO and returns its segments "
+        try:
+            manifest = json.loads(manifest)
+            segments = []
+            for seg in manifest:
+                path = seg['path'].encode('utf8')
+                container, _, name = path.lstrip('/').partition('/')
+                segments.append(
+                    (container, name, seg.get('etag'), seg.get('size_bytes')))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise HTTPError(400, 'Invalid SLO manifest')
+        checked = []
+        for container, name, etag, size in segments:
+            try:
+                obj = self.get_object(account, container, name)
+            except HTTPError:
+                raise HTTPError(400, '/%s/%s: 404 Not Found' % (
+                    container, name))
+            if etag and etag != obj.etag:
+                raise HTTPError(400, '/%s/%s: Etag Mismatch' % (
+                    container, name))
+            if size is not None and size != len(obj.data):
+                raise HTTPError(400, '/%s/%s: Size Mismatch' % (
+                    container, name))
+            checked.append((container, name, obj.etag, len(obj.data)))
+        return checked
+
+    def object_POST(self, request, account, container, name):
+        obj = self.get_object(account, container, name)
+        obj.meta.clear()
+        update_meta(request, 'X-Object-Meta-', obj.meta)
+        content_type = request.getHeader('content-type')
+        if content_type:
+            obj.content_type = content_type
+        request.setResponseCode(202)
+        return ''
+
+    def object_DELETE(self, request, account, container, name):
+        obj = self.get_object(account, container, name)
+        if request.args.get('multipart-manifest') == ['delete'] and \
+                obj.segments is not None:
+            for seg_container, seg_name, _, _ in obj.segments:
+                seg_container = account.containers.get(seg_container)
+                if seg_container and seg_name in seg_container.objects:
+                    seg_container.delete(seg_name)
+        account.containers[container].delete(name)
+        request.setResponseCode(204)
+        return ''
+
+
+def set_meta(request, prefix, meta):
+    for key, value in meta.iteritems():
+        request.setHeader(prefix + key, value)
+
+
+def update_meta(request, prefix, meta):
+    " Takes the metadata headers with the prefix from a request "
+    prefix = prefix.lower()
+    for key, values in request.requestHeaders.getAllRawHeaders():
+        key = key.lower()
+        if key.startswith(prefix):
+            if values[-1]:
+                meta[key[len(prefix):]] = values[-1]
+            else:
+                meta.pop(key[len(prefix):], None)
+
+
+def not_modified(request, etag, timestamp):
+    " Whether the conditional headers of the request are met "
+    if_none_match = request.getHeader('if-none-match')
+    if if_none_match:
+        tags = [tag.strip().strip('"') for tag in if_none_match.split(',')]
+        return '*' in tags or etag.strip('"') in tags
+    if_modified_since = request.getHeader('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(timestamp) <= stringToDatetime(if_modified_since)
+        except ValueError:
+            pass
+    return False
+
+
+def format_listing(request, results, entry):
+    """ Renders a listing as JSON or plain text
+
+    :param request: twisted.web.server.Request
+    :param list results: names and (True, subdir) from listing()
+    :param entry: function that returns the JSON entry of a name
+
+    """
+    if request.args.get('format') == ['json']:
+        request.setHeader('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps([
+            {'subdir': r[1].decode('utf8')} if isinstance(r, tuple)
+            else entry(r) for r in results])
+    if not results:
+        request.setResponseCode(204)
+        return ''
+    request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+    return ''.join(
+        '%s\n' % (r[1] if isinstance(r, tuple) else r) for r in results)
+
+
+class FakeSwiftSite(server.Site):
+    " Site for FakeSwift, with request bodies read at its bandwidth "
+    requestFactory = FakeSwiftRequest
+
+    def __init__(self, swift, **kwargs):
+        server.Site.__init__(self, swift, **kwargs)
+        self.noisy = False
+
+    def log(self, request):
+        pass
+
+
+def parse_users(value):
+    """ Parses users from "account:user=key, account2:user2=key2"
+
+    :returns dict: username -> key
+
+    """
+    users = {}
+    for user in value.split(','):
+        if user.strip():
+            name, _, key = user.partition('=')
+            users[name.strip()] = key.strip()
+    return users
+
+
+def run():
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    # Start Logging
+    obs = StdOutObserver()
+    obs.start()
+
+    s = makeService(options)
+    s.startService()
+    reactor.run()
+
+
+class Options(usage.Options):
+    "Defines Command-line options for the swftp-fakeswift service"
+    optParameters = [
+        ["port", "p", 8080, "Port to bind to.", int],
+        ["host", "h", '127.0.0.1', "IP to bind to."],
+        ["latency", "l", 0, "Seconds to wait before each response.", float],
+        ["bandwidth", "b", 0,
+            "Bytes per second of object data each way, 0 is unlimited.", int],
+        ["users", "u", None,
+            "Users that may log in, as account:user=key, comma separated. "
+            "[default: anyone]"],
+    ]
+
+
+def makeService(options):
+    """
+    Makes a new fake swift service that keeps its data in memory.
+    """
+    users = None
+    if options['users']:
+        users = parse_users(options['users'])
+    swift = FakeSwift(
+        users=users, latency=options['latency'],
+        bandwidth=options['bandwidth'])
+    log.msg('Fake swift listening on %s:%s' % (
+        options['host'], options['port']))
+    return internet.TCPServer(
+        options['port'], FakeSwiftSite(swift), interface=options['host'])
+
+
+if __name__ == '__main__':
+    run()
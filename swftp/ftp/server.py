@@ -3,31 +3,44 @@ This file contains the primary server code for the FTP server.
 
 See COPYING for license information.
 """
+import fnmatch
 import stat
-from collections import defaultdict
+import time
 
 from zope.interface import implements
 from twisted.protocols.ftp import (
     FTP, IFTPShell, IReadFile, IWriteFile, FileNotFoundError,
     CmdNotImplementedForArgError, IsNotADirectoryError, IsADirectoryError,
     PermissionDeniedError,
-    RESPONSE, TOO_MANY_CONNECTIONS)
+    RESPONSE, TOO_MANY_CONNECTIONS, SVC_NOT_AVAIL_CLOSING_CTRL_CNX)
 from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IPullProducer
 from twisted.internet.protocol import Protocol
 from twisted.python import log
 from twisted.protocols.ftp import (
     NAME_SYS_TYPE, CmdArgSyntaxError, BadCmdSequenceError,
-    REQ_FILE_ACTN_PENDING_FURTHER_INFO
+    REQ_FILE_ACTN_PENDING_FURTHER_INFO, DATA_CNX_ALREADY_OPEN_START_XFR,
+    TXFR_COMPLETE_OK, CNX_CLOSED_TXFR_ABORTED, REQ_FILE_ACTN_COMPLETED_OK,
+    FILE_STATUS, FILE_STATUS_OK_OPEN_DATA_CNX, FILE_NOT_FOUND, FTPCmdError,
+    ASCIIConsumerWrapper, InvalidPath, toSegments, _isGlobbingExpression
 )
 from twisted.protocols.ftp import PortConnectionError
 
+from swftp.auth import LoginRejected
 from swftp.logging import msg
-from swftp.swiftfilesystem import SwiftFileSystem, swift_stat, obj_to_path
+from swftp.ratelimit import ThrottledConsumer
+from swftp.sessions import LocalSessionCounter
+from swftp.swiftfilesystem import (
+    SwiftFileSystem, ListingCache, props_stat, obj_to_path, swift_mode,
+    swift_mtime)
 from swftp.swift import NotFound, Conflict, UnAuthorized
 
+MONTHS = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+          'Sep', 'Oct', 'Nov', 'Dec']
+
 
 def stat_format(keys, props):
-    st = swift_stat(**props)
+    st = props_stat(props)
     l = []
     for key in keys:
         if key == 'size':
@@ -44,15 +57,158 @@ def stat_format(keys, props):
             val = 'nobody'
         elif key in 'group':
             val = 'nobody'
+        elif key == 'content_type':
+            val = props.get('content_type')
+        elif key == 'hash':
+            val = props.get('hash')
         else:  # Unknown Value
             val = ''
         l.append(val)
     return l
 
 
+class ListFormatter(object):
+    """ Formats LIST lines for ListingEntry objects. The output matches the
+        lines twisted's DTP writes for the values `stat_format` returns, but
+        skips building an os.stat_result per entry and caches the columns
+        that only depend on the mode and the minute of the mtime.
+
+    :param float now: the time used to decide whether a date is this year
+    """
+    owner = 'nobody'
+    group = 'nobody'
+
+    def __init__(self, now=None):
+        self.year = time.gmtime(now).tm_year
+        self._prefixes = {}
+        self._dates = {}
+
+    def prefix(self, mode):
+        " Directory flag, permissions, hardlinks, owner and group columns "
+        try:
+            return self._prefixes[mode]
+        except KeyError:
+            perms = ''.join([mode & (256 >> n) and 'rwx'[n % 3] or '-'
+                             for n in range(9)])
+            prefix = '%s%s%4d %-9s %-9s ' % (
+                mode & stat.S_IFDIR == stat.S_IFDIR and 'd' or '-',
+                perms, 0, self.owner[:8], self.group[:8])
+            self._prefixes[mode] = prefix
+            return prefix
+
+    def date(self, mtime):
+        " Date column "
+        key = mtime // 60
+        try:
+            return self._dates[key]
+        except KeyError:
+            t = time.gmtime(mtime)
+            if t.tm_year != self.year:
+                date = '%s %02d %5d' % (MONTHS[t.tm_mon], t.tm_mday, t.tm_year)
+            else:
+                date = '%s %02d %02d:%02d' % (
+                    MONTHS[t.tm_mon], t.tm_mday, t.tm_hour, t.tm_min)
+            date = '%12s' % date
+            self._dates[key] = date
+            return date
+
+    def line(self, name, entry):
+        " Formats a single LIST line for a ListingEntry (without CRLF) "
+        return '%s%15d %s %s' % (
+            self.prefix(swift_mode(entry.content_type)), int(entry.size),
+            self.date(int(swift_mtime(entry.last_modified))), name)
+
+
+class FactsFormatter(object):
+    """ Formats RFC 3659 MLSD/MLST fact lines. The facts come straight from
+        the container listing (or a HEAD for MLST), so clients don't need to
+        follow up with a SIZE/MDTM for every file.
+    """
+    # Facts as advertised by FEAT. The hash fact is the object's MD5 (etag),
+    # it is left out for large objects (see listing_hash).
+    FEATURE = 'MLST type*;size*;modify*;perm*;media-type*;x.md5*;'
+    keys = ('size', 'directory', 'modified', 'content_type', 'hash')
+    dir_perm = 'elcmfd'
+    file_perm = 'rwfd'
+
+    def facts(self, size, directory, modified, content_type, hash):
+        " Returns the facts part of a line, including the trailing space "
+        if directory:
+            facts = ['type=dir', 'perm=%s' % self.dir_perm]
+        else:
+            facts = ['type=file', 'size=%d' % size,
+                     'perm=%s' % self.file_perm]
+            if content_type:
+                facts.append('media-type=%s' % content_type)
+            if hash:
+                facts.append('x.md5=%s' % hash)
+        facts.append('modify=%s' % time.strftime(
+            '%Y%m%d%H%M%S', time.gmtime(modified)))
+        return '%s; ' % ';'.join(facts)
+
+    def line(self, name, entry):
+        " Formats a single MLSD line for a ListingEntry (without CRLF) "
+        mode = swift_mode(entry.content_type)
+        return self.facts(
+            int(entry.size), mode & stat.S_IFDIR == stat.S_IFDIR,
+            int(swift_mtime(entry.last_modified)), entry.content_type,
+            entry.hash) + name
+
+
+class ListingProducer(object):
+    """ Writes a listing to an FTP data connection in large blocks. Lines are
+        only formatted when the consumer asks for more data, so the whole
+        listing is never formatted up front.
+
+    :param listing: OrderedDict of {name: ListingEntry}
+    :param format_line: callable(name, entry) that returns a line or None
+    :param consumer: the DTP instance to write to
+    """
+    implements(IPullProducer)
+    block_size = 64 * 1024
+
+    def __init__(self, listing, format_line, consumer):
+        self.entries = listing.iteritems()
+        self.format_line = format_line
+        self.consumer = consumer
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        " Returns a deferred that fires when the whole listing is written "
+        self.consumer.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        lines = []
+        size = 0
+        for name, entry in self.entries:
+            line = self.format_line(name, entry)
+            if line is None:
+                continue
+            lines.append(line)
+            size += len(line)
+            if size >= self.block_size:
+                break
+        if lines:
+            lines.append('')
+            self.consumer.write('\r\n'.join(lines))
+        elif not self.deferred.called:
+            self.consumer.unregisterProducer()
+            self.deferred.callback(None)
+
+    def stopProducing(self):
+        self.entries = iter(())
+        if not self.deferred.called:
+            self.deferred.errback(defer.CancelledError())
+
+
 class SwftpFTPProtocol(FTP, object):
-    _connCountMap = defaultdict(int)
+    sessionCounter = LocalSessionCounter()
     maxConnectionsPerUser = 10
+    _sessionUser = None  # set while the session is counted
+    _lost = False
+    FEATURES = getattr(FTP, 'FEATURES', []) + [
+        FactsFormatter.FEATURE, 'HASH MD5*', 'XMD5', 'REST STREAM']
 
     def connectionMade(self, *args, **kwargs):
         log.msg(metric='num_clients')
@@ -61,58 +217,259 @@ class SwftpFTPProtocol(FTP, object):
     def connectionLost(self, *args, **kwargs):
         log.msg(metric='num_clients', count=-1)
 
-        if self.shell:
-            username = self.shell.username()
-            msg("User Disconnected (%s) [%s/%s]" % (
-                username,
-                self._connCountMap[username],
-                self.maxConnectionsPerUser,
-                ))
-            self._connCountMap[username] -= 1
-            # To avoid a slow memory leak
-            if self._connCountMap[username] == 0:
-                del self._connCountMap[username]
+        self._lost = True
+        if self._sessionUser:
+            msg("User Disconnected (%s)" % self._sessionUser)
+            self.sessionCounter.release(self._sessionUser)
+            self._sessionUser = None
         return super(SwftpFTPProtocol, self).connectionLost(*args, **kwargs)
 
     def ftp_PASS(self, *args, **kwargs):
         # Check to see if the user has too many connections
         d = super(SwftpFTPProtocol, self).ftp_PASS(*args, **kwargs)
 
-        def pass_cb(res):
-            username = self.shell.username()
-            self._connCountMap[username] += 1
+        def counted(count, username):
+            if self._lost:
+                self.sessionCounter.release(username)
+                return
+            self._sessionUser = username
             msg("User Connected (%s) [%s/%s]" % (
                 username,
-                self._connCountMap[username],
+                count,
                 self.maxConnectionsPerUser,
                 ))
             if self.maxConnectionsPerUser != 0 and \
-                    self._connCountMap[username] > self.maxConnectionsPerUser:
+                    count > self.maxConnectionsPerUser:
                 msg("Too Many Connections For User (%s) [%s/%s]" % (
                     username,
-                    self._connCountMap[username],
+                    count,
                     self.maxConnectionsPerUser,
                     ))
                 self.sendLine(RESPONSE[TOO_MANY_CONNECTIONS])
                 self.transport.loseConnection()
-            return res
+
+        def not_counted(failure, username):
+            log.err(failure, "Could not count the session of %s" % username)
+
+        def pass_cb(res):
+            username = self.shell.username()
+            d = self.sessionCounter.acquire(username)
+            d.addCallbacks(counted, not_counted, callbackArgs=(username,),
+                           errbackArgs=(username,))
+            d.addCallback(lambda _: res)
+            return d
+
+        def rejected(failure):
+            failure.trap(LoginRejected)
+            msg("Login Rejected: %s" % failure.getErrorMessage())
+            self.sendLine(RESPONSE[SVC_NOT_AVAIL_CLOSING_CTRL_CNX])
+            self.transport.loseConnection()
 
         d.addCallback(pass_cb)
+        d.addErrback(rejected)
+        return d
+
+    def _sendListing(self, listing, format_line):
+        " Streams a listing to the data connection "
+        self.reply(DATA_CNX_ALREADY_OPEN_START_XFR)
+        producer = ListingProducer(listing, format_line, self.dtpInstance)
+
+        def eb(failure):
+            failure.trap(defer.CancelledError)
+            return (CNX_CLOSED_TXFR_ABORTED,)
+
+        d = producer.start()
+        d.addCallbacks(lambda _: (TXFR_COMPLETE_OK,), eb)
         return d
 
     def ftp_LIST(self, path=''):
+        if self.dtpInstance is None or not self.dtpInstance.isConnected:
+            return defer.fail(
+                BadCmdSequenceError('must send PORT or PASV before LIST'))
+
         # ignore special flags for command LIST
         keys = ['-a', '-l', '-la', '-al']
         segm = path.split()
         path = " ".join(s for s in segm if s.lower() not in keys)
 
-        return super(SwftpFTPProtocol, self).ftp_LIST(path)
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        formatter = ListFormatter()
+        d = self.shell.listing(segments)
+        d.addCallback(self._sendListing, formatter.line)
+        return d
 
     def ftp_NLST(self, path=''):
         """
         Overwrite for fix http://twistedmatrix.com/trac/ticket/4258
         """
-        return super(SwftpFTPProtocol, self).ftp_NLST(path)
+        if self.dtpInstance is None or not self.dtpInstance.isConnected:
+            return defer.fail(
+                BadCmdSequenceError('must send PORT or PASV before NLST'))
+
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        glob = None
+        if _isGlobbingExpression(segments):
+            glob = segments.pop()
+
+        def format_line(name, entry):
+            if not glob or fnmatch.fnmatch(name, glob):
+                return name
+
+        def eb(failure):
+            # RFC 959: send nothing for paths that can't be listed
+            failure.trap(FileNotFoundError)
+            self.dtpInstance.transport.loseConnection()
+            return (TXFR_COMPLETE_OK,)
+
+        d = self.shell.listing(segments)
+        d.addCallbacks(self._sendListing, eb, callbackArgs=(format_line,))
+        return d
+
+    def ftp_MLSD(self, path=''):
+        """ Machine-readable listing of a directory (RFC 3659) sent over the
+            data connection
+        """
+        if self.dtpInstance is None or not self.dtpInstance.isConnected:
+            return defer.fail(
+                BadCmdSequenceError('must send PORT or PASV before MLSD'))
+
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        d = self.shell.listing(segments)
+        d.addCallback(self._sendListing, FactsFormatter().line)
+        return d
+
+    def ftp_MLST(self, path=''):
+        """ Machine-readable facts about a single path (RFC 3659) sent over
+            the control connection
+        """
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        formatter = FactsFormatter()
+
+        def cb(result):
+            name = '/' + '/'.join(segments)
+            self.sendLine('250- Listing %s' % name)
+            self.sendLine(' %s%s' % (formatter.facts(*result), name))
+            return (REQ_FILE_ACTN_COMPLETED_OK,)
+
+        d = self.shell.stat(segments, formatter.keys)
+        d.addCallback(cb)
+        return d
+
+    def ftp_HASH(self, path):
+        """ Returns the MD5 that swift stored for a file, so clients can
+            verify transfers without downloading the file again
+        """
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        def cb(result):
+            size, md5 = result
+            return (FILE_STATUS, 'MD5 0-%s %s %s' % (size, md5, path))
+
+        d = self.shell.hash(segments)
+        d.addCallback(cb)
+        return d
+
+    def ftp_XMD5(self, path):
+        try:
+            segments = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        def cb(result):
+            size, md5 = result
+            self.sendLine('250 %s' % md5)
+
+        d = self.shell.hash(segments)
+        d.addCallback(cb)
+        return d
+
+    def ftp_STOR(self, path):
+        offset = getattr(self.dtpInstance, 'rest_offset', 0)
+        if offset:
+            del self.dtpInstance.rest_offset  # reset for next command
+        return self._store(path, offset)
+
+    def ftp_APPE(self, path):
+        return self._store(path, None)
+
+    def _store(self, path, offset):
+        """ Same as FTP.ftp_STOR except that the shell is told where the data
+            starts. Resumed uploads (REST+STOR) and APPE only send the missing
+            bytes to swift.
+
+        :param path: path to store the data to
+        :param offset: offset to write at, None appends to the end
+
+        """
+        if self.dtpInstance is None:
+            raise BadCmdSequenceError('PORT or PASV required before STOR')
+
+        try:
+            newsegs = toSegments(self.workingDirectory, path)
+        except InvalidPath:
+            return defer.fail(FileNotFoundError(path))
+
+        self.setTimeout(None)
+
+        def enableTimeout(result):
+            self.setTimeout(self.factory.timeOut)
+            return result
+
+        def cbOpened(file):
+            d = file.receive()
+            d.addCallback(cbConsumer)
+            d.addCallback(lambda ignored: file.close())
+            d.addCallbacks(cbSent, ebSent)
+            return d
+
+        def ebOpened(err):
+            if isinstance(err.value, FTPCmdError):
+                return (err.value.errorCode, '/'.join(newsegs))
+            log.err(err, "Unexpected error received while opening file:")
+            return (FILE_NOT_FOUND, '/'.join(newsegs))
+
+        def cbConsumer(cons):
+            if not self.binary:
+                cons = ASCIIConsumerWrapper(cons)
+            d = self.dtpInstance.registerConsumer(cons)
+            if self.dtpInstance.isConnected:
+                self.reply(DATA_CNX_ALREADY_OPEN_START_XFR)
+            else:
+                self.reply(FILE_STATUS_OK_OPEN_DATA_CNX)
+            return d
+
+        def cbSent(result):
+            return (TXFR_COMPLETE_OK,)
+
+        def ebSent(err):
+            log.err(err, "Unexpected error received during transfer:")
+            if err.check(FTPCmdError):
+                return err
+            return (CNX_CLOSED_TXFR_ABORTED,)
+
+        d = self.shell.openForWriting(newsegs, offset)
+        d.addCallbacks(cbOpened, ebOpened)
+        d.addBoth(enableTimeout)
+        return d
 
     def ftp_REST(self, value):
         if self.dtpInstance is None:
@@ -165,9 +522,10 @@ class SwiftFTPShell(object):
 
     allow_no_existing_path = False
 
-    def __init__(self, swiftconn):
+    def __init__(self, swiftconn, listing_cache_ttl=10):
         self.swiftconn = swiftconn
         self.swiftfilesystem = SwiftFileSystem(self.swiftconn)
+        self.listing_cache = ListingCache(ttl=listing_cache_ttl)
         self.log_command('login')
 
     def log_command(self, command, *args):
@@ -191,11 +549,13 @@ class SwiftFTPShell(object):
     def makeDirectory(self, path):
         self.log_command('makeDirectory', path)
         fullpath = self._fullpath(path)
+        self.listing_cache.invalidate()
         return self.swiftfilesystem.makeDirectory(fullpath)
 
     def removeDirectory(self, path):
         self.log_command('removeDirectory', path)
         fullpath = self._fullpath(path)
+        self.listing_cache.invalidate()
 
         def not_found_eb(failure):
             failure.trap(NotFound)
@@ -213,6 +573,7 @@ class SwiftFTPShell(object):
     def removeFile(self, path):
         self.log_command('removeFile', path)
         fullpath = self._fullpath(path)
+        self.listing_cache.invalidate()
 
         def errback(failure):
             failure.trap(NotFound, NotImplementedError)
@@ -226,6 +587,7 @@ class SwiftFTPShell(object):
         self.log_command('rename', fromPath, toPath)
         oldpath = self._fullpath(fromPath)
         newpath = self._fullpath(toPath)
+        self.listing_cache.invalidate()
 
         d = self.swiftfilesystem.renameFile(oldpath, newpath)
 
@@ -275,6 +637,14 @@ class SwiftFTPShell(object):
         self.log_command('stat', path, keys)
         fullpath = self._fullpath(path)
 
+        # Answer from the last listing when possible. Clients tend to send
+        # SIZE/MDTM for every file right after a LIST. Large objects are
+        # listed with the size of their manifest (0), so ask swift for those.
+        entry = self.listing_cache.lookup(fullpath)
+        if entry is not None and (
+                entry.size or entry.content_type == 'application/directory'):
+            return defer.succeed(stat_format(keys, entry))
+
         def cb(result):
             return stat_format(keys, result)
 
@@ -287,15 +657,41 @@ class SwiftFTPShell(object):
         d.addErrback(err)
         return d
 
-    def list(self, path=None, keys=()):
+    def hash(self, path):
+        """ Returns a deferred that fires with a (size, md5) tuple for the
+            given file. Only a HEAD request is made.
+        """
+        self.log_command('hash', path)
+        fullpath = self._fullpath(path)
+
+        def cb(result):
+            if not result['hash']:
+                raise CmdNotImplementedForArgError(
+                    'No MD5 is stored for large objects.')
+            return int(result['size']), result['hash']
+
+        def err(failure):
+            failure.trap(NotFound)
+            return defer.fail(FileNotFoundError(fullpath))
+
+        try:
+            d = self.swiftfilesystem.checkFileExistance(fullpath)
+        except NotImplementedError:
+            return defer.fail(IsADirectoryError(fullpath))
+        d.addCallback(cb)
+        d.addErrback(err)
+        return d
+
+    def listing(self, path=None):
+        """ Returns a deferred that fires with an OrderedDict of
+            {name: ListingEntry} for the given path
+        """
         self.log_command('list', path)
         fullpath = self._fullpath(path)
 
-        def cb(results):
-            l = []
-            for key, value in results.iteritems():
-                l.append([key, stat_format(keys, value)])
-            return l
+        def cb(listing):
+            self.listing_cache.store(fullpath, listing)
+            return listing
 
         def err(failure):
             failure.trap(NotFound)
@@ -306,6 +702,17 @@ class SwiftFTPShell(object):
         d.addErrback(err)
         return d
 
+    def list(self, path=None, keys=()):
+        def cb(results):
+            l = []
+            for key, value in results.iteritems():
+                l.append([key, stat_format(keys, value)])
+            return l
+
+        d = self.listing(path)
+        d.addCallback(cb)
+        return d
+
     def openForReading(self, path):
         self.log_command('openForReading', path)
         fullpath = self._fullpath(path)
@@ -325,19 +732,42 @@ class SwiftFTPShell(object):
         except NotImplementedError:
             return defer.fail(IsADirectoryError(fullpath))
 
-    def openForWriting(self, path):
+    def openForWriting(self, path, offset=0):
+        """ Opens a file for writing. With a non-zero offset the data is
+            appended to the existing file (see
+            `SwiftFileSystem.prepareAppend`). None appends to the end.
+        """
         self.log_command('openForWriting', path)
         fullpath = self._fullpath(path)
         container, obj = obj_to_path(fullpath)
         if not container or not obj:
             raise CmdNotImplementedForArgError(
                 'Cannot upload files to root directory.')
-        f = SwiftWriteFile(self.swiftfilesystem, fullpath)
-        return defer.succeed(f)
+        self.listing_cache.invalidate()
+        if offset == 0:
+            f = SwiftWriteFile(self.swiftfilesystem, fullpath)
+            return defer.succeed(f)
+
+        def cb(uploadpath):
+            return SwiftWriteFile(self.swiftfilesystem, uploadpath)
+
+        def err(failure):
+            failure.trap(NotFound, NotImplementedError)
+            if failure.check(NotFound):
+                return defer.fail(FileNotFoundError(fullpath))
+            return defer.fail(CmdNotImplementedForArgError(
+                failure.value.args[0]))
+
+        d = self.swiftfilesystem.prepareAppend(fullpath, offset)
+        d.addCallback(cb)
+        d.addErrback(err)
+        return d
 
 
 class SwiftWriteFile(object):
     implements(IWriteFile)
+    # swftp.ratelimit.RateLimiter for uploads, if any
+    ingress_limiter = None
 
     def __init__(self, swiftfilesystem, fullpath):
         self.swiftfilesystem = swiftfilesystem
@@ -347,7 +777,11 @@ class SwiftWriteFile(object):
     def receive(self):
         d, writer = self.swiftfilesystem.startFileUpload(self.fullpath)
         self.finished = d
-        return writer.started
+        if self.ingress_limiter is None:
+            return writer.started
+        throttle = self.ingress_limiter.throttle(
+            self.swiftfilesystem.swiftconn.username)
+        return writer.started.addCallback(ThrottledConsumer, throttle)
 
     def close(self):
         return self.finished
@@ -355,6 +789,8 @@ class SwiftWriteFile(object):
 
 class SwiftReadFile(Protocol):
     implements(IReadFile)
+    # swftp.ratelimit.RateLimiter for downloads, if any
+    egress_limiter = None
 
     def __init__(self, swiftfilesystem, fullpath):
         self.swiftfilesystem = swiftfilesystem
@@ -382,6 +818,10 @@ class SwiftReadFile(Protocol):
         at = getattr(consumer, "rest_offset", 0)
         if at:
             del consumer.rest_offset  # reset for next command
+        if self.egress_limiter is not None:
+            consumer = ThrottledConsumer(
+                consumer, self.egress_limiter.throttle(
+                    self.swiftfilesystem.swiftconn.username))
         self.consumer = consumer
         d = self.swiftfilesystem.startFileDownload(
             self.fullpath, self, offset=at)
@@ -4,7 +4,7 @@ This file defines what is required for swftp-ftp to work with twistd.
 See COPYING for license information.
 """
 from swftp import VERSION
-from swftp.logging import StdOutObserver
+from swftp.logging import StdOutObserver, WorkerLogObserver
 
 from twisted.application import internet, service
 from twisted.python import usage, log
@@ -18,6 +18,7 @@ import sys
 CONFIG_DEFAULTS = {
     'auth_url': 'http://127.0.0.1:8080/auth/v1.0',
     'swift_proxy': '',
+    'http_backend': 'swftp.swift.twisted_agent',
     'host': '0.0.0.0',
     'port': '5021',
 
@@ -26,10 +27,15 @@ CONFIG_DEFAULTS = {
 
     'num_persistent_connections': '100',
     'num_connections_per_session': '10',
+    'num_metadata_connections_per_session': '2',
+    'auth_max_in_flight': '50',
+    'auth_max_queued': '500',
+    'auth_queue_timeout': '30',
     'connection_timeout': '240',
     'session_timeout': '60',
     'sessions_per_user': '10',
     'extra_headers': '',
+    'user_weights': '',
     'verbose': 'false',
     'welcome_message': 'Welcome to SwFTP'
                        ' - an FTP interface for Openstack Swift',
@@ -41,7 +47,32 @@ CONFIG_DEFAULTS = {
     'stats_host': '',
     'stats_port': '38021',
 
+    'workers': '1',
+    'session_counter': 'local',
+    'session_counter_file': '/tmp/swftp-ftp-sessions',
+    'session_counter_slots': '65536',
+    'session_counter_host': '127.0.0.1',
+    'session_counter_port': '38121',
+    'session_counter_serve': 'no',
+
     'allow_no_existing_path': 'no',
+    'listing_cache_ttl': '10',
+
+    'spool_dir': '',
+    'spool_max_size': '10737418240',
+    'spool_max_flushes': '10',
+    'spool_segment_size': '104857600',
+
+    'object_cache_size': '0',
+    'object_cache_max_object_size': '1048576',
+    'object_cache_dir': '',
+    'object_cache_disk_size': '1073741824',
+
+    'ingress_rate_limit': '0',
+    'egress_rate_limit': '0',
+    'user_ingress_rate_limit': '0',
+    'user_egress_rate_limit': '0',
+    'user_rate_limits': '',
 }
 
 
@@ -54,8 +85,11 @@ def run():
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
-    # Start Logging
-    obs = StdOutObserver()
+    # Start Logging. Workers send their log to the supervisor.
+    if options['log_fd']:
+        obs = WorkerLogObserver(int(options['log_fd']))
+    else:
+        obs = StdOutObserver()
     obs.start()
 
     s = makeService(options)
@@ -94,6 +128,11 @@ class Options(usage.Options):
             "[default: http://127.0.0.1:8080/auth/v1.0]"],
         ["port", "p", None, "Port to bind to."],
         ["host", "h", None, "IP to bind to."],
+        ["listen_fd", None, None, "(internal) Listening socket of a worker."],
+        ["session_fds", None, None,
+            "(internal) Session count pipes of a worker."],
+        ["log_fd", None, None, "(internal) Log pipe of a worker."],
+        ["worker", None, None, "(internal) Index of a worker."],
     ]
 
 
@@ -105,9 +144,12 @@ def makeService(options):
     from twisted.protocols.ftp import FTPFactory
     from twisted.cred.portal import Portal
 
-    from swftp.ftp.server import SwftpFTPProtocol
+    from swftp.ftp.server import (
+        SwftpFTPProtocol, SwiftReadFile, SwiftWriteFile)
+    from swftp.ratelimit import RateLimiter
     from swftp.realm import SwftpRealm
-    from swftp.auth import SwiftBasedAuthDB
+    from swftp.auth import SwiftBasedAuthDB, AdmissionControlledChecker
+    from swftp.swiftfilesystem import SwiftFileSystem
     from swftp.utils import (
         log_runtime_info, GLOBAL_METRICS, parse_key_value_config)
 
@@ -116,6 +158,46 @@ def makeService(options):
     c = get_config(options['config_file'], options)
     ftp_service = service.MultiService()
 
+    # Run as the supervisor of worker processes, which serve the connections
+    supervisor = c.getint('ftp', 'workers') > 1 and not options['listen_fd']
+
+    # Per-user session counts are kept in this process unless they are
+    # shared with other processes
+    session_counter = None
+    if c.get('ftp', 'session_counter') == 'shared':
+        from swftp.sessions import SharedSessionCounter
+        session_counter = SharedSessionCounter(
+            c.get('ftp', 'session_counter_file'),
+            slots=c.getint('ftp', 'session_counter_slots'))
+    elif c.get('ftp', 'session_counter') == 'tcp':
+        if c.getboolean('ftp', 'session_counter_serve') and \
+                not options['listen_fd']:
+            from swftp.sessions import (
+                LocalSessionCounter, SessionCountServerFactory)
+            session_counter = LocalSessionCounter()
+            internet.TCPServer(
+                c.getint('ftp', 'session_counter_port'),
+                SessionCountServerFactory(session_counter),
+                interface=c.get('ftp', 'session_counter_host'),
+            ).setServiceParent(ftp_service)
+        elif not supervisor:
+            from swftp.sessions import TCPSessionCounter
+            session_counter = TCPSessionCounter()
+            internet.TCPClient(
+                c.get('ftp', 'session_counter_host'),
+                c.getint('ftp', 'session_counter_port'),
+                session_counter).setServiceParent(ftp_service)
+
+    if supervisor:
+        from swftp.workers import WorkerSupervisor, listen
+        WorkerSupervisor(
+            'swftp.ftp.service', options,
+            listen(c.getint('ftp', 'port'), c.get('ftp', 'host')),
+            c.getint('ftp', 'workers'),
+            session_counter=session_counter,
+        ).setServiceParent(ftp_service)
+        return ftp_service
+
     # Add statsd service
     if c.get('ftp', 'log_statsd_host'):
         try:
@@ -129,6 +211,39 @@ def makeService(options):
         except ImportError:
             sys.stderr.write('Missing Statsd Module. Requires "txstatsd" \n')
 
+    from twisted.python.reflect import namedAny
+    from swftp.swift import SwiftConnection
+    SwiftConnection.http_backend = staticmethod(
+        namedAny(c.get('ftp', 'http_backend')))
+
+    authdb = SwiftBasedAuthDB(
+        c.get('ftp', 'auth_url'),
+        global_max_concurrency=c.getint('ftp', 'num_persistent_connections'),
+        max_concurrency=c.getint('ftp', 'num_connections_per_session'),
+        max_metadata_concurrency=c.getint(
+            'ftp', 'num_metadata_connections_per_session'),
+        timeout=c.getint('ftp', 'connection_timeout'),
+        proxy=c.get('ftp', 'swift_proxy'),
+        extra_headers=parse_key_value_config(c.get('ftp', 'extra_headers')),
+        verbose=c.getboolean('ftp', 'verbose'),
+        rewrite_scheme=c.get('ftp', 'rewrite_storage_scheme'),
+        rewrite_netloc=c.get('ftp', 'rewrite_storage_netloc'),
+        user_weights=dict(
+            (user, float(weight)) for user, weight in
+            parse_key_value_config(c.get('ftp', 'user_weights')).items()),
+    )
+    checker = authdb
+    gauges = {}
+    if authdb.scheduler:
+        gauges['swift.queue_depth'] = lambda: authdb.scheduler.waiting
+    if c.getint('ftp', 'auth_max_in_flight'):
+        checker = AdmissionControlledChecker(
+            authdb,
+            max_in_flight=c.getint('ftp', 'auth_max_in_flight'),
+            max_queued=c.getint('ftp', 'auth_max_queued'),
+            queue_timeout=c.getfloat('ftp', 'auth_queue_timeout'))
+        gauges['auth.queue_depth'] = lambda: len(checker.queue)
+
     if c.get('ftp', 'stats_host'):
         from swftp.report import makeService as makeReportService
         known_fields = [
@@ -141,35 +256,68 @@ def makeService(options):
             'command.access',
             'command.stat',
             'command.list',
+            'command.hash',
             'command.openForReading',
             'command.openForWriting',
         ] + GLOBAL_METRICS
         makeReportService(
             c.get('ftp', 'stats_host'),
-            c.getint('ftp', 'stats_port'),
-            known_fields=known_fields
+            c.getint('ftp', 'stats_port') + int(options['worker'] or 0),
+            known_fields=known_fields,
+            gauges=gauges,
         ).setServiceParent(ftp_service)
 
-    authdb = SwiftBasedAuthDB(
-        c.get('ftp', 'auth_url'),
-        global_max_concurrency=c.getint('ftp', 'num_persistent_connections'),
-        max_concurrency=c.getint('ftp', 'num_connections_per_session'),
-        timeout=c.getint('ftp', 'connection_timeout'),
-        proxy=c.get('ftp', 'swift_proxy'),
-        extra_headers=parse_key_value_config(c.get('ftp', 'extra_headers')),
-        verbose=c.getboolean('ftp', 'verbose'),
-        rewrite_scheme=c.get('ftp', 'rewrite_storage_scheme'),
-        rewrite_netloc=c.get('ftp', 'rewrite_storage_netloc'),
-    )
-
     realm = SwftpRealm()
     realm.allow_no_existing_path = c.getboolean(
         'ftp', 'allow_no_existing_path')
+    realm.listing_cache_ttl = c.getint('ftp', 'listing_cache_ttl')
+    # Workers split the disk space of the spool and the object cache and
+    # each use their own directory
+    from swftp.workers import worker_share
+    if c.get('ftp', 'spool_dir'):
+        from swftp.spool import UploadSpool
+        spool_dir, spool_size = worker_share(
+            c.get('ftp', 'spool_dir'), c.getint('ftp', 'spool_max_size'),
+            options['worker'], c.getint('ftp', 'workers'))
+        SwiftFileSystem.spool = UploadSpool(
+            spool_dir, spool_size,
+            max_flushes=c.getint('ftp', 'spool_max_flushes'),
+            segment_size=c.getint('ftp', 'spool_segment_size'))
+    if c.getint('ftp', 'object_cache_size'):
+        from swftp.objectcache import ObjectCache
+        cache_dir, cache_size = None, 0
+        if c.get('ftp', 'object_cache_dir'):
+            cache_dir, cache_size = worker_share(
+                c.get('ftp', 'object_cache_dir'),
+                c.getint('ftp', 'object_cache_disk_size'),
+                options['worker'], c.getint('ftp', 'workers'))
+        SwiftFileSystem.object_cache = ObjectCache(
+            c.getint('ftp', 'object_cache_size'),
+            max_object_size=c.getint('ftp', 'object_cache_max_object_size'),
+            directory=cache_dir, disk_size=cache_size)
+    user_rates = dict(
+        (user, int(rate)) for user, rate in
+        parse_key_value_config(c.get('ftp', 'user_rate_limits')).items())
+    if c.getint('ftp', 'ingress_rate_limit') or \
+            c.getint('ftp', 'user_ingress_rate_limit') or user_rates:
+        SwiftWriteFile.ingress_limiter = RateLimiter(
+            c.getint('ftp', 'ingress_rate_limit'),
+            user_rate=c.getint('ftp', 'user_ingress_rate_limit'),
+            user_rates=user_rates)
+    if c.getint('ftp', 'egress_rate_limit') or \
+            c.getint('ftp', 'user_egress_rate_limit') or user_rates:
+        SwiftReadFile.egress_limiter = RateLimiter(
+            c.getint('ftp', 'egress_rate_limit'),
+            user_rate=c.getint('ftp', 'user_egress_rate_limit'),
+            user_rates=user_rates)
+
     ftpportal = Portal(realm)
-    ftpportal.registerChecker(authdb)
+    ftpportal.registerChecker(checker)
     ftpfactory = FTPFactory(ftpportal)
     protocol = SwftpFTPProtocol
     protocol.maxConnectionsPerUser = c.getint('ftp', 'sessions_per_user')
+    if session_counter is not None:
+        protocol.sessionCounter = session_counter
     ftpfactory.protocol = protocol
     ftpfactory.welcomeMessage = c.get('ftp', 'welcome_message')
     ftpfactory.allowAnonymous = False
@@ -178,8 +326,19 @@ def makeService(options):
     signal.signal(signal.SIGUSR1, log_runtime_info)
     signal.signal(signal.SIGUSR2, log_runtime_info)
 
-    internet.TCPServer(
-        c.getint('ftp', 'port'),
-        ftpfactory,
-        interface=c.get('ftp', 'host')).setServiceParent(ftp_service)
+    if options['listen_fd']:
+        from swftp.workers import WorkerService, address_family
+        WorkerService(
+            ftpfactory,
+            int(options['listen_fd']),
+            address_family(c.get('ftp', 'host')),
+            [int(fd) for fd in options['session_fds'].split(',')],
+            protocol,
+            count_sessions=session_counter is None,
+        ).setServiceParent(ftp_service)
+    else:
+        internet.TCPServer(
+            c.getint('ftp', 'port'),
+            ftpfactory,
+            interface=c.get('ftp', 'host')).setServiceParent(ftp_service)
     return ftp_service
@@ -1,6 +1,8 @@
 """
 See COPYING for license information.
 """
+import json
+import os
 import sys
 import syslog as pysyslog
 
@@ -35,6 +37,32 @@ class StdOutObserver(LogObserver):
         self.obs = log.FileLogObserver(sys.stdout)
 
 
+class WorkerLogObserver(LogObserver):
+    """ Sends the log of a worker process to its supervisor (see
+        swftp.workers), which logs it wherever its own log goes
+
+    :param int fd: file descriptor of the log pipe to the supervisor
+
+    """
+    def __init__(self, fd):
+        self.obs = self
+        self.pipe = os.fdopen(fd, 'w')
+
+    def emit(self, event_dict):
+        text = log.textFromEventDict(event_dict)
+        if not text:
+            return
+        try:
+            self.pipe.write('%s\n' % json.dumps({
+                'message': text,
+                'isError': bool(event_dict.get('isError')),
+            }))
+            self.pipe.flush()
+        except IOError:
+            # The supervisor is gone, the worker exits soon
+            pass
+
+
 class SysLogObserver(LogObserver):
     facility = pysyslog.LOG_USER
 
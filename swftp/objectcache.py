@@ -0,0 +1,283 @@
+"""
+Read-through cache for small objects that are downloaded over and over. The
+data of an object is kept in memory and, when a cache directory is configured,
+moved to disk once it is pushed out of memory. Cached entries are revalidated
+with a conditional GET (If-None-Match) every time they are used, so only
+unchanged objects are served from the cache.
+
+See COPYING for license information.
+"""
+import errno
+import hashlib
+import os
+import re
+
+from twisted.internet import task
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+
+from swftp.swift import NotModified
+from swftp.utils import OrderedDict
+
+
+class ObjectCache(object):
+    """ Two tiered LRU cache of object data, keyed by (storage_url, path).
+
+    :param int memory_size: bytes of object data kept in memory
+    :param int max_object_size: objects larger than this aren't cached
+    :param str directory: directory for the disk tier. Entries pushed out of
+        memory are dropped if this is None
+    :param int disk_size: bytes of object data kept in the directory
+
+    The disk tier reads, writes and removes its files in the reactor thread,
+    so it is meant for a local disk and objects of at most a few megabytes.
+    Files that an earlier process left in the directory are removed on start.
+    Errors of the disk tier are logged and treated as cache misses.
+
+    """
+    # Names of the files of the disk tier, see _diskPath
+    file_name = re.compile(r'^[0-9a-f]{40}(\.tmp)?$')
+
+    def __init__(self, memory_size, max_object_size=1024 * 1024,
+                 directory=None, disk_size=0):
+        self.memory_size = memory_size
+        self.max_object_size = max_object_size
+        self.directory = directory
+        self.disk_size = disk_size
+        if directory:
+            self._clearDirectory()
+
+        self.memory = OrderedDict()  # key -> (etag, data)
+        self.disk = OrderedDict()  # key -> (etag, size)
+        self.memory_used = 0
+        self.disk_used = 0
+
+    def get(self, key):
+        " Returns (etag, data) of a cached object or None "
+        entry = self.memory.pop(key, None)
+        if entry is None:
+            entry = self._loadFromDisk(key)
+            if entry is None:
+                return None
+            self.memory_used += len(entry[1])
+        self.memory[key] = entry
+        self._evictMemory()
+        return entry
+
+    def put(self, key, etag, data):
+        " Caches the data of an object "
+        self.discard(key)
+        if len(data) > self.max_object_size:
+            return
+        self.memory[key] = (etag, data)
+        self.memory_used += len(data)
+        self._evictMemory()
+
+    def discard(self, key):
+        " Forgets an object "
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_used -= len(entry[1])
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_used -= entry[1]
+            self._unlink(self._diskPath(key))
+
+    def _diskPath(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _clearDirectory(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            if self.file_name.match(name):
+                self._unlink(os.path.join(self.directory, name))
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                log.msg('Could not remove cached object %s: %s' % (path, e))
+
+    def _evictMemory(self):
+        while self.memory_used > self.memory_size:
+            key, (etag, data) = self.memory.popitem(last=False)
+            self.memory_used -= len(data)
+            self._saveToDisk(key, etag, data)
+
+    def _saveToDisk(self, key, etag, data):
+        if not self.directory or len(data) > self.disk_size:
+            return
+        path = self._diskPath(key)
+        try:
+            f = open(path + '.tmp', 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            log.msg('Could not cache object %s: %s' % (path, e))
+            self._unlink(path + '.tmp')
+            return
+        self.disk[key] = (etag, len(data))
+        self.disk_used += len(data)
+        while self.disk_used > self.disk_size:
+            old_key, (_, size) = self.disk.popitem(last=False)
+            self.disk_used -= size
+            self._unlink(self._diskPath(old_key))
+
+    def _loadFromDisk(self, key):
+        entry = self.disk.pop(key, None)
+        if entry is None:
+            return None
+        etag, size = entry
+        self.disk_used -= size
+        path = self._diskPath(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            log.msg('Could not read cached object %s: %s' % (path, e))
+            return None
+        finally:
+            self._unlink(path)
+        if len(data) != size:
+            return None
+        return etag, data
+
+
+class CachedBodyTransport(object):
+    " Lets the consumer of a cached body pause, resume and stop sending it "
+    def __init__(self, cooperative_task):
+        self.task = cooperative_task
+        self.paused = False
+
+    def pauseProducing(self):
+        if self.paused:
+            return
+        try:
+            self.task.pause()
+            self.paused = True
+        except task.TaskFinished:
+            pass
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.task.resume()
+
+    def stopProducing(self):
+        try:
+            self.task.stop()
+        except task.TaskFinished:
+            pass
+
+
+class CachingReceiver(Protocol):
+    """ Sits between a GET request and the protocol that was passed to
+        `SwiftFileSystem.startFileDownload`. Bodies of small objects are put
+        into the cache on their way through. If swift answers a conditional
+        GET with NotModified the consumer is sent the cached copy.
+
+    :param cache: ObjectCache instance
+    :param key: cache key of the object
+    :param consumer: twisted.internet.protocol.Protocol to send the body to
+    :param cached: the (etag, data) that was revalidated, if any
+
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, cache, key, consumer, cached=None):
+        self.cache = cache
+        self.key = key
+        self.consumer = consumer
+        self.cached = cached
+
+        self.transport = None
+        self.response = None
+        self.reason = None      # set when the body is complete
+        self.received = []      # data that arrived before the response
+        self.recording = False  # whether the body is being cached
+        self.recorded = []
+        self.etag = None
+
+    def notModified(self, failure):
+        " Sends the cached copy once swift confirmed that it's still valid "
+        failure.trap(NotModified)
+        log.msg(metric='object_cache.hit')
+        self._replay()
+
+    def gotResponse(self, response):
+        " Starts forwarding the body once swift sent a new copy "
+        self.response = response
+        log.msg(metric='object_cache.miss')
+        self.cache.discard(self.key)
+        self.recording = self._cacheable(response)
+        self.consumer.makeConnection(self.transport)
+        for data in self.received:
+            self._forward(data)
+        self.received = []
+        if self.reason is not None:
+            self._finish()
+        return response
+
+    def _cacheable(self, response):
+        if response.code != 200:
+            return False
+        headers = response.headers
+        etag = headers.getRawHeaders('etag')
+        length = headers.getRawHeaders('content-length')
+        if not etag or not length or \
+                headers.hasHeader('x-object-manifest') or \
+                headers.hasHeader('x-static-large-object'):
+            return False
+        self.etag = etag[-1].strip('"')
+        return int(length[-1]) <= self.cache.max_object_size
+
+    def _forward(self, data):
+        if self.recording:
+            self.recorded.append(data)
+        self.consumer.dataReceived(data)
+
+    def _finish(self):
+        if self.recording and self.reason.check(ResponseDone):
+            self.cache.put(self.key, self.etag, ''.join(self.recorded))
+        self.recorded = []
+        self.consumer.connectionLost(self.reason)
+
+    def _replay(self):
+        data = self.cached[1]
+
+        def send():
+            for i in xrange(0, len(data), self.chunk_size):
+                self.consumer.dataReceived(data[i:i + self.chunk_size])
+                yield None
+
+        t = task.cooperate(send())
+        self.consumer.makeConnection(CachedBodyTransport(t))
+        t.whenDone().addCallbacks(
+            lambda _: self.consumer.connectionLost(Failure(ResponseDone())),
+            self.consumer.connectionLost)
+
+    # Protocol
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        if self.response is None:
+            self.received.append(data)
+        else:
+            self._forward(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+        if self.response is not None:
+            self._finish()
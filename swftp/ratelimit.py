@@ -0,0 +1,161 @@
+"""
+Bandwidth limits for transfers. Each chunk that is transferred is taken from
+token buckets: one for the whole process and one for the user. A bucket may
+go into debt; the transfer then pauses its producer until the debt is paid
+off, so the cost is constant per chunk.
+
+    limiter = RateLimiter(rate=100 * 1024 * 1024, user_rate=10 * 1024 * 1024)
+    throttle = limiter.throttle('user')
+    wait = throttle.consume(len(data))
+    if wait:
+        producer.pauseProducing()
+        wait.addCallback(lambda _: producer.resumeProducing())
+
+See COPYING for license information.
+"""
+import weakref
+
+from zope import interface
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IConsumer, IPushProducer
+
+
+class TokenBucket(object):
+    """ Tokens (bytes) flow in at a fixed rate, up to a burst
+
+    :param rate: bytes per second
+    :param int burst: bytes that may be sent at once after an idle period
+        (default: one second's worth)
+    :param clock: IReactorTime provider
+
+    """
+    def __init__(self, rate, burst=None, clock=reactor):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock.seconds()
+
+    def consume(self, size):
+        " Takes size tokens and returns the seconds until none are owed "
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Throttle(object):
+    """ The buckets that one transfer takes from
+
+    :param buckets: list of TokenBucket
+    :param clock: IReactorTime provider
+
+    """
+    def __init__(self, buckets, clock=reactor):
+        self.buckets = buckets
+        self.clock = clock
+
+    def consume(self, size):
+        """ Accounts for a chunk of size bytes. Returns None if the transfer
+            may go on, or a Deferred that fires when it may resume.
+        """
+        delay = 0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.consume(size))
+        if delay:
+            return task.deferLater(self.clock, delay, lambda: None)
+
+
+class RateLimiter(object):
+    """ Limits one direction of transfers, for the process and per user.
+        Users share a bucket between their transfers.
+
+    :param int rate: bytes per second for the whole process, 0 is unlimited
+    :param int user_rate: bytes per second for each user, 0 is unlimited
+    :param dict user_rates: user -> bytes per second, overrides user_rate
+    :param clock: IReactorTime provider
+
+    """
+    def __init__(self, rate=0, user_rate=0, user_rates=None, clock=reactor):
+        self.user_rate = user_rate
+        self.user_rates = user_rates or {}
+        self.clock = clock
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, clock=clock)
+        # Buckets are dropped when the last transfer of the user is done
+        self.user_buckets = weakref.WeakValueDictionary()
+
+    def throttle(self, user):
+        " Returns the Throttle for a transfer of the given user "
+        buckets = []
+        if self.bucket:
+            buckets.append(self.bucket)
+        rate = self.user_rates.get(user, self.user_rate)
+        if rate:
+            bucket = self.user_buckets.get(user)
+            if bucket is None:
+                bucket = TokenBucket(rate, clock=self.clock)
+                self.user_buckets[user] = bucket
+            buckets.append(bucket)
+        return Throttle(buckets, clock=self.clock)
+
+
+class ThrottledConsumer(object):
+    """ Sits between a streaming producer and its consumer and pauses the
+        producer while the throttle says so
+
+    :param consumer: IConsumer to pass the data to
+    :param throttle: Throttle of the transfer
+
+    """
+    interface.implements(IConsumer, IPushProducer)
+
+    def __init__(self, consumer, throttle):
+        self.consumer = consumer
+        self.throttle = throttle
+        self.producer = None
+        self.paused = False     # paused by the consumer
+        self.throttled = False  # paused by the throttle
+
+    # IConsumer
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.consumer.registerProducer(self, streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.consumer.unregisterProducer()
+
+    def write(self, data):
+        self.consumer.write(data)
+        wait = self.throttle.consume(len(data))
+        if wait and not self.throttled:
+            self.throttled = True
+            if not self.paused and self.producer:
+                self.producer.pauseProducing()
+            wait.addCallback(self._unthrottle)
+
+    def _unthrottle(self, ignored):
+        self.throttled = False
+        if not self.paused and self.producer:
+            self.producer.resumeProducing()
+
+    # IPushProducer
+    def pauseProducing(self):
+        self.paused = True
+        if not self.throttled and self.producer:
+            self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.throttled and self.producer:
+            self.producer.resumeProducing()
+
+    def stopProducing(self):
+        if self.producer:
+            self.producer.stopProducing()
@@ -20,6 +20,7 @@ class SwftpRealm(object):
     interface.implements(portal.IRealm)
 
     allow_no_existing_path = False
+    listing_cache_ttl = 10
 
     def getHomeDirectory(self):
         return '/'
@@ -31,7 +32,8 @@ class SwftpRealm(object):
                 avatar = SwiftSFTPUser(avatarId)
                 return interface, avatar, avatar.logout
             elif HAS_FTP and interface == IFTPShell:
-                shell = SwiftFTPShell(avatarId)
+                shell = SwiftFTPShell(
+                    avatarId, listing_cache_ttl=self.listing_cache_ttl)
                 shell.allow_no_existing_path = self.allow_no_existing_path
                 return interface, shell, shell.logout
 
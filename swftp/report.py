@@ -18,12 +18,19 @@ class Stats(Resource):
     Routes:
         GET /stats.json
 
+    :param metric_collector: MetricCollector instance
+    :param list known_fields: metrics that are reported even if they were
+        never logged
+    :param dict gauges: callables that return the current value of a
+        measurement, keyed by name
+
     """
     isLeaf = True
 
-    def __init__(self, metric_collector, known_fields=None):
+    def __init__(self, metric_collector, known_fields=None, gauges=None):
         self.metric_collector = metric_collector
         self.known_fields = known_fields or []
+        self.gauges = gauges or {}
 
     def _populate_known_fields(self, d, default=0):
         for field in self.known_fields:
@@ -39,6 +46,8 @@ class Stats(Resource):
             'rates': dict(
                 (key, sum(value) / len(value)) for (key, value) in
                 samples.items()),
+            'gauges': dict(
+                (key, gauge()) for (key, gauge) in self.gauges.items()),
         }
 
     def render_GET(self, request):
@@ -63,11 +72,12 @@ class CustomEncoder(json.JSONEncoder):
         return str(obj)
 
 
-def makeService(host='127.0.0.1', port=8125, known_fields=None):
+def makeService(host='127.0.0.1', port=8125, known_fields=None,
+                gauges=None):
     metric_collector = MetricCollector()
     metric_collector.start()
 
-    root = Stats(metric_collector, known_fields=known_fields)
+    root = Stats(metric_collector, known_fields=known_fields, gauges=gauges)
     site = Site(root)
 
     def sample_metrics():
@@ -0,0 +1,102 @@
+"""
+Shares the requests that may be made to swift at once between the users of
+the server. Requests are served in order of priority. Within a priority,
+each user that is waiting gets a turn in round robin (deficit round robin),
+so a user with many requests can't hold up the others.
+
+    scheduler = FairScheduler(100)
+    d = scheduler.acquire('user', 'metadata')
+    d.addCallback(make_request)
+    d.addBoth(lambda result: scheduler.release() or result)
+
+See COPYING for license information.
+"""
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+class FairScheduler(object):
+    """ Limits the number of requests in progress at once and decides whose
+        request goes next when one finishes
+
+    :param int max_concurrency: number of requests in progress at once
+    :param dict weights: user -> share of the turns of that user relative to
+        the others (default: 1)
+    :param clock: IReactorTime provider
+
+    """
+    # Priorities, highest first. Metadata requests (listings, stat, deletes)
+    # are short and a client waits on each one, so they go ahead of transfers.
+    priorities = ('metadata', 'transfer')
+
+    def __init__(self, max_concurrency, weights=None, clock=reactor):
+        self.max_concurrency = max_concurrency
+        self.weights = weights or {}
+        for user, weight in self.weights.items():
+            if weight <= 0:
+                raise ValueError('Weight of %s must be positive' % user)
+        self.clock = clock
+        self.in_flight = 0
+        self.waiting = 0
+        # priority -> deque of users with waiting requests, in turn order
+        self.rounds = dict((p, deque()) for p in self.priorities)
+        # (priority, user) -> deque of (deferred, time queued)
+        self.queues = {}
+        # (priority, user) -> requests the user may still make this turn
+        self.deficits = {}
+
+    def acquire(self, user, priority='transfer'):
+        """ Returns a Deferred that fires when the user may make a request.
+            release() must be called once the request is done.
+
+        :param user: name of the user the request is made for
+        :param priority: one of FairScheduler.priorities
+
+        """
+        if self.in_flight < self.max_concurrency and not self.waiting:
+            self.in_flight += 1
+            return defer.succeed(None)
+
+        log.msg(metric='swift.queued')
+        d = defer.Deferred()
+        key = (priority, user)
+        if key not in self.queues:
+            self.queues[key] = deque()
+            self.deficits[key] = self.weights.get(user, 1)
+            self.rounds[priority].append(user)
+        self.queues[key].append((d, self.clock.seconds()))
+        self.waiting += 1
+        return d
+
+    def release(self):
+        " Ends a request and lets the next one start "
+        self.in_flight -= 1
+        while self.waiting and self.in_flight < self.max_concurrency:
+            priority, d, queued = self._next()
+            self.in_flight += 1
+            self.waiting -= 1
+            log.msg(metric='swift.queue_wait_ms.%s' % priority,
+                    count=int((self.clock.seconds() - queued) * 1000))
+            d.callback(None)
+
+    def _next(self):
+        " Takes the request that goes next off its queue "
+        for priority in self.priorities:
+            rounds = self.rounds[priority]
+            while rounds:
+                key = (priority, rounds[0])
+                if self.deficits[key] < 1:
+                    # The turn of the user is over. Its share is added for
+                    # the next one.
+                    self.deficits[key] += self.weights.get(rounds[0], 1)
+                    rounds.rotate(-1)
+                    continue
+                self.deficits[key] -= 1
+                d, queued = self.queues[key].popleft()
+                if not self.queues[key]:
+                    del self.queues[key]
+                    del self.deficits[key]
+                    rounds.popleft()
+                return priority, d, queued
@@ -0,0 +1,279 @@
+"""
+Counts the sessions of each user so that sessions_per_user can be enforced.
+The count is kept in-process by default. Worker processes (see
+swftp.workers) ask the supervisor, which holds the counts of all workers.
+Processes on one host can share counts through a memory mapped file
+(SharedSessionCounter) and several hosts through a counter service
+(TCPSessionCounter).
+
+Every counted session is a lease that ends with the process or connection
+that holds it, so the sessions of crashed processes don't stay counted.
+
+See COPYING for license information.
+"""
+from collections import defaultdict
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+
+class SessionCounterFull(Exception):
+    pass
+
+
+class LocalSessionCounter(object):
+    " Counts the sessions of each user in this process "
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def acquire(self, username):
+        """ Counts a new session of the user
+
+        :returns: deferred that fires with the number of sessions of the user,
+            including the new one
+
+        """
+        self.counts[username] += 1
+        return defer.succeed(self.counts[username])
+
+    def release(self, username):
+        " Forgets a session of the user "
+        self.counts[username] -= 1
+        # To avoid a slow memory leak
+        if self.counts[username] <= 0:
+            del self.counts[username]
+
+
+class SessionCountServerProtocol(LineReceiver):
+    """ Serves a SessionCounter to a RemoteSessionCounter. Sessions count as
+        long as the connection they were acquired on is open, so the sessions
+        of a crashed worker are released with its connection.
+
+        Requests are "ACQUIRE <username>", which is answered with the number
+        of sessions of the user, and "RELEASE <username>".
+    """
+    delimiter = '\n'
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.held = defaultdict(int)
+
+    def lineReceived(self, line):
+        command, _, username = line.partition(' ')
+        if command == 'ACQUIRE':
+            self.held[username] += 1
+            d = self.counter.acquire(username)
+            d.addCallback(lambda count: self.sendLine(str(count)))
+        elif command == 'RELEASE' and self.held.get(username):
+            self.held[username] -= 1
+            self.counter.release(username)
+        else:
+            log.msg('Invalid session count request: %r' % line)
+
+    def connectionLost(self, reason):
+        for username, count in self.held.items():
+            for _ in xrange(count):
+                self.counter.release(username)
+        self.held.clear()
+
+
+class SessionCountServerFactory(Factory):
+    " Serves one SessionCounter to any number of RemoteSessionCounters "
+    noisy = False
+
+    def __init__(self, counter=None):
+        self.counter = counter or LocalSessionCounter()
+
+    def buildProtocol(self, addr):
+        return SessionCountServerProtocol(self.counter)
+
+
+class RemoteSessionCounter(LineReceiver):
+    """ Counts sessions with a SessionCountServerProtocol on the other end of
+        the connection. Requests fail with ConnectionLost if the connection is
+        gone.
+    """
+    delimiter = '\n'
+    factory = None
+
+    def __init__(self):
+        self.pending = []
+        self.connected = False
+        self.lost = defer.Deferred()  # fires when the connection is lost
+
+    def acquire(self, username):
+        if not self.connected:
+            return defer.fail(
+                ConnectionLost('The session counter is not connected'))
+        d = defer.Deferred()
+        self.pending.append(d)
+        self.sendLine('ACQUIRE %s' % username)
+        return d
+
+    def release(self, username):
+        if self.connected:
+            self.sendLine('RELEASE %s' % username)
+
+    def connectionMade(self):
+        self.connected = True
+        if self.factory is not None:
+            self.factory.counterConnected(self)
+
+    def lineReceived(self, line):
+        if self.pending:
+            self.pending.pop(0).callback(int(line))
+
+    def connectionLost(self, reason):
+        self.connected = False
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.errback(reason)
+        self.lost.callback(None)
+
+
+class SharedSessionCounter(object):
+    """ Counts sessions in a memory mapped file that all processes on the host
+        that use the same path share. Each session takes a slot which holds
+        the pid of its process and a hash of the username. Slots of processes
+        that no longer exist are freed when the user is counted again.
+
+    :param str path: location of the file
+    :param int slots: number of sessions the file has room for
+
+    """
+    slot = struct.Struct('<i20s')  # pid, sha1 of the username
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.size = slots * self.slot.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock()
+        try:
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+        finally:
+            self._unlock()
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def _lock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _find(self, data, start=0):
+        " Returns the offset of the next slot that starts with data or -1 "
+        while True:
+            offset = self.map.find(data, start)
+            if offset == -1 or offset % self.slot.size == 0:
+                return offset
+            start = offset + 1
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def acquire(self, username):
+        name = hashlib.sha1(username).digest()
+        pid = os.getpid()
+        self._lock()
+        try:
+            count = 0
+            offset = 0
+            while True:
+                offset = self.map.find(name, offset)
+                if offset == -1:
+                    break
+                start = offset - 4
+                if start % self.slot.size == 0:
+                    other, _ = self.slot.unpack_from(self.map, start)
+                    if other == pid or self._alive(other):
+                        count += 1
+                    else:
+                        self.map[start:start + self.slot.size] = \
+                            '\0' * self.slot.size
+                offset += 1
+            free = self._find('\0' * self.slot.size)
+            if free == -1:
+                return defer.fail(SessionCounterFull(self.path))
+            self.map[free:free + self.slot.size] = self.slot.pack(pid, name)
+            return defer.succeed(count + 1)
+        finally:
+            self._unlock()
+
+    def release(self, username):
+        entry = self.slot.pack(os.getpid(), hashlib.sha1(username).digest())
+        self._lock()
+        try:
+            offset = self._find(entry)
+            if offset != -1:
+                self.map[offset:offset + self.slot.size] = \
+                    '\0' * self.slot.size
+        finally:
+            self._unlock()
+
+
+class TCPSessionCounter(ReconnectingClientFactory):
+    """ Counts sessions with a counter service (SessionCountServerFactory)
+        that all hosts share. Sessions count for as long as the connection to
+        the service is open. They are counted again after reconnecting.
+        Sessions can't be counted while the service is unreachable.
+
+        Connect it with twisted.application.internet.TCPClient.
+    """
+    noisy = False
+    maxDelay = 30
+
+    def __init__(self):
+        self.counter = None
+        self.held = defaultdict(int)
+
+    def acquire(self, username):
+        if self.counter is None:
+            return defer.fail(
+                ConnectionLost('The session counter is not connected'))
+        d = self.counter.acquire(username)
+        d.addCallback(self._acquired, username)
+        return d
+
+    def _acquired(self, count, username):
+        # Only sessions the service counted are counted again on reconnect
+        self.held[username] += 1
+        return count
+
+    def release(self, username):
+        if self.held.get(username):
+            self.held[username] -= 1
+            if self.held[username] == 0:
+                del self.held[username]
+            if self.counter is not None:
+                self.counter.release(username)
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        counter = RemoteSessionCounter()
+        counter.factory = self
+        counter.lost.addCallback(self._lost, counter)
+        return counter
+
+    def counterConnected(self, counter):
+        self.counter = counter
+        for username, count in self.held.items():
+            for _ in xrange(count):
+                counter.acquire(username).addErrback(lambda _: None)
+
+    def _lost(self, ignored, counter):
+        if self.counter is counter:
+            self.counter = None
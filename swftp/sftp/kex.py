@@ -0,0 +1,69 @@
+"""
+Server side of the SSH Diffie-Hellman key exchange, computed with OpenSSL.
+Unlike Python's pow(), OpenSSL lets go of the GIL, so these functions can run
+in a thread without holding up the reactor.
+
+This needs the cryptography package and a Twisted that has
+twisted.conch.ssh._kex. Importing it fails with ImportError otherwise and the
+SFTP server leaves key exchanges to conch.
+
+See COPYING for license information.
+"""
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import dh
+from twisted.conch.ssh import _kex
+from twisted.conch.ssh.common import NS, MP
+
+
+def dh_group(kex_alg):
+    " Returns (g, p) of the fixed group of a key exchange algorithm "
+    return _kex.getDHGeneratorAndPrime(kex_alg)
+
+
+def dh_exchange(g, p, client_public):
+    """ Returns (server_public, shared_secret) as integers
+
+    :param int g: generator of the group
+    :param int p: prime of the group
+    :param int client_public: the client's public value (e)
+
+    """
+    backend = default_backend()
+    numbers = dh.DHParameterNumbers(p, g)
+    private = numbers.parameters(backend).generate_private_key()
+    peer = dh.DHPublicNumbers(client_public, numbers).public_key(backend)
+    shared = private.exchange(peer)
+    return (private.public_key().public_numbers().y,
+            int(shared.encode('hex'), 16))
+
+
+def kex_reply(transport, client_public, group_request=''):
+    """ Does the expensive part of answering KEXDH_INIT or KEX_DH_GEX_INIT:
+        the exchange, the exchange hash and its signature.
+
+    :param transport: SSHServerTransport that negotiated the key exchange
+    :param int client_public: the client's public value (e)
+    :param str group_request: the KEX_DH_GEX_REQUEST(_OLD) followed by p and
+        g for group exchanges, empty for fixed groups
+    :returns: (reply payload, MP encoded shared secret, exchange hash)
+
+    """
+    server_public, shared = dh_exchange(
+        transport.g, transport.p, client_public)
+    server_public, shared = MP(server_public), MP(shared)
+    host_key = transport.factory.publicKeys[transport.keyAlg].blob()
+
+    h = _kex.getHashProcessor(transport.kexAlg)()
+    h.update(NS(transport.otherVersionString))
+    h.update(NS(transport.ourVersionString))
+    h.update(NS(transport.otherKexInitPayload))
+    h.update(NS(transport.ourKexInitPayload))
+    h.update(NS(host_key))
+    h.update(group_request)
+    h.update(MP(client_public))
+    h.update(server_public)
+    h.update(shared)
+    exchange_hash = h.digest()
+    signature = transport.factory.privateKeys[transport.keyAlg].sign(
+        exchange_hash)
+    return NS(host_key) + server_public + NS(signature), shared, exchange_hash
@@ -4,26 +4,37 @@ This file contains the primary server code for the SFTP server.
 See COPYING for license information.
 """
 from zope import interface
-from collections import defaultdict
+import struct
 
 from twisted.conch.interfaces import ISFTPServer, ISession
 from twisted.python import components, log
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.conch import avatar
 from twisted.conch.ssh import session
 from twisted.conch.ssh.filetransfer import (
-    FileTransferServer, SFTPError, FX_FAILURE, FX_NO_SUCH_FILE)
-from twisted.conch.ssh.common import getNS
+    FileTransferServer, SFTPError, FX_FAILURE, FX_NO_SUCH_FILE,
+    FX_OP_UNSUPPORTED, FX_FILE_ALREADY_EXISTS, FX_PERMISSION_DENIED,
+    FXF_READ, FXF_WRITE)
+from twisted.conch.ssh.common import NS, getNS, getMP, MP
 from twisted.conch.ssh.transport import (
-    SSHServerTransport, DISCONNECT_TOO_MANY_CONNECTIONS)
+    SSHServerTransport, DISCONNECT_TOO_MANY_CONNECTIONS,
+    DISCONNECT_KEY_EXCHANGE_FAILED, MSG_KEXDH_REPLY, MSG_KEX_DH_GEX_REPLY)
 from twisted.conch.ssh.userauth import SSHUserAuthServer
 
+from swftp.auth import LoginRejected
 from swftp.swift import NotFound, Conflict
 from swftp.logging import msg
+from swftp.sessions import LocalSessionCounter
 from swftp.sftp.swiftfile import SwiftFile
 from swftp.sftp.swiftdirectory import SwiftDirectory
 from swftp.swiftfilesystem import SwiftFileSystem, swift_stat, obj_to_path
 
+try:
+    from swftp.sftp.kex import dh_group, kex_reply
+except ImportError:
+    # No cryptography or an older Twisted, conch does the key exchanges
+    dh_group = kex_reply = None
+
 
 class SwiftSession(object):
     """ Barebones Session that closes when a client tries to open a shell.
@@ -62,6 +73,34 @@ class SwiftFileTransferServer(FileTransferServer):
         fileObj.session = self.transport.session
         FileTransferServer._cbOpenFile(self, fileObj, requestId)
 
+    # Overridden to handle copy-data, which refers to open file handles
+    def packet_EXTENDED(self, data):
+        requestId = data[:4]
+        extName, extData = getNS(data[4:])
+        if extName != 'copy-data':
+            return FileTransferServer.packet_EXTENDED(self, data)
+        d = defer.maybeDeferred(self._copyData, extData)
+        d.addCallback(self._cbStatus, requestId)
+        d.addErrback(self._ebStatus, requestId, 'copy-data failed')
+
+    def _copyData(self, data):
+        readHandle, data = getNS(data)
+        readOffset, length = struct.unpack('!QQ', data[:16])
+        writeHandle, data = getNS(data[16:])
+        writeOffset, = struct.unpack('!Q', data[:8])
+        if readHandle not in self.openFiles or \
+                writeHandle not in self.openFiles:
+            raise SFTPError(FX_FAILURE, 'Invalid handle')
+        return self.client.copyData(
+            self.openFiles[readHandle], readOffset, length,
+            self.openFiles[writeHandle], writeOffset)
+
+    # Extended requests that only report success reply with a status
+    def _cbExtended(self, data, requestId):
+        if data is None:
+            return self._cbStatus(data, requestId)
+        return FileTransferServer._cbExtended(self, data, requestId)
+
     # This is overridden because Flow was sending data that looks to be invalid
     def packet_REALPATH(self, data):
         requestId = data[:4]
@@ -79,7 +118,13 @@ class SwiftSSHServerTransport(SSHServerTransport, object):
     ourVersionString = 'SSH-2.0-SwFTP'
     maxConnectionsPerUser = 10
 
-    _connCountMap = defaultdict(int)
+    # Whether key exchanges are computed in the reactor's thread pool
+    offloadKeyExchange = True
+
+    sessionCounter = LocalSessionCounter()
+    _sessionUser = None  # set while the session is counted
+    _lost = False
+    _kexPending = None  # set while a key exchange is computed
 
     def sendDisconnect(self, *args, **kwargs):
         return super(SwiftSSHServerTransport, self).sendDisconnect(
@@ -94,45 +139,105 @@ class SwiftSSHServerTransport(SSHServerTransport, object):
 
     def connectionLost(self, reason):
         log.msg(metric='num_clients', count=-1)
-        if getattr(self, 'avatar', None):
-            username = self.avatar.username()
-            msg("User Disconnected (%s) [%s/%s]" % (
-                username,
-                self._connCountMap[username],
-                self.maxConnectionsPerUser,
-                ))
-            self._connCountMap[username] -= 1
-            # To avoid a slow memory leak
-            if self._connCountMap[username] == 0:
-                del self._connCountMap[username]
+        self._lost = True
+        if self._sessionUser:
+            msg("User Disconnected (%s)" % self._sessionUser)
+            self.sessionCounter.release(self._sessionUser)
+            self._sessionUser = None
 
         if self.service:
             self.service.serviceStopped()
         if hasattr(self, 'avatar'):
             self.logoutFunction()
 
+    def getPacket(self):
+        # Packets wait in the buffer while a key exchange is computed
+        if self._kexPending is not None:
+            return None
+        return super(SwiftSSHServerTransport, self).getPacket()
+
+    def _ssh_KEXDH_INIT(self, packet):
+        if kex_reply is None:
+            return super(SwiftSSHServerTransport, self)._ssh_KEXDH_INIT(
+                packet)
+        clientDHpublicKey, _ = getMP(packet)
+        self.g, self.p = dh_group(self.kexAlg)
+        self._replyKEXDH(MSG_KEXDH_REPLY, clientDHpublicKey, '')
+
+    def ssh_KEX_DH_GEX_INIT(self, packet):
+        if kex_reply is None:
+            return super(SwiftSSHServerTransport, self).ssh_KEX_DH_GEX_INIT(
+                packet)
+        clientDHpublicKey, _ = getMP(packet)
+        self._replyKEXDH(
+            MSG_KEX_DH_GEX_REPLY, clientDHpublicKey,
+            self.dhGexRequest + MP(self.p) + MP(self.g))
+
+    def _replyKEXDH(self, messageType, clientDHpublicKey, groupRequest):
+        if not self.offloadKeyExchange:
+            self._sendKEXDH(
+                kex_reply(self, clientDHpublicKey, groupRequest),
+                messageType)
+            return
+        self._kexPending = threads.deferToThread(
+            kex_reply, self, clientDHpublicKey, groupRequest)
+        self._kexPending.addCallbacks(
+            self._cbKEXDH, self._ebKEXDH, callbackArgs=(messageType,))
+
+    def _cbKEXDH(self, reply, messageType):
+        self._kexPending = None
+        if self._lost:
+            return
+        self._sendKEXDH(reply, messageType)
+        # Handle the packets that arrived in the meantime
+        self.dataReceived('')
+
+    def _ebKEXDH(self, failure):
+        self._kexPending = None
+        log.err(failure, "Key exchange failed")
+        if not self._lost:
+            self.sendDisconnect(
+                DISCONNECT_KEY_EXCHANGE_FAILED, 'key exchange failed')
+
+    def _sendKEXDH(self, reply, messageType):
+        payload, sharedSecret, exchangeHash = reply
+        self.sendPacket(messageType, payload)
+        self._keySetup(sharedSecret, exchangeHash)
+
     def on_auth(self, res):
         if not getattr(self, 'avatar', None):
             return res
         username = self.avatar.username()
-        self._connCountMap[username] += 1
+        d = self.sessionCounter.acquire(username)
+        d.addCallbacks(self._cbCounted, self._ebCounted,
+                       callbackArgs=(username,), errbackArgs=(username,))
+        d.addCallback(lambda _: res)
+        return d
+
+    def _cbCounted(self, count, username):
+        if self._lost:
+            self.sessionCounter.release(username)
+            return
+        self._sessionUser = username
         msg("User Connected (%s) [%s/%s]" % (
             username,
-            self._connCountMap[username],
+            count,
             self.maxConnectionsPerUser,
             ))
         if self.maxConnectionsPerUser != 0 and \
-                self._connCountMap[username] > self.maxConnectionsPerUser:
+                count > self.maxConnectionsPerUser:
             msg("Too Many Connections For User (%s) [%s/%s]" % (
                 username,
-                self._connCountMap[username],
+                count,
                 self.maxConnectionsPerUser,
                 ))
             self.sendDisconnect(
                 DISCONNECT_TOO_MANY_CONNECTIONS,
                 'too many connections')
             self.loseConnection()
-        return res
+
+    def _ebCounted(self, failure, username):
+        log.err(failure, "Could not count the session of %s" % username)
 
 
 class SwiftSSHUserAuthServer(SSHUserAuthServer, object):
@@ -144,6 +249,14 @@ class SwiftSSHUserAuthServer(SSHUserAuthServer, object):
         d.addCallback(self.transport.on_auth)
         return d
 
+    def _ebBadAuth(self, reason):
+        if reason.check(LoginRejected):
+            msg("Login Rejected: %s" % reason.getErrorMessage())
+            self.transport.sendDisconnect(
+                DISCONNECT_TOO_MANY_CONNECTIONS, reason.getErrorMessage())
+            return
+        return super(SwiftSSHUserAuthServer, self)._ebBadAuth(reason)
+
 
 class SwiftSFTPUser(avatar.ConchUser):
     """ Swift SFTP User. Provides t.c.i.IConchUser
@@ -191,6 +304,18 @@ class SFTPServerForSwiftConchUser(object):
     """
     interface.implements(ISFTPServer)
 
+    # Maps the supported extended requests to the methods handling them
+    extensions = {
+        'check-file-name': 'checkFileName',
+        'md5-hash': 'md5Hash',
+        'copy-file': 'copyFile',
+        'statvfs@openssh.com': 'statVFS',
+    }
+
+    # Reported as the total size by statvfs when the account has no quota
+    statvfs_default_size = 1 << 50
+    statvfs_block_size = 4096
+
     def __init__(self, avatar):
         self.swiftconn = avatar.swiftconn
         self.swiftfilesystem = SwiftFileSystem(self.swiftconn)
@@ -210,7 +335,13 @@ class SFTPServerForSwiftConchUser(object):
     def gotVersion(self, otherVersion, extData):
         """ Client sent their version info """
         self.log_command('gotVersion', otherVersion, extData)
-        return {}
+        return {
+            'check-file': 'md5',
+            'md5-hash': '1',
+            'copy-file': '1',
+            'copy-data': '1',
+            'statvfs@openssh.com': '2',
+        }
 
     def openFile(self, fullpath, flags, attrs):
         """ Open File/Object. Checks for Object Existence
@@ -384,8 +515,190 @@ class SFTPServerForSwiftConchUser(object):
         return real_path
 
     def extendedRequest(self, extName, extData):
-        """ No-op """
-        raise NotImplementedError
+        """ Dispatches an extended request to the method named in
+            `extensions`
+
+        :param str extName: name of the extension
+        :param str extData: extension specific request data
+
+        """
+        self.log_command('extendedRequest', extName)
+        handler = self.extensions.get(extName)
+        if handler is None:
+            raise NotImplementedError
+        return getattr(self, handler)(extData)
+
+    def getObjectHash(self, fullpath):
+        """ Returns a deferred that fires with the MD5 digest (raw bytes) that
+            swift stored for an object. No data is downloaded.
+
+        :param str fullpath: path to an object
+
+        """
+        def cb(result):
+            md5 = result['hash']
+            if not md5 or len(md5) != 32:
+                raise SFTPError(
+                    FX_OP_UNSUPPORTED, 'No MD5 is stored for this object')
+            return md5.decode('hex')
+
+        def errback(failure):
+            failure.trap(NotFound, NotImplementedError)
+            raise SFTPError(FX_NO_SUCH_FILE, 'Not Found')
+
+        d = defer.maybeDeferred(
+            self.swiftfilesystem.checkFileExistance, fullpath)
+        d.addCallback(cb)
+        d.addErrback(errback)
+        return d
+
+    def checkFileName(self, data):
+        """ check-file-name extension (draft-ietf-secsh-filexfer-extensions).
+            Only md5 over the whole file is supported.
+
+        :param str data: extension specific request data
+
+        """
+        fullpath, data = getNS(data)
+        algorithms, data = getNS(data)
+        start, length, block_size = struct.unpack('!QQL', data[:20])
+        if 'md5' not in algorithms.split(',') or start or length or \
+                block_size:
+            raise SFTPError(FX_OP_UNSUPPORTED, 'Only md5 of whole files')
+
+        d = self.getObjectHash(fullpath)
+        d.addCallback(lambda md5: NS('check-file') + NS('md5') + md5)
+        return d
+
+    def md5Hash(self, data):
+        """ md5-hash extension (draft-ietf-secsh-filexfer-09). The quick check
+            hash is not verified since answering costs no data transfer.
+
+        :param str data: extension specific request data
+
+        """
+        fullpath, data = getNS(data)
+        start, length = struct.unpack('!QQ', data[:16])
+        if start or length:
+            raise SFTPError(FX_OP_UNSUPPORTED, 'Only md5 of whole files')
+
+        d = self.getObjectHash(fullpath)
+        d.addCallback(lambda md5: NS('md5-hash') + NS(md5))
+        return d
+
+    def copyFile(self, data):
+        """ copy-file extension (draft-ietf-secsh-filexfer-extensions). The
+            copy is made inside of the swift cluster.
+
+        :param str data: extension specific request data
+
+        """
+        srcpath, data = getNS(data)
+        dstpath, data = getNS(data)
+        overwrite = data[:1] not in ('', '\x00')
+
+        def check_destination(ignored):
+            d = self.swiftfilesystem.checkFileExistance(dstpath)
+
+            def cb(result):
+                raise SFTPError(FX_FILE_ALREADY_EXISTS, 'File Exists')
+
+            def errback(failure):
+                failure.trap(NotFound)
+            d.addCallbacks(cb, errback)
+            return d
+
+        def copy(ignored):
+            return self.swiftfilesystem.copyFile(srcpath, dstpath)
+
+        def errback(failure):
+            failure.trap(NotFound, NotImplementedError)
+            if failure.check(NotFound):
+                raise SFTPError(FX_NO_SUCH_FILE, 'No Such File')
+            raise SFTPError(FX_OP_UNSUPPORTED, 'Only objects can be copied')
+
+        d = defer.succeed(None)
+        if not overwrite:
+            d.addCallback(check_destination)
+        d.addCallback(copy)
+        d.addCallback(lambda r: None)
+        d.addErrback(errback)
+        return d
+
+    def copyData(self, readFile, readOffset, length, writeFile, writeOffset):
+        """ copy-data extension (draft-ietf-secsh-filexfer-extensions). Only
+            whole objects can be copied, from a file opened for reading into
+            one opened for writing that hasn't been written to yet. The copy
+            is made inside of the swift cluster.
+
+        :param readFile: SwiftFile to copy from
+        :param int readOffset: offset to start reading at
+        :param int length: number of bytes to copy, 0 copies up to the end
+        :param writeFile: SwiftFile to copy to
+        :param int writeOffset: offset to start writing at
+
+        """
+        self.log_command(
+            'copyData', readFile.fullpath, writeFile.fullpath)
+        if not (readFile.flags or 0) & FXF_READ or \
+                not (writeFile.flags or 0) & FXF_WRITE:
+            raise SFTPError(FX_PERMISSION_DENIED, 'Permission Denied')
+        # A length is only known to cover the object if its size is known
+        if length and readFile.props is None:
+            raise SFTPError(
+                FX_OP_UNSUPPORTED, 'Only whole objects can be copied')
+        if readOffset or writeOffset or writeFile.w or \
+                0 < length < int(readFile.props['size']):
+            raise SFTPError(
+                FX_OP_UNSUPPORTED, 'Only whole objects can be copied')
+
+        def errback(failure):
+            failure.trap(NotFound, NotImplementedError)
+            if failure.check(NotFound):
+                raise SFTPError(FX_NO_SUCH_FILE, 'No Such File')
+            raise SFTPError(FX_OP_UNSUPPORTED, 'Only objects can be copied')
+
+        d = defer.maybeDeferred(
+            self.swiftfilesystem.copyFile, readFile.fullpath,
+            writeFile.fullpath)
+        d.addCallback(lambda r: None)
+        d.addErrback(errback)
+        return d
+
+    def statVFS(self, data):
+        """ statvfs@openssh.com extension. Sizes come from the account stats
+            (the quota, if one is set in X-Account-Meta-Quota-Bytes)
+
+        :param str data: extension specific request data
+
+        """
+        bsize = self.statvfs_block_size
+        # Swift has no limit on the number of objects
+        ffree = 1 << 32
+
+        def cb(stats):
+            used = int(stats['size'])
+            total = max(int(stats['quota'] or self.statvfs_default_size),
+                        used)
+            free = (total - used) // bsize
+            files = int(stats['objects']) + ffree
+            return struct.pack(
+                '!11Q',
+                bsize,                  # f_bsize
+                bsize,                  # f_frsize
+                total // bsize,         # f_blocks
+                free,                   # f_bfree
+                free,                   # f_bavail
+                files,                  # f_files
+                ffree,                  # f_ffree
+                ffree,                  # f_favail
+                0,                      # f_fsid
+                0,                      # f_flag
+                1024)                   # f_namemax
+
+        d = self.swiftfilesystem.getAccountStats()
+        d.addCallback(cb)
+        return d
 
 components.registerAdapter(
     SFTPServerForSwiftConchUser, SwiftSFTPUser, ISFTPServer)
@@ -4,7 +4,7 @@ This file defines what is required for swftp-sftp to work with twistd.
 See COPYING for license information.
 """
 from swftp import VERSION
-from swftp.logging import StdOutObserver
+from swftp.logging import StdOutObserver, WorkerLogObserver
 
 from twisted.application import internet, service
 from twisted.python import usage, log
@@ -20,6 +20,7 @@ import time
 CONFIG_DEFAULTS = {
     'auth_url': 'http://127.0.0.1:8080/auth/v1.0',
     'swift_proxy': '',
+    'http_backend': 'swftp.swift.twisted_agent',
     'host': '0.0.0.0',
     'port': '5022',
 
@@ -28,11 +29,22 @@ CONFIG_DEFAULTS = {
 
     'priv_key': '/etc/swftp/id_rsa',
     'pub_key': '/etc/swftp/id_rsa.pub',
+    'host_keys': '',
+    'ciphers': 'aes128-ctr,aes192-ctr,aes256-ctr',
+    'macs': 'hmac-sha2-512,hmac-sha2-256,hmac-sha1',
+    'kex_algorithms': 'diffie-hellman-group-exchange-sha256,'
+                      'diffie-hellman-group14-sha1',
+    'moduli_file': '/etc/ssh/moduli',
     'num_persistent_connections': '100',
     'num_connections_per_session': '10',
+    'num_metadata_connections_per_session': '2',
+    'auth_max_in_flight': '50',
+    'auth_max_queued': '500',
+    'auth_queue_timeout': '30',
     'connection_timeout': '240',
     'sessions_per_user': '10',
     'extra_headers': '',
+    'user_weights': '',
     'verbose': 'false',
 
     'log_statsd_host': '',
@@ -42,6 +54,34 @@ CONFIG_DEFAULTS = {
 
     'stats_host': '',
     'stats_port': '38022',
+
+    'workers': '1',
+    'session_counter': 'local',
+    'session_counter_file': '/tmp/swftp-sftp-sessions',
+    'session_counter_slots': '65536',
+    'session_counter_host': '127.0.0.1',
+    'session_counter_port': '38122',
+    'session_counter_serve': 'no',
+
+    'spool_dir': '',
+    'spool_max_size': '10737418240',
+    'spool_max_flushes': '10',
+    'spool_segment_size': '104857600',
+
+    'object_cache_size': '0',
+    'object_cache_max_object_size': '1048576',
+    'object_cache_dir': '',
+    'object_cache_disk_size': '1073741824',
+
+    'ingress_rate_limit': '0',
+    'egress_rate_limit': '0',
+    'user_ingress_rate_limit': '0',
+    'user_egress_rate_limit': '0',
+    'user_rate_limits': '',
+
+    'readahead_limit': '268435456',
+    'buffer_limit': '1073741824',
+    'kex_threads': '10',
 }
 
 
@@ -54,8 +94,11 @@ def run():
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
-    # Start Logging
-    obs = StdOutObserver()
+    # Start Logging. Workers send their log to the supervisor.
+    if options['log_fd']:
+        obs = WorkerLogObserver(int(options['log_fd']))
+    else:
+        obs = StdOutObserver()
     obs.start()
 
     s = makeService(options)
@@ -82,6 +125,24 @@ def get_config(config_path, overrides):
     return c
 
 
+def parse_algorithms(value, supported, kind):
+    """ Returns the algorithms of a comma separated config value that are
+        supported, in the configured order
+    """
+    algorithms = []
+    for name in value.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name in supported:
+            algorithms.append(name)
+        else:
+            log.msg('Ignoring unsupported %s: %s' % (kind, name))
+    if not algorithms:
+        raise ValueError('None of the configured %s are supported' % kind)
+    return algorithms
+
+
 class Options(usage.Options):
     "Defines Command-line options for the swftp-sftp service"
     optFlags = [
@@ -96,6 +157,11 @@ class Options(usage.Options):
         ["host", "h", None, "IP to bind to."],
         ["priv_key", "priv-key", None, "Private Key Location."],
         ["pub_key", "pub-key", None, "Public Key Location."],
+        ["listen_fd", None, None, "(internal) Listening socket of a worker."],
+        ["session_fds", None, None,
+            "(internal) Session count pipes of a worker."],
+        ["log_fd", None, None, "(internal) Log pipe of a worker."],
+        ["worker", None, None, "(internal) Index of a worker."],
     ]
 
 
@@ -107,14 +173,21 @@ def makeService(options):
     from twisted.conch.ssh.connection import SSHConnection
     from twisted.conch.ssh.factory import SSHFactory
     from twisted.conch.ssh.keys import Key
+    from twisted.conch.ssh.transport import SSHCiphers, SSHTransportBase
+    from twisted.conch.openssh_compat.primes import parseModuliFile
     from twisted.cred.portal import Portal
 
     from swftp.realm import SwftpRealm
     from swftp.sftp.server import (
         SwiftSSHServerTransport, SwiftSSHUserAuthServer)
-    from swftp.auth import SwiftBasedAuthDB
+    from swftp.auth import SwiftBasedAuthDB, AdmissionControlledChecker
+    from swftp.swiftfilesystem import SwiftFileSystem
+    from swftp.sftp.swiftfile import (
+        SwiftFile, SwiftFileReceiver, ReadAheadBudget, transfer_buffers)
+    from swftp.ratelimit import RateLimiter
     from swftp.utils import (
-        log_runtime_info, GLOBAL_METRICS, parse_key_value_config)
+        log_runtime_info, GLOBAL_METRICS, parse_key_value_config,
+        OrderedDict)
 
     c = get_config(options['config_file'], options)
 
@@ -126,6 +199,46 @@ def makeService(options):
 
     print('Starting SwFTP-sftp %s' % VERSION)
 
+    # Run as the supervisor of worker processes, which serve the connections
+    supervisor = c.getint('sftp', 'workers') > 1 and not options['listen_fd']
+
+    # Per-user session counts are kept in this process unless they are
+    # shared with other processes
+    session_counter = None
+    if c.get('sftp', 'session_counter') == 'shared':
+        from swftp.sessions import SharedSessionCounter
+        session_counter = SharedSessionCounter(
+            c.get('sftp', 'session_counter_file'),
+            slots=c.getint('sftp', 'session_counter_slots'))
+    elif c.get('sftp', 'session_counter') == 'tcp':
+        if c.getboolean('sftp', 'session_counter_serve') and \
+                not options['listen_fd']:
+            from swftp.sessions import (
+                LocalSessionCounter, SessionCountServerFactory)
+            session_counter = LocalSessionCounter()
+            internet.TCPServer(
+                c.getint('sftp', 'session_counter_port'),
+                SessionCountServerFactory(session_counter),
+                interface=c.get('sftp', 'session_counter_host'),
+            ).setServiceParent(sftp_service)
+        elif not supervisor:
+            from swftp.sessions import TCPSessionCounter
+            session_counter = TCPSessionCounter()
+            internet.TCPClient(
+                c.get('sftp', 'session_counter_host'),
+                c.getint('sftp', 'session_counter_port'),
+                session_counter).setServiceParent(sftp_service)
+
+    if supervisor:
+        from swftp.workers import WorkerSupervisor, listen
+        WorkerSupervisor(
+            'swftp.sftp.service', options,
+            listen(c.getint('sftp', 'port'), c.get('sftp', 'host')),
+            c.getint('sftp', 'workers'),
+            session_counter=session_counter,
+        ).setServiceParent(sftp_service)
+        return sftp_service
+
     # Add statsd service
     if c.get('sftp', 'log_statsd_host'):
         try:
@@ -139,6 +252,39 @@ def makeService(options):
         except ImportError:
             sys.stderr.write('Missing Statsd Module. Requires "txstatsd" \n')
 
+    from twisted.python.reflect import namedAny
+    from swftp.swift import SwiftConnection
+    SwiftConnection.http_backend = staticmethod(
+        namedAny(c.get('sftp', 'http_backend')))
+
+    authdb = SwiftBasedAuthDB(
+        c.get('sftp', 'auth_url'),
+        global_max_concurrency=c.getint('sftp', 'num_persistent_connections'),
+        max_concurrency=c.getint('sftp', 'num_connections_per_session'),
+        max_metadata_concurrency=c.getint(
+            'sftp', 'num_metadata_connections_per_session'),
+        timeout=c.getint('sftp', 'connection_timeout'),
+        proxy=c.get('sftp', 'swift_proxy'),
+        extra_headers=parse_key_value_config(c.get('sftp', 'extra_headers')),
+        verbose=c.getboolean('sftp', 'verbose'),
+        rewrite_scheme=c.get('sftp', 'rewrite_storage_scheme'),
+        rewrite_netloc=c.get('sftp', 'rewrite_storage_netloc'),
+        user_weights=dict(
+            (user, float(weight)) for user, weight in
+            parse_key_value_config(c.get('sftp', 'user_weights')).items()),
+    )
+    checker = authdb
+    gauges = {}
+    if authdb.scheduler:
+        gauges['swift.queue_depth'] = lambda: authdb.scheduler.waiting
+    if c.getint('sftp', 'auth_max_in_flight'):
+        checker = AdmissionControlledChecker(
+            authdb,
+            max_in_flight=c.getint('sftp', 'auth_max_in_flight'),
+            max_queued=c.getint('sftp', 'auth_max_queued'),
+            queue_timeout=c.getfloat('sftp', 'auth_queue_timeout'))
+        gauges['auth.queue_depth'] = lambda: len(checker.queue)
+
     if c.get('sftp', 'stats_host'):
         from swftp.report import makeService as makeReportService
         known_fields = [
@@ -152,51 +298,123 @@ def makeService(options):
             'command.removeDirectory',
             'command.openDirectory',
             'command.getAttrs',
+            'command.extendedRequest',
+            'command.copyData',
         ] + GLOBAL_METRICS
+        gauges['buffers.bytes'] = lambda: transfer_buffers.used
         makeReportService(
             c.get('sftp', 'stats_host'),
-            c.getint('sftp', 'stats_port'),
-            known_fields=known_fields
+            c.getint('sftp', 'stats_port') + int(options['worker'] or 0),
+            known_fields=known_fields,
+            gauges=gauges,
         ).setServiceParent(sftp_service)
 
-    authdb = SwiftBasedAuthDB(
-        c.get('sftp', 'auth_url'),
-        global_max_concurrency=c.getint('sftp', 'num_persistent_connections'),
-        max_concurrency=c.getint('sftp', 'num_connections_per_session'),
-        timeout=c.getint('sftp', 'connection_timeout'),
-        proxy=c.get('sftp', 'swift_proxy'),
-        extra_headers=parse_key_value_config(c.get('sftp', 'extra_headers')),
-        verbose=c.getboolean('sftp', 'verbose'),
-        rewrite_scheme=c.get('sftp', 'rewrite_storage_scheme'),
-        rewrite_netloc=c.get('sftp', 'rewrite_storage_netloc'),
-    )
+    # Workers split the disk space of the spool and the object cache and
+    # each use their own directory
+    from swftp.workers import worker_share
+    if c.get('sftp', 'spool_dir'):
+        from swftp.spool import UploadSpool
+        spool_dir, spool_size = worker_share(
+            c.get('sftp', 'spool_dir'), c.getint('sftp', 'spool_max_size'),
+            options['worker'], c.getint('sftp', 'workers'))
+        SwiftFileSystem.spool = UploadSpool(
+            spool_dir, spool_size,
+            max_flushes=c.getint('sftp', 'spool_max_flushes'),
+            segment_size=c.getint('sftp', 'spool_segment_size'))
+    if c.getint('sftp', 'object_cache_size'):
+        from swftp.objectcache import ObjectCache
+        cache_dir, cache_size = None, 0
+        if c.get('sftp', 'object_cache_dir'):
+            cache_dir, cache_size = worker_share(
+                c.get('sftp', 'object_cache_dir'),
+                c.getint('sftp', 'object_cache_disk_size'),
+                options['worker'], c.getint('sftp', 'workers'))
+        SwiftFileSystem.object_cache = ObjectCache(
+            c.getint('sftp', 'object_cache_size'),
+            max_object_size=c.getint('sftp', 'object_cache_max_object_size'),
+            directory=cache_dir, disk_size=cache_size)
+    SwiftFileReceiver.readahead = ReadAheadBudget(
+        c.getint('sftp', 'readahead_limit'))
+    transfer_buffers.limit = c.getint('sftp', 'buffer_limit')
+    user_rates = dict(
+        (user, int(rate)) for user, rate in
+        parse_key_value_config(c.get('sftp', 'user_rate_limits')).items())
+    if c.getint('sftp', 'ingress_rate_limit') or \
+            c.getint('sftp', 'user_ingress_rate_limit') or user_rates:
+        SwiftFile.ingress_limiter = RateLimiter(
+            c.getint('sftp', 'ingress_rate_limit'),
+            user_rate=c.getint('sftp', 'user_ingress_rate_limit'),
+            user_rates=user_rates)
+    if c.getint('sftp', 'egress_rate_limit') or \
+            c.getint('sftp', 'user_egress_rate_limit') or user_rates:
+        SwiftFile.egress_limiter = RateLimiter(
+            c.getint('sftp', 'egress_rate_limit'),
+            user_rate=c.getint('sftp', 'user_egress_rate_limit'),
+            user_rates=user_rates)
 
     realm = SwftpRealm()
     sftpportal = Portal(realm)
-    sftpportal.registerChecker(authdb)
+    sftpportal.registerChecker(checker)
 
     sshfactory = SSHFactory()
     protocol = SwiftSSHServerTransport
     protocol.maxConnectionsPerUser = c.getint('sftp', 'sessions_per_user')
+    protocol.offloadKeyExchange = c.getint('sftp', 'kex_threads') > 0
+    protocol.supportedCiphers = parse_algorithms(
+        c.get('sftp', 'ciphers'), SSHCiphers.cipherMap, 'ciphers')
+    protocol.supportedMACs = parse_algorithms(
+        c.get('sftp', 'macs'), SSHCiphers.macMap, 'macs')
+    try:
+        from twisted.conch.ssh import _kex
+        kex_algorithms = _kex.getSupportedKeyExchanges()
+    except ImportError:
+        # Older Twisted releases only know their built-in list
+        kex_algorithms = SSHTransportBase.supportedKeyExchanges
+    protocol.supportedKeyExchanges = parse_algorithms(
+        c.get('sftp', 'kex_algorithms'), kex_algorithms, 'kex_algorithms')
+    if protocol.offloadKeyExchange:
+        reactor.suggestThreadPoolSize(c.getint('sftp', 'kex_threads'))
+    if session_counter is not None:
+        protocol.sessionCounter = session_counter
     sshfactory.protocol = protocol
     sshfactory.noisy = False
     sshfactory.portal = sftpportal
     sshfactory.services['ssh-userauth'] = SwiftSSHUserAuthServer
     sshfactory.services['ssh-connection'] = SSHConnection
 
+    # Host keys in order of preference: the ones in host_keys, then ssh-rsa
+    sshfactory.publicKeys = OrderedDict()
+    sshfactory.privateKeys = OrderedDict()
+    for path in c.get('sftp', 'host_keys').split(','):
+        if path.strip():
+            key = Key.fromFile(path.strip())
+            sshfactory.publicKeys[key.sshType()] = key.public()
+            sshfactory.privateKeys[key.sshType()] = key
     pub_key_string = file(c.get('sftp', 'pub_key')).read()
     priv_key_string = file(c.get('sftp', 'priv_key')).read()
-    sshfactory.publicKeys = {
-        'ssh-rsa': Key.fromString(data=pub_key_string)}
-    sshfactory.privateKeys = {
-        'ssh-rsa': Key.fromString(data=priv_key_string)}
+    sshfactory.publicKeys['ssh-rsa'] = Key.fromString(data=pub_key_string)
+    sshfactory.privateKeys['ssh-rsa'] = Key.fromString(data=priv_key_string)
+    # Group exchanges need the primes of a moduli file
+    if os.path.exists(c.get('sftp', 'moduli_file')):
+        sshfactory.primes = parseModuliFile(c.get('sftp', 'moduli_file'))
 
     signal.signal(signal.SIGUSR1, log_runtime_info)
     signal.signal(signal.SIGUSR2, log_runtime_info)
 
-    internet.TCPServer(
-        c.getint('sftp', 'port'),
-        sshfactory,
-        interface=c.get('sftp', 'host')).setServiceParent(sftp_service)
+    if options['listen_fd']:
+        from swftp.workers import WorkerService, address_family
+        WorkerService(
+            sshfactory,
+            int(options['listen_fd']),
+            address_family(c.get('sftp', 'host')),
+            [int(fd) for fd in options['session_fds'].split(',')],
+            protocol,
+            count_sessions=session_counter is None,
+        ).setServiceParent(sftp_service)
+    else:
+        internet.TCPServer(
+            c.getint('sftp', 'port'),
+            sshfactory,
+            interface=c.get('sftp', 'host')).setServiceParent(sftp_service)
 
     return sftp_service
@@ -1,29 +1,107 @@
 """
 See COPYING for license information.
 """
+import itertools
+import os
+import time
+
 from twisted.conch import ls
 
 from swftp.utils import OrderedDict
-from swftp.swiftfilesystem import swift_stat
+from swftp.swiftfilesystem import ListingEntry, swift_mode, swift_mtime
+
+
+class LsLineRenderer(object):
+    """ Renders the same lines as twisted.conch.ls.lsLine for listing entries.
+
+        The permission/link/owner columns only depend on the mode and link
+        count and the date column only changes once per minute, so both are
+        cached instead of being formatted for every entry.
+
+    :param float now: the time used to decide whether a date is recent
+    """
+    sixmonths = 60 * 60 * 24 * 7 * 26
+    uid = 65535
+    gid = 65535
+
+    def __init__(self, now=None):
+        self.now = now or time.time()
+        self._prefixes = {}
+        self._dates = {}
+
+    def prefix(self, mode, nlink):
+        " Permissions, link count, uid and gid columns "
+        key = (mode, nlink)
+        try:
+            return self._prefixes[key]
+        except KeyError:
+            perms = ls.lsLine('', os.stat_result(
+                (mode, 0, 0, 0, 0, 0, 0, 0, 0, 0)))[:10]
+            prefix = ''.join((
+                perms, str(nlink).rjust(5), ' ', str(self.uid).ljust(9),
+                str(self.gid).ljust(9)))
+            self._prefixes[key] = prefix
+            return prefix
+
+    def date(self, mtime):
+        " Date column, including the trailing space "
+        old = mtime + self.sixmonths < self.now
+        key = (int(mtime) // 60, old)
+        try:
+            return self._dates[key]
+        except KeyError:
+            ttup = time.localtime(mtime)
+            if old:
+                strtime = time.strftime("%%s %d  %Y ", ttup)
+            else:
+                strtime = time.strftime("%%s %d %H:%M ", ttup)
+            date = strtime % (ls._MONTH_NAMES[ttup[1]],)
+            self._dates[key] = date
+            return date
+
+    def render(self, name, entry):
+        """ Returns (name, longname, attrs) for a ListingEntry, in the format
+            expected from ISFTPServer.openDirectory iterators.
+        """
+        mode = swift_mode(entry.content_type)
+        size = int(entry.size)
+        mtime = swift_mtime(entry.last_modified)
+        longname = ''.join((
+            self.prefix(mode, entry.count), str(size).rjust(8), ' ',
+            self.date(mtime), name))
+        return (name, longname, {
+            "size": size,
+            "uid": self.uid,
+            "gid": self.gid,
+            "permissions": mode,
+            "atime": int(mtime),
+            "mtime": int(mtime)
+        })
 
 
 class SwiftDirectory(object):
     "Swift Directory is an iterator that returns a listing of the directory."
+    # Matches the number of entries twisted puts into one FXP_NAME packet
+    page_size = 250
+
     def __init__(self, swiftfilesystem, fullpath):
         self.swiftfilesystem = swiftfilesystem
         self.fullpath = fullpath
         # A lot of clients require . and .. to be within the directory listing
         self.files = OrderedDict(
             [
-                ('.', {}),
-                ('..', {}),
+                ('.', ListingEntry('.')),
+                ('..', ListingEntry('..')),
             ])
+        self.listing = OrderedDict()
+        self.renderer = LsLineRenderer()
+        self._entries = None
+        self._page = []
 
     def get_full_listing(self):
         "Populate the directory listing."
         def cb(results):
-            for k, v in results.iteritems():
-                self.files[k] = v
+            self.listing = results
 
         d = self.swiftfilesystem.get_full_listing(self.fullpath)
         d.addCallback(cb)
@@ -32,22 +110,28 @@ class SwiftDirectory(object):
     def __iter__(self):
         return self
 
+    def _render_page(self):
+        " Renders the next page of entries, in listing order "
+        if self._entries is None:
+            self._entries = itertools.chain(
+                self.files.iteritems(), self.listing.iteritems())
+        render = self.renderer.render
+        page = [render(name, f) for name, f in
+                itertools.islice(self._entries, self.page_size)]
+        page.reverse()
+        self._page = page
+
     def next(self):
+        if not self._page:
+            self._render_page()
         try:
-            name, f = self.files.popitem(last=False)
-            lstat = swift_stat(**f)
-            longname = ls.lsLine(name, lstat)
-            return (name, longname, {
-                "size": lstat.st_size,
-                "uid": lstat.st_uid,
-                "gid": lstat.st_gid,
-                "permissions": lstat.st_mode,
-                "atime": int(lstat.st_atime),
-                "mtime": int(lstat.st_mtime)
-            })
-        except KeyError:
+            return self._page.pop()
+        except IndexError:
             raise StopIteration
 
     def close(self):
-        self.files = []
+        self.files = OrderedDict()
+        self.listing = OrderedDict()
+        self._entries = iter(())
+        self._page = []
         self.offset = 0
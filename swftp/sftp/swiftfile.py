@@ -8,14 +8,15 @@ from zope import interface
 
 from twisted.internet import defer, task, reactor
 from twisted.conch.ssh.filetransfer import (
-    FXF_CREAT, FXF_TRUNC, SFTPError, FX_NO_SUCH_FILE, FX_FAILURE,
-    FX_CONNECTION_LOST)
+    FXF_CREAT, FXF_TRUNC, FXF_APPEND, SFTPError, FX_NO_SUCH_FILE, FX_FAILURE,
+    FX_CONNECTION_LOST, FX_OP_UNSUPPORTED)
 from twisted.conch.interfaces import ISFTPFile
 from twisted.internet.protocol import Protocol
 from twisted.internet.interfaces import IPushProducer
 from twisted.internet.error import ConnectionLost
 from twisted.python import log
 
+from swftp.buffers import BufferGovernor
 from swftp.swift import NotFound
 
 
@@ -25,40 +26,139 @@ def cb_log_egress_bytes(result):
     return result
 
 
+# Buffers of all transfers of the process
+transfer_buffers = BufferGovernor(1024 * 1024 * 1024)
+
+
+class ReadAheadBudget(object):
+    """ Bytes that all downloads together may read ahead beyond their
+        download_buffer_limit
+
+    :param int limit: number of bytes
+
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size):
+        " Reserves up to size bytes and returns how many were granted "
+        granted = max(0, min(size, self.limit - self.used))
+        self.used += granted
+        return granted
+
+    def release(self, size):
+        self.used -= size
+
+
 class SwiftFileReceiver(Protocol):
-    "Streams data from Swift user to SFTP session"
+    """ Streams data from Swift user to SFTP session. The amount of data
+        read ahead of the client starts at download_buffer_limit and grows up
+        to max_download_buffer to cover the bandwidth-delay product of the
+        client's consumption rate and the latency of swift.
+    """
     download_buffer_limit = 1024 * 1024
+    max_download_buffer = 32 * 1024 * 1024
     upload_buffer_limit = 1024 * 1024
+    # Shared by all downloads of the process
+    readahead = ReadAheadBudget(256 * 1024 * 1024)
+    governor = transfer_buffers
 
-    def __init__(self, size, session):
+    def __init__(self, size, session, clock=reactor, throttle=None):
         self.size = size
         self.session = session
+        self.clock = clock
+        self.throttle = throttle  # swftp.ratelimit.Throttle, if any
         self.finished = defer.Deferred()
         self.done = False
+        self.closed = False
         self.consume_paused = False
+        self.throttled = False
 
         self._offset = 0
         self._recv_buffer = ""
         self._recv_listeners = []
         self.transport = None
 
+        self.window = self.download_buffer_limit
+        self.requested_at = clock.seconds()
+        self.latency = None     # seconds until swift sent the first byte
+        self.served_since = None
+        self.served = 0
+
     def dataReceived(self, _bytes):
         """
             Data has been received from Swift. Pauses Swift if the
-            download_buffer_limit has been reached.
+            read-ahead window is full.
         """
+        if self.closed:
+            return
+        if self.latency is None:
+            self.latency = self.clock.seconds() - self.requested_at
+        self.governor.reserve(len(_bytes))
         self._recv_buffer += _bytes
         self._readloop()
-        if len(self._recv_buffer) > self.download_buffer_limit:
+        if self.throttle is not None:
+            # Every chunk is charged, even ones that arrive while paused
+            wait = self.throttle.consume(len(_bytes))
+            if wait and not self.throttled:
+                self.throttled = True
+                wait.addCallback(self._unthrottle)
+                if not self.consume_paused:
+                    self.consume_paused = True
+                    self.transport.pauseProducing()
+                return
+        if self.consume_paused:
+            return
+        if len(self._recv_buffer) > self.window:
+            self.consume_paused = True
+            self.transport.pauseProducing()
+        elif self.governor.full():
             self.consume_paused = True
             self.transport.pauseProducing()
+            self.governor.waitForSpace().addCallback(self._resumeIfDrained)
+
+    def _unthrottle(self, ignored):
+        self.throttled = False
+        self.governor.waitForSpace().addCallback(self._resumeIfDrained)
+
+    def _resumeIfDrained(self, ignored=None):
+        " Resumes swift if the buffer has room again "
+        if self.consume_paused and not self.done and not self.throttled and \
+                len(self._recv_buffer) <= self.window and \
+                not self.governor.full():
+            self.consume_paused = False
+            self.transport.resumeProducing()
+
+    def _served(self, size):
+        " Grows the window when the client consumes faster than it covers "
+        if self.done or self.closed:
+            # Swift has sent everything, reading ahead more is of no use
+            return
+        now = self.clock.seconds()
+        if self.served_since is None:
+            self.served_since = now
+        self.served += size
+        elapsed = now - self.served_since
+        if not self.latency or elapsed <= 0:
+            return
+        # Twice the bandwidth-delay product, so the buffer doesn't run dry
+        # while swift resumes after a pause
+        wanted = int(2 * self.served / elapsed * self.latency)
+        wanted = min(wanted, self.max_download_buffer)
+        if wanted > self.window:
+            self.window += self.readahead.reserve(wanted - self.window)
+
+    def _releaseWindow(self):
+        self.readahead.release(self.window - self.download_buffer_limit)
+        self.window = self.download_buffer_limit
 
     def _checksessionbuffertimer(self):
         """
             Checks session buffer to see if we need to resume.
             Reschedules itself if the buffer is still not small enough
         """
-        if not self.consume_paused:
+        if not self.consume_paused or self.throttled:
             return
         if len(self.session.buf) <= self.upload_buffer_limit:
             self.consume_paused = False
@@ -91,11 +191,9 @@ class SwiftFileReceiver(Protocol):
                 self._recv_listeners.remove(callback)
                 self._offset += len(data)
                 self._recv_buffer = self._recv_buffer[length:]
-
-                if self.consume_paused and \
-                        len(self._recv_buffer) <= self.download_buffer_limit:
-                    self.consume_paused = False
-                    self.transport.resumeProducing()
+                self.governor.release(len(data))
+                self._served(len(data))
+                self._resumeIfDrained()
             else:
                 break
 
@@ -123,6 +221,15 @@ class SwiftFileReceiver(Protocol):
         self._readloop()
         return d
 
+    def close(self):
+        " Drops buffered data and stops the download when the file is closed "
+        self.closed = True
+        self._releaseWindow()
+        self.governor.release(len(self._recv_buffer))
+        self._recv_buffer = ""
+        if not self.done and self.transport:
+            self.transport.stopProducing()
+
     def connectionLost(self, reason):
         """
             For some reason, the HTTP connection has been lost. We can either
@@ -132,6 +239,7 @@ class SwiftFileReceiver(Protocol):
         from twisted.web.http import PotentialDataLoss
 
         self.done = True
+        self._releaseWindow()
 
         if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
             self._readloop()
@@ -145,7 +253,10 @@ class SwiftFileReceiver(Protocol):
                 d, _, _ = callback
                 d.errback(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
             self._recv_listeners = []
-            self.finished.errback(reason)
+            if self.closed:
+                self.finished.callback(None)
+            else:
+                self.finished.errback(reason)
 
 
 class SwiftFileSender(object):
@@ -153,11 +264,15 @@ class SwiftFileSender(object):
     interface.implements(IPushProducer)
     max_buffer_writes = 20
     buffer_writes_resume = 5
+    governor = transfer_buffers
 
-    def __init__(self, swiftfilesystem, fullpath, session):
+    def __init__(self, swiftfilesystem, fullpath, session, ready=None,
+                 throttle=None):
         self.swiftfilesystem = swiftfilesystem
         self.fullpath = fullpath
         self.session = session
+        self.ready = ready  # Deferred that fires when the upload can start
+        self.throttle = throttle  # swftp.ratelimit.Throttle, if any
 
         self.write_finished = None  # Deferred that fires when finished writing
         self._task = None           # Task loop
@@ -165,6 +280,7 @@ class SwiftFileSender(object):
         self._writeBuffer = []
 
         self.paused = False
+        self.throttled = False
         self.started = False
 
     def pauseProducing(self):
@@ -181,9 +297,9 @@ class SwiftFileSender(object):
                 pass
 
         for buf in self._writeBuffer:
-            d, _ = buf
+            d, data = buf
+            self.governor.release(len(data))
             d.errback(SFTPError(FX_CONNECTION_LOST, 'Connection Lost'))
-            self._writeBuffer.remove(buf)
         self._writeBuffer = []
 
     def _writeFlusher(self, writer):
@@ -198,6 +314,7 @@ class SwiftFileSender(object):
 
             try:
                 d, data = self._writeBuffer.pop(0)
+                self.governor.release(len(data))
                 writer.write(data)
                 d.callback(len(data))
                 self._checkBuffer()
@@ -207,14 +324,25 @@ class SwiftFileSender(object):
             finally:
                 yield
 
-    def _checkBuffer(self):
-        if self.paused and len(self._writeBuffer) < self.buffer_writes_resume:
+    def _unthrottle(self, ignored):
+        self.throttled = False
+        self.governor.waitForSpace().addCallback(self._checkBuffer)
+
+    def _checkBuffer(self, ignored=None):
+        if self.throttled:
+            return
+        if self.paused and len(self._writeBuffer) < self.buffer_writes_resume \
+                and not self.governor.full():
             self.session.conn.transport.transport.resumeProducing()
             self.paused = False
         elif not self.paused \
                 and len(self._writeBuffer) > self.max_buffer_writes:
             self.session.conn.transport.transport.pauseProducing()
             self.paused = True
+        elif not self.paused and self.governor.full():
+            self.session.conn.transport.transport.pauseProducing()
+            self.paused = True
+            self.governor.waitForSpace().addCallback(self._checkBuffer)
 
     def cb_start_task(self, writer):
         self._task = task.cooperate(self._writeFlusher(writer))
@@ -223,23 +351,207 @@ class SwiftFileSender(object):
         self._done_sending = True
         return self.write_finished
 
+    def _startUpload(self, ignored):
+        d, writer = self.swiftfilesystem.startFileUpload(self.fullpath)
+        writer.registerProducer(self, streaming=True)
+        writer.started.addCallback(self.cb_start_task)
+        return d
+
+    def _ebUpload(self, failure):
+        self.stopProducing()
+        return failure
+
     def write(self, data):
         if not self.started:
             # If we haven't started uploading to Swift, start up that process
-            self.write_finished, writer = \
-                self.swiftfilesystem.startFileUpload(self.fullpath)
-            writer.registerProducer(self, streaming=True)
-            writer.started.addCallback(self.cb_start_task)
+            ready = self.ready or defer.succeed(None)
+            self.write_finished = ready.addCallback(self._startUpload)
+            self.write_finished.addErrback(self._ebUpload)
             self.started = True
         d = defer.Deferred()
+        self.governor.reserve(len(data))
         self._writeBuffer.append((d, data))
+        if self.throttle is not None:
+            wait = self.throttle.consume(len(data))
+            if wait and not self.throttled:
+                self.throttled = True
+                wait.addCallback(self._unthrottle)
+                if not self.paused:
+                    self.session.conn.transport.transport.pauseProducing()
+                    self.paused = True
         self._checkBuffer()
         return d
 
 
+class SwiftFileWriter(object):
+    """ Accepts writes at arbitrary offsets for one open file. Writes that
+        continue the current upload are streamed to Swift. Writes that are
+        ahead of it are held in memory (up to write_window bytes) until the
+        missing data arrives. If the window overflows, the current upload is
+        finished and a new one is started as a segment at the lowest held
+        offset. When segments were used, a DLO manifest is written on close.
+
+    :param swiftfilesystem: SwiftFileSystem instance
+    :param fullpath: path to the object
+    :param session: SSH session (used for throttling)
+    :param int size: size of the existing content that is kept. Writes
+        continue after it
+    :param bool append: ignore offsets and append every write to the end
+    :param throttle: swftp.ratelimit.Throttle of the uploads, if any
+
+    """
+    write_window = 8 * 1024 * 1024
+    governor = transfer_buffers
+
+    def __init__(self, swiftfilesystem, fullpath, session, size=0,
+                 append=False, throttle=None):
+        self.swiftfilesystem = swiftfilesystem
+        self.fullpath = fullpath
+        self.session = session
+        self.throttle = throttle
+        self.size = size
+        self.append = append
+        self.end = size
+
+        # Names the segments of this writer, see SwiftFileSystem.newUpload
+        self.upload = swiftfilesystem.newUpload()
+        self.sender = None       # SwiftFileSender of the current upload
+        self.start = None        # offset the current upload started at
+        self.expected = None     # offset the current upload continues at
+        self.direct = False      # set if the first upload is to fullpath
+        self.segments = {}       # {start offset: length} of all uploads
+        self.finished = []       # deferreds of finished uploads
+        self.pending = {}        # {offset: data} not yet uploaded
+        self.pending_bytes = 0
+        self.failure = None
+
+    def write(self, offset, data):
+        if self.append:
+            offset = self.end
+        if offset < self.size:
+            if offset or self.segments or self.pending:
+                raise SFTPError(
+                    FX_OP_UNSUPPORTED, 'Cannot overwrite existing data')
+            # Rewriting the file from the start
+            self.size = 0
+        self.end = max(self.end, offset + len(data))
+
+        if self.sender is not None and offset == self.expected:
+            d = self._send(data)
+            self._drain()
+            return d
+        if self.sender is None and offset == self.size:
+            self._start(offset)
+            d = self._send(data)
+            self._drain()
+            return d
+
+        for start, length in self.segments.iteritems():
+            if start <= offset < start + length:
+                raise SFTPError(
+                    FX_OP_UNSUPPORTED,
+                    'Cannot overwrite data that was already written')
+        if offset in self.pending:
+            self.pending_bytes -= len(self.pending[offset])
+            self.governor.release(len(self.pending[offset]))
+        self.pending[offset] = data
+        self.pending_bytes += len(data)
+        self.governor.reserve(len(data))
+        # Held writes are handed to a new segment early when the process is
+        # short on buffer space
+        if self.pending_bytes > self.write_window or self.governor.full():
+            self._spill()
+        return defer.succeed(len(data))
+
+    def _start(self, offset):
+        " Starts a new upload at the given offset "
+        self._finishUpload()
+        if offset == 0 and not self.segments:
+            uploadpath = self.fullpath
+            self.direct = True
+            ready = None
+        else:
+            uploadpath = self.swiftfilesystem.segmentPath(
+                self.fullpath, self.upload, offset)
+            # Segments are large (see write_window), so making sure that the
+            # segment container exists costs little
+            ready = self.swiftfilesystem.makeSegmentContainer(self.fullpath)
+        self.sender = SwiftFileSender(
+            self.swiftfilesystem, uploadpath, self.session, ready=ready,
+            throttle=self.throttle)
+        self.start = self.expected = offset
+        self.segments[offset] = 0
+
+    def _finishUpload(self):
+        if self.sender is None:
+            return
+        d = self.sender.close()
+        if d is not None:
+            self.finished.append(d)
+        self.sender = None
+
+    def _send(self, data):
+        d = self.sender.write(data)
+        d.addErrback(self._ebSend)
+        self.segments[self.start] += len(data)
+        self.expected += len(data)
+        return d
+
+    def _ebSend(self, failure):
+        self.failure = failure
+        return failure
+
+    def _drain(self):
+        " Uploads held writes that now continue the current upload "
+        while self.expected in self.pending:
+            data = self.pending.pop(self.expected)
+            self.pending_bytes -= len(data)
+            self.governor.release(len(data))
+            # Already acknowledged, errors are reported on close
+            self._send(data).addErrback(lambda f: None)
+
+    def _spill(self):
+        " Starts a new segment at the lowest offset that is held in memory "
+        self._start(min(self.pending))
+        self._drain()
+
+    @defer.inlineCallbacks
+    def close(self):
+        while self.pending:
+            self._spill()
+        self._finishUpload()
+        results = yield defer.DeferredList(self.finished, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        if self.failure is not None:
+            self.failure.raiseException()
+        if self.direct and len(self.segments) == 1:
+            return
+
+        position = self.size
+        for start in sorted(self.segments):
+            if start != position:
+                raise SFTPError(
+                    FX_FAILURE, 'Writes left a gap at offset %s' % position)
+            position += self.segments[start]
+
+        # When appending, or when the first upload went to the object itself,
+        # the current object becomes the first segment
+        keep_current = bool(self.size) or self.direct
+        try:
+            yield self.swiftfilesystem.writeManifest(
+                self.fullpath, self.upload, keep_current=keep_current)
+        except NotImplementedError, e:
+            raise SFTPError(FX_OP_UNSUPPORTED, e.args[0])
+
+
 class SwiftFile(object):
     "Acts as an open file for the SFTP Server instance"
     interface.implements(ISFTPFile)
+    # swftp.ratelimit.RateLimiter for uploads and downloads, if any
+    ingress_limiter = None
+    egress_limiter = None
 
     def __init__(self, server, fullpath, flags=None, attrs=None):
         self.server = server
@@ -279,6 +591,8 @@ class SwiftFile(object):
     # New Writer Methods
     def close(self):
         " Returns a deferred that fires when the connection is closed "
+        if self.r:
+            self.r.close()
         if self.w:
             d = defer.maybeDeferred(self.w.close)
             d.addErrback(self._errClose)
@@ -294,12 +608,20 @@ class SwiftFile(object):
 
     def writeChunk(self, offset, data):
         if not self.w:
-            self.w = SwiftFileSender(
-                self.swiftfilesystem, self.fullpath, self.session)
+            flags = self.flags or 0
+            size = 0
+            if self.props and not flags & FXF_TRUNC:
+                size = int(self.props['size'])
+            self.w = SwiftFileWriter(
+                self.swiftfilesystem, self.fullpath, self.session, size=size,
+                append=flags & FXF_APPEND == FXF_APPEND,
+                throttle=self._throttle(self.ingress_limiter))
 
-        d = self.w.write(data)
+        d = defer.maybeDeferred(self.w.write, offset, data)
 
         def errback(failure):
+            if failure.check(SFTPError):
+                return failure
             raise SFTPError(FX_FAILURE, 'Upload Failure')
         d.addErrback(errback)
 
@@ -311,13 +633,19 @@ class SwiftFile(object):
     # Reading Methods
     def readChunk(self, offset, length):
         if not self.r:
-            self.r = SwiftFileReceiver(int(self.props['size']), self.session)
+            self.r = SwiftFileReceiver(
+                int(self.props['size']), self.session,
+                throttle=self._throttle(self.egress_limiter))
             self.swiftfilesystem.startFileDownload(
                 self.fullpath, self.r, offset=offset)
         d = self.r.read(offset, length)
         d.addCallback(cb_log_egress_bytes)
         return d
 
+    def _throttle(self, limiter):
+        if limiter is not None:
+            return limiter.throttle(self.swiftfilesystem.swiftconn.username)
+
     def getAttrs(self):
         return self.server.getAttrs(self.fullpath)
 
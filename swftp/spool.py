@@ -0,0 +1,201 @@
+"""
+Spools uploads to local disk so that clients can send data at their own pace,
+independent of how fast the swift cluster accepts it.
+
+See COPYING for license information.
+"""
+import os
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from twisted.python import log
+
+from zope import interface
+
+
+class UploadSpool(object):
+    """ Process-wide accounting for spooled uploads.
+
+    :param str directory: directory the spool files are written to
+    :param int max_size: number of bytes the spool may use. Uploads that are
+        started while the spool is full are streamed directly to swift and
+        clients of spooled uploads are paused while it's full
+    :param int max_flushes: number of uploads from the spool to swift that
+        may run at once
+    :param int segment_size: spooled files are uploaded in segments of this
+        size, in parallel, while the client is still sending data
+
+    """
+    def __init__(self, directory, max_size, max_flushes=10,
+                 segment_size=100 * 1024 * 1024):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.scheduler = defer.DeferredSemaphore(max_flushes)
+        self.used = 0
+        self.flushing = 0       # bytes of spool files that are uploading
+        self._waiting = []
+
+    def full(self):
+        return self.used >= self.max_size
+
+    def reserve(self, size):
+        " Accounts for bytes written to the spool "
+        self.used += size
+        log.msg(metric='spool.bytes', count=size)
+
+    def flush(self, size):
+        " Accounts for bytes of a spool file that is scheduled for upload "
+        self.flushing += size
+
+    def release(self, size):
+        " Accounts for bytes of an uploaded spool file "
+        self.used -= size
+        self.flushing -= size
+        log.msg(metric='spool.bytes', count=-size)
+        while self._waiting and not self._blocked():
+            self._waiting.pop(0).callback(None)
+
+    def _blocked(self):
+        # Waiting only helps while uploads are running that free up space
+        return self.full() and self.flushing > 0
+
+    def waitForSpace(self):
+        """ Returns a deferred that fires once the spool isn't full anymore,
+            or once no upload is left that could make room
+        """
+        if not self._blocked():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def startUpload(self, swiftfilesystem, fullpath):
+        " Returns a new SpooledUpload "
+        return SpooledUpload(swiftfilesystem, self, fullpath)
+
+    def tempfile(self):
+        " Returns (path, file) of a new spool file "
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='swftp-')
+        return path, os.fdopen(fd, 'w+b')
+
+
+class SpooledUpload(object):
+    """ Takes the place of `SwiftWriteFile` when uploads are spooled. Data is
+        written to spool files of `segment_size` bytes. Each full spool file
+        is uploaded as a segment (through the spool's scheduler) while the
+        client keeps sending. Files that fit into one spool file are uploaded
+        as a normal object once the client is done. `finished` fires once
+        everything is stored in swift.
+
+    :param swiftfilesystem: SwiftFileSystem instance
+    :param spool: UploadSpool instance
+    :param fullpath: path to the object
+
+    """
+    interface.implements(IConsumer)
+
+    def __init__(self, swiftfilesystem, spool, fullpath):
+        self.swiftfilesystem = swiftfilesystem
+        self.spool = spool
+        self.fullpath = fullpath
+        # Segments can't be segmented any further
+        self.segmentable = '//' not in fullpath
+
+        self.started = defer.succeed(self)
+        self.finished = defer.Deferred()
+        self.producer = None
+        self.paused = False
+
+        self.offset = 0         # offset of the current spool file
+        self.size = 0           # bytes in the current spool file
+        self.path, self.file = spool.tempfile()
+        # Names the segments of this upload, see SwiftFileSystem.newUpload
+        self.upload = swiftfilesystem.newUpload()
+        self.segments = []      # start offsets of the uploaded segments
+        self.uploads = []       # deferreds of running uploads
+
+    # IConsumer
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+        self._seal(final=True)
+        d = defer.DeferredList(self.uploads, consumeErrors=True)
+        d.addCallback(self._cbUploaded)
+        d.chainDeferred(self.finished)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.spool.reserve(len(data))
+        log.msg(metric='transfer.ingress_bytes', count=len(data))
+        if self.segmentable and self.size >= self.spool.segment_size:
+            self._seal()
+        if self.spool.full() and self.producer and not self.paused:
+            # Uploading what was received so far frees up space. Segments
+            # can't be split up, they wait for the uploads of others.
+            if self.segmentable and self.size:
+                self._seal()
+            if not self.spool.flushing:
+                return
+            self.paused = True
+            self.producer.pauseProducing()
+            self.spool.waitForSpace().addCallback(self._resume)
+
+    def _resume(self, ignored):
+        self.paused = False
+        if self.producer:
+            self.producer.resumeProducing()
+
+    def _seal(self, final=False):
+        " Schedules the upload of the current spool file "
+        self.file.close()
+        if final and self.segments and not self.size:
+            os.unlink(self.path)
+            return
+        if final and not self.segments:
+            uploadpath = self.fullpath
+        else:
+            uploadpath = self.swiftfilesystem.segmentPath(
+                self.fullpath, self.upload, self.offset)
+            self.segments.append(self.offset)
+        self.spool.flush(self.size)
+        d = self.spool.scheduler.run(
+            self._upload, uploadpath, self.path, self.size)
+        self.uploads.append(d)
+        if not final:
+            self.offset += self.size
+            self.size = 0
+            self.path, self.file = self.spool.tempfile()
+
+    def _upload(self, uploadpath, path, size):
+        f = open(path, 'rb')
+
+        def cleanup(result):
+            f.close()
+            os.unlink(path)
+            self.spool.release(size)
+            return result
+
+        d = defer.succeed(None)
+        if uploadpath != self.fullpath:
+            d.addCallback(
+                lambda r: self.swiftfilesystem.makeSegmentContainer(
+                    self.fullpath))
+        d.addCallback(
+            lambda r: self.swiftfilesystem.uploadFile(uploadpath, f))
+        d.addBoth(cleanup)
+        return d
+
+    def _cbUploaded(self, results):
+        for success, result in results:
+            if not success:
+                return result
+        if self.segments:
+            return self.swiftfilesystem.writeManifest(
+                self.fullpath, self.upload)
@@ -13,7 +13,7 @@ from twisted.internet.protocol import Protocol
 from twisted.web.http_headers import Headers
 from twisted.web import error
 from twisted.web._newclient import ResponseDone
-from twisted.web.http import PotentialDataLoss
+from twisted.web.http import PotentialDataLoss, datetimeToString
 from twisted.python import log
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
@@ -41,6 +41,13 @@ class Conflict(RequestError):
     pass
 
 
+class NotModified(RequestError):
+    """ Raised when a conditional request finds that the resource didn't
+        change (304 Not Modified). The body was not transferred.
+    """
+    pass
+
+
 class ResponseReceiver(Protocol):
     """
     Assembles HTTP response from return stream.
@@ -77,7 +84,7 @@ class ResponseIgnorer(Protocol):
 
 def cb_recv_resp(response, load_body=False, receiver=None):
     d_resp_recvd = Deferred()
-    if response.code == 204:
+    if response.code in (204, 304):
         response.deliverBody(ResponseIgnorer(d_resp_recvd))
     elif load_body:
         response.deliverBody(ResponseReceiver(d_resp_recvd))
@@ -100,6 +107,8 @@ def cb_process_resp(body, response):
         raise UnAuthorized(response.code, body)
     if response.code == 409:
         raise Conflict(response.code, body)
+    if response.code == 304:
+        raise NotModified(response.code, body)
     elif response.code > 299 and response.code < 400:
         raise error.PageRedirect(response.code, body)
     elif response.code > 399:
@@ -111,6 +120,24 @@ def cb_process_resp(body, response):
     return response, body
 
 
+def conditional_headers(headers=None, if_none_match=None,
+                        if_modified_since=None):
+    """ Returns a copy of headers with the conditional request headers added
+
+    :param dict headers: headers of the request
+    :param if_none_match: ETag of the copy the caller already has
+    :param if_modified_since: UNIX timestamp of the copy the caller already
+        has
+
+    """
+    headers = dict(headers or {})
+    if if_none_match:
+        headers['If-None-Match'] = '"%s"' % if_none_match.strip('"')
+    if if_modified_since is not None:
+        headers['If-Modified-Since'] = datetimeToString(if_modified_since)
+    return headers
+
+
 def format_head_response(result):
     resp, _ = result
     return resp.headers
@@ -121,6 +148,30 @@ def cb_json_decode(result):
     return resp, json.loads(body)
 
 
+def twisted_agent(pool=None, proxy=None):
+    """ HTTP backend that uses twisted.web.client. Backends are callables
+        that take these arguments and return an IAgent
+        (twisted.web.iweb.IAgent). Responses must provide IResponse, with the
+        body delivered to a protocol that can pause the transfer through its
+        transport, and request bodies are IBodyProducers.
+
+        :param pool: A twisted.web.client.HTTPConnectionPool object
+        :param proxy: a proxy for request to swift (or None), ex.: 127.0.0.1:88
+    """
+    if proxy:
+        if ":" in proxy:
+            addr, port = proxy.rsplit(":", 1)
+            port = int(port)
+        else:
+            addr, port = proxy, 8000
+
+        endpoint = TCP4ClientEndpoint(reactor, addr, port)
+        return ProxyAgent(endpoint, pool=pool)
+    contextFactory = WebClientContextFactory()
+    contextFactory.noisy = False
+    return Agent(reactor, contextFactory, pool=pool)
+
+
 class SwiftConnection(object):
     """ A basic connection class to interface with OpenStack Swift.
 
@@ -133,6 +184,8 @@ class SwiftConnection(object):
         :param bool verbose: verbose setting
     """
     user_agent = 'Twisted Swift'
+    # Returns the IAgent that requests are made with (see twisted_agent)
+    http_backend = staticmethod(twisted_agent)
 
     def __init__(self, auth_url, username, api_key, pool=None, proxy=None,
                  extra_headers=None, verbose=False):
@@ -142,21 +195,7 @@ class SwiftConnection(object):
         self.storage_url = None
         self.auth_token = None
         self.pool = pool
-
-        if proxy:
-            if ":" in proxy:
-                addr, port = proxy.rsplit(":", 1)
-                port = int(port)
-            else:
-                addr, port = proxy, 8000
-
-            endpoint = TCP4ClientEndpoint(reactor, addr, port)
-            self.agent = ProxyAgent(endpoint, pool=self.pool)
-        else:
-            contextFactory = WebClientContextFactory()
-            contextFactory.noisy = False
-            self.agent = Agent(reactor, contextFactory, pool=self.pool)
-
+        self.agent = self.http_backend(pool=pool, proxy=proxy)
         self.extra_headers = extra_headers
         self.verbose = verbose
 
@@ -346,34 +385,50 @@ class SwiftConnection(object):
         d.addCallback(cb_recv_resp)
         return d
 
-    def head_object(self, container, path):
-        """ Get details about an object
+    def head_object(self, container, path, if_none_match=None,
+                    if_modified_since=None):
+        """ Get details about an object. NotModified is raised if a condition
+        is given and the object still matches it.
 
         :param container: The container name
         :param path: The object name/path
+        :param if_none_match: ETag of the copy the caller already has
+        :param if_modified_since: UNIX timestamp of the copy the caller
+                                  already has
 
         :returns dict:
 
         """
         _path = "/".join((quote(container), quote(path)))
-        d = self.make_request('HEAD', _path)
+        headers = conditional_headers(
+            if_none_match=if_none_match, if_modified_since=if_modified_since)
+        d = self.make_request('HEAD', _path, headers=headers)
         d.addCallback(cb_recv_resp)
         d.addCallback(format_head_response)
         return d
 
-    def get_object(self, container, path, headers=None, receiver=None):
-        """ Download an object
+    def get_object(self, container, path, headers=None, receiver=None,
+                   if_none_match=None, if_modified_since=None):
+        """ Download an object. NotModified is raised if a condition is given
+        and the object still matches it. The receiver doesn't get any calls
+        in that case.
 
         :param container: The container name
         :param path: The object name/path
         :param dict headers: Extra headers to use with the HTTP request
         :param receiver: A twisted.internet.protocol.Protocol that will receive
                          the contents of the object
+        :param if_none_match: ETag of the copy the caller already has
+        :param if_modified_since: UNIX timestamp of the copy the caller
+                                  already has
 
         :returns t.w.c.Response:
 
         """
         _path = "/".join((quote(container), quote(path)))
+        headers = conditional_headers(
+            headers, if_none_match=if_none_match,
+            if_modified_since=if_modified_since)
         d = self.make_request('GET', _path, headers=headers)
         d.addCallback(cb_recv_resp, receiver=receiver)
         return d
@@ -418,35 +473,67 @@ class ThrottledSwiftConnection(SwiftConnection):
         before making requests. Locks can either be a DeferredSemaphore, a
         DeferredLock, or anything else that implements
         twisted.internet.defer._ConcurrencyPrimitive. Locks are acquired in the
-        order in the list.
+        order in the list. After the locks, a turn is taken from the scheduler
+        if there is one (see swftp.scheduler.FairScheduler).
+
+        Metadata requests use metadata_locks instead when they are set, so
+        that they don't wait for transfers.
 
         :param locks: list of locks that implement
             twisted.internet.defer._ConcurrencyPrimitive
         :param \*args: same arguments as `SwiftConnection`
         :param \*\*args: same keyword arguments as `SwiftConnection`
     """
+    scheduler = None
+    metadata_locks = None
+
     def __init__(self, locks, *args, **kwargs):
         SwiftConnection.__init__(self, *args, **kwargs)
         self.locks = locks or []
 
-    def _release_all(self, result):
-        for lock in self.locks:
+    def _release_all(self, result, locks):
+        for lock in locks:
             lock.release()
+        if self.scheduler:
+            self.scheduler.release()
         return result
 
-    def _aquire_all(self):
+    def _aquire_all(self, locks, priority='transfer'):
         d = succeed(None)
-        for lock in self.locks:
-            d.addCallback(lambda r: lock.acquire())
+        for lock in locks:
+            d.addCallback(lambda r, lock=lock: lock.acquire())
+        if self.scheduler:
+            d.addCallback(
+                lambda r: self.scheduler.acquire(self.username, priority))
         return d
 
-    def make_request(self, *args, **kwargs):
+    def request_class(self, method, params=None, headers=None, body=None):
+        """ Returns 'transfer' for object downloads, uploads and server side
+            copies and 'metadata' for everything else. Listings always have
+            parameters.
+        """
+        if body is not None or (method == 'GET' and not params):
+            return 'transfer'
+        # A copy moves the whole object inside of the cluster
+        if headers and 'X-Copy-From' in headers:
+            return 'transfer'
+        return 'metadata'
+
+    def make_request(self, method, path, params=None, headers=None,
+                     body=None):
+        request_class = self.request_class(
+            method, params=params, headers=headers, body=body)
+        locks = self.locks
+        if request_class == 'metadata' and self.metadata_locks is not None:
+            locks = self.metadata_locks
+
         def execute(ignored):
-            d = SwiftConnection.make_request(self, *args, **kwargs)
-            d.addBoth(self._release_all)
+            d = SwiftConnection.make_request(
+                self, method, path, params=params, headers=headers, body=body)
+            d.addBoth(self._release_all, locks)
             return d
 
-        d = self._aquire_all()
+        d = self._aquire_all(locks, request_class)
         d.addCallback(execute)
         return d
 
@@ -7,19 +7,23 @@ See COPYING for license information.
 import datetime
 import stat
 import os
+import urllib
 import urlparse
 import time
+import uuid
 
 from twisted.internet import defer, reactor, task
 from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from twisted.web.client import FileBodyProducer
 from twisted.internet.interfaces import IConsumer
 from twisted.python import log
 
 from zope import interface
 
+from swftp.objectcache import CachingReceiver
 from swftp.utils import OrderedDict
 from swftp.utils import try_datetime_parse
-from swftp.swift import NotFound, Conflict
+from swftp.swift import NotFound, Conflict, quote
 
 
 def obj_to_path(path):
@@ -39,6 +43,46 @@ def obj_to_path(path):
     return container, item
 
 
+def segment_container(container):
+    " Returns the container that holds the segments of large objects "
+    return '%s_segments' % container
+
+
+def segment_prefix(path, upload=''):
+    """ Returns the prefix shared by all segments of one upload of a large
+        object. Each upload has its own prefix, so uploads of the same path
+        never see each other's segments. Paths coming from clients never
+        contain '//', so segments of one object can't be mistaken for
+        segments of another.
+    """
+    if upload:
+        return '%s//%s/' % (path, upload)
+    return '%s//' % path
+
+
+def segment_name(path, upload, offset):
+    """ Returns the name of the segment that starts at the given offset. Names
+        sort in the same order as the offsets.
+    """
+    return '%s%016d' % (segment_prefix(path, upload), offset)
+
+
+def manifest_upload(container, path, headers):
+    """ Returns the upload whose segments a DLO that was created by this
+        server is made of, None for any other object
+    """
+    manifest = headers.get('x-object-manifest')
+    if not manifest:
+        return None
+    prefix = '/'.join((segment_container(container), segment_prefix(path)))
+    manifest = urllib.unquote(manifest)
+    upload = manifest[len(prefix):-1]
+    if not manifest.startswith(prefix) or not manifest.endswith('/') or \
+            not upload or '/' in upload:
+        return None
+    return upload
+
+
 def cb_parse_account_headers(headers):
     return {
         'count': headers.get('x-account-container-count', 0),
@@ -55,29 +99,203 @@ def cb_parse_container_headers(headers):
     }
 
 
+def object_hash(headers):
+    """ Returns the MD5 of an object's content from its HEAD/GET headers.
+        Large object manifests have an ETag that isn't the MD5 of the content,
+        so None is returned for them.
+    """
+    if 'x-object-manifest' in headers or 'x-static-large-object' in headers:
+        return None
+    etag = headers.get('etag')
+    if etag:
+        etag = etag.strip('"')
+    return etag or None
+
+
+def listing_hash(item):
+    """ Returns the MD5 of an object's content from its item in a JSON
+        container listing. Listings don't mark DLO manifests, which list the
+        MD5 of their empty body, so no hash is given for empty objects. SLOs
+        list the ETag of their manifest and are known by their slo_etag.
+    """
+    if not item.get('bytes') or 'slo_etag' in item:
+        return None
+    return str(item.get('hash') or '').strip('"') or None
+
+
 def cb_parse_object_headers(headers):
     return {
         'size': headers.get('content-length', 0),
         'last_modified': headers.get('last-modified', 0),
         'content_type': headers.get('content-type'),
+        'hash': object_hash(headers),
     }
 
 
-def swift_stat(last_modified=None, content_type="application/directory",
-               count=1, bytes=0, size=0, **kwargs):
-    size = int(size) or int(bytes)
+def swift_mtime(last_modified):
+    " Parses a swift timestamp, defaulting to the current time "
     mtime = try_datetime_parse(last_modified)
     if not mtime:
         mtime = time.mktime(datetime.datetime.utcnow().timetuple())
+    return mtime
 
+
+def swift_mode(content_type):
+    " Returns the file mode used for the given content type "
     if content_type == "application/directory":
-        mode = 0700 | stat.S_IFDIR
-    else:
-        mode = 0600 | stat.S_IFREG
+        return 0700 | stat.S_IFDIR
+    return 0600 | stat.S_IFREG
+
+
+def swift_stat(last_modified=None, content_type="application/directory",
+               count=1, bytes=0, size=0, **kwargs):
+    size = int(size) or int(bytes)
+    mtime = swift_mtime(last_modified)
+    mode = swift_mode(content_type)
     return os.stat_result((mode, 0, 0, count, 65535, 65535, size, mtime,
                            mtime, mtime))
 
 
+class ListingEntry(object):
+    """ A compact record for one entry of an account or container listing.
+
+        Listings can hold millions of entries, so this keeps only the fields
+        that are needed to render FTP/SFTP listings. It also supports the
+        read-only mapping protocol so it can be used wherever the property
+        dicts returned by `SwiftFileSystem.getAttrs` are expected.
+
+        :param str name: the formatted (base) name of the entry
+        :param content_type: content type of the entry
+        :param int size: size in bytes
+        :param int count: number of objects (for containers)
+        :param str last_modified: last modified timestamp, as sent by swift
+        :param str hash: the MD5 hash (etag) of the object
+    """
+    __slots__ = ('name', 'content_type', 'size', 'count', 'last_modified',
+                 'hash')
+
+    def __init__(self, name, content_type="application/directory", size=0,
+                 count=1, last_modified=None, hash=None):
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+        self.count = count
+        self.last_modified = last_modified
+        self.hash = hash
+
+    @classmethod
+    def from_object(cls, item):
+        " Creates an entry from an item of a JSON container listing "
+        if 'subdir' in item:
+            return cls(
+                os.path.basename(item['subdir'].encode("utf-8").rstrip('/')))
+        return cls(
+            os.path.basename(item['name'].encode("utf-8").rstrip('/')),
+            content_type=intern(str(
+                item.get('content_type', 'application/directory'))),
+            size=item.get('bytes', 0),
+            last_modified=str(item.get('last_modified') or '') or None,
+            hash=listing_hash(item))
+
+    @classmethod
+    def from_container(cls, item):
+        " Creates an entry from an item of a JSON account listing "
+        return cls(item['name'].encode("utf-8"), size=item.get('bytes', 0),
+                   count=item.get('count', 1))
+
+    def stat(self):
+        " Returns an os.stat_result for this entry "
+        return swift_stat(last_modified=self.last_modified,
+                          content_type=self.content_type, count=self.count,
+                          size=self.size)
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '<ListingEntry %r>' % self.name
+
+
+def props_stat(props):
+    """ Returns an os.stat_result for either a ListingEntry or a property dict
+        as returned by `SwiftFileSystem.getAttrs`
+    """
+    if isinstance(props, ListingEntry):
+        return props.stat()
+    return swift_stat(**props)
+
+
+class ListingCache(object):
+    """ Remembers the most recent directory listing of a session so that stat
+        requests for its entries (FTP clients send SIZE/MDTM for every file
+        right after LIST) can be answered without a HEAD request each.
+
+    :param int ttl: number of seconds a listing is trusted for. 0 disables
+        the cache
+    :param clock: provides seconds(), defaults to the reactor
+
+    """
+    def __init__(self, ttl=10, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        self.path = None
+        self.listing = None
+        self.expires = 0
+
+    def _key(self, fullpath):
+        container, path = obj_to_path(fullpath)
+        if container and path:
+            return '/'.join([container, path])
+        return container or ''
+
+    def store(self, fullpath, listing):
+        " Stores the listing of the given directory path "
+        if self.ttl <= 0:
+            return
+        self.path = self._key(fullpath)
+        self.listing = listing
+        self.expires = self.clock.seconds() + self.ttl
+
+    def lookup(self, fullpath):
+        """ Returns the ListingEntry for the given path if its parent directory
+            was the last one listed and the listing is still fresh. Returns
+            None otherwise.
+        """
+        if self.listing is None:
+            return None
+        if self.clock.seconds() >= self.expires:
+            self.invalidate()
+            return None
+        key = self._key(fullpath)
+        if not key:
+            return None
+        parent, _, name = key.rpartition('/')
+        if parent != self.path:
+            return None
+        return self.listing.get(name)
+
+    def invalidate(self):
+        " Forgets the cached listing "
+        self.path = None
+        self.listing = None
+        self.expires = 0
+
+
 class SwiftWriteFile(object):
     """ Adapts IBodyProducer and IConsumer """
     interface.implements(IBodyProducer, IConsumer)
@@ -119,22 +337,51 @@ class SwiftWriteFile(object):
 
 class SwiftFileSystem(object):
     "Defines a common interface used to create Swift similar to a filesystem"
-    def __init__(self, swiftconn):
+    # Seconds that the account stats returned by getAccountStats are reused
+    account_stats_ttl = 60
+    # swftp.spool.UploadSpool that uploads are written to, if any
+    spool = None
+    # swftp.objectcache.ObjectCache that small downloads are served from
+    object_cache = None
+
+    def __init__(self, swiftconn, clock=reactor):
         self.swiftconn = swiftconn
+        self.clock = clock
+        self._account_stats = None
+        self._account_stats_expires = 0
 
     def startFileUpload(self, fullpath):
         "returns IConsumer to write to object data to"
+        if self.spool is not None and not self.spool.full():
+            upload = self.spool.startUpload(self, fullpath)
+            return upload.finished, upload
         container, path = obj_to_path(fullpath)
         consumer = SwiftWriteFile()
         d = self.swiftconn.put_object(container, path, body=consumer)
         return d, consumer
 
+    def uploadFile(self, fullpath, f):
+        " Uploads the contents of a local file object "
+        container, path = obj_to_path(fullpath)
+        return self.swiftconn.put_object(
+            container, path, body=FileBodyProducer(f))
+
     def startFileDownload(self, fullpath, consumer, offset=0):
         "consumer: Protocol"
         container, path = obj_to_path(fullpath)
         headers = {}
         if offset > 0:
             headers['Range'] = 'bytes=%s-' % offset
+        elif self.object_cache is not None:
+            key = (self.swiftconn.storage_url, fullpath)
+            cached = self.object_cache.get(key)
+            receiver = CachingReceiver(
+                self.object_cache, key, consumer, cached=cached)
+            d = self.swiftconn.get_object(
+                container, path, receiver=receiver,
+                if_none_match=cached and cached[0])
+            d.addCallbacks(receiver.gotResponse, receiver.notModified)
+            return d
         d = self.swiftconn.get_object(container, path, receiver=consumer,
                                       headers=headers)
         return d
@@ -190,11 +437,206 @@ class SwiftFileSystem(object):
                 raise NotImplementedError
 
             # This is an actual object with no children. Free to rename.
-            yield self.swiftconn.put_object(
-                newcontainer, newpath,
-                headers={'X-Copy-From': '%s/%s' % (container, path)})
+            yield self.copyFile(oldpath, '/'.join((newcontainer, newpath)))
             yield self.swiftconn.delete_object(container, path)
 
+    def copyFile(self, srcpath, dstpath):
+        """ Copies an object inside of the swift cluster (X-Copy-From), no data
+            passes through this server
+        """
+        container, path = obj_to_path(srcpath)
+        newcontainer, newpath = obj_to_path(dstpath)
+        if not container or not path or not newcontainer or not newpath:
+            raise NotImplementedError
+        return self.swiftconn.put_object(
+            newcontainer, newpath,
+            headers={'X-Copy-From': '/%s/%s' % (quote(container),
+                                                quote(path))})
+
+    @defer.inlineCallbacks
+    def prepareAppend(self, fullpath, offset=None):
+        """ Prepares an object so that data can be appended to it. Unless it's
+            missing or empty, the object is turned into a dynamic large object
+            (DLO), see `segmentObject`. Returns a deferred that fires with the
+            path the appended data has to be uploaded to.
+
+        :param fullpath: path to the object
+        :param offset: offset the new data starts at. Only the current size
+            of the object is supported. None appends to the end
+
+        """
+        container, path = obj_to_path(fullpath)
+        if not container or not path:
+            raise NotImplementedError('Cannot append to directories.')
+        try:
+            headers = yield self.swiftconn.head_object(container, path)
+        except NotFound:
+            headers = {}
+        size = int(headers.get('content-length', 0))
+        if offset is None:
+            offset = size
+        if offset != size:
+            raise NotImplementedError(
+                'Uploads can only be resumed at the end of the file (%s).'
+                % size)
+        if offset == 0:
+            defer.returnValue(fullpath)
+        upload = yield self.segmentObject(fullpath, headers)
+        defer.returnValue(self.segmentPath(fullpath, upload, offset))
+
+    def newUpload(self):
+        " Returns the id of a new upload, which names its segments "
+        return uuid.uuid4().hex
+
+    def makeSegmentContainer(self, fullpath):
+        " Creates the container that holds the segments of an object "
+        container, _ = obj_to_path(fullpath)
+        return self.swiftconn.put_container(segment_container(container))
+
+    def segmentPath(self, fullpath, upload, offset):
+        """ Returns the path of the segment of an upload of an object at the
+            given offset
+        """
+        container, path = obj_to_path(fullpath)
+        return '/'.join((segment_container(container),
+                         segment_name(path, upload, offset)))
+
+    @defer.inlineCallbacks
+    def segmentObject(self, fullpath, headers, upload=None,
+                      keep_current=True):
+        """ Turns an object into a DLO over the segments of an upload, which
+            live in <container>_segments. Returns a deferred that fires with
+            the upload. The segments of the DLO that is replaced are deleted.
+
+        :param fullpath: path to the object
+        :param dict headers: the current headers of the object (from a HEAD)
+        :param upload: the upload whose segments make up the new content.
+            None starts a new one, or leaves a DLO that was created by this
+            server as it is
+        :param bool keep_current: keep the current content of the object as
+            the first segments of the upload
+
+        """
+        container, path = obj_to_path(fullpath)
+        current = manifest_upload(container, path, headers)
+        if keep_current and current is None and (
+                'x-static-large-object' in headers or
+                'x-object-manifest' in headers):
+            raise NotImplementedError(
+                'Cannot append to large objects created by other clients.')
+        if upload is None:
+            if current is not None:
+                defer.returnValue(current)
+            upload = self.newUpload()
+
+        yield self.makeSegmentContainer(fullpath)
+        if keep_current:
+            if current is not None:
+                yield self.copySegments(fullpath, current, upload)
+            elif int(headers.get('content-length', 0)):
+                yield self.copyFile(
+                    fullpath, self.segmentPath(fullpath, upload, 0))
+        manifest = '/'.join((segment_container(container),
+                             segment_prefix(path, upload)))
+        manifest_headers = {'X-Object-Manifest': quote(manifest)}
+        if headers.get('content-type'):
+            manifest_headers['Content-Type'] = headers['content-type']
+        yield self.swiftconn.put_object(
+            container, path, headers=manifest_headers)
+        if current is not None and current != upload:
+            yield self.deleteSegments(fullpath, current)
+        defer.returnValue(upload)
+
+    @defer.inlineCallbacks
+    def writeManifest(self, fullpath, upload, keep_current=False):
+        """ Finishes an upload that was stored as segments by turning the
+            object into a DLO over them
+
+        :param fullpath: path to the object
+        :param upload: the upload the segments belong to
+        :param bool keep_current: keep the current content of the object as
+            the first segment (when data was appended to it)
+
+        """
+        container, path = obj_to_path(fullpath)
+        try:
+            headers = yield self.swiftconn.head_object(container, path)
+        except NotFound:
+            headers = {}
+        yield self.segmentObject(
+            fullpath, headers, upload=upload, keep_current=keep_current)
+
+    @defer.inlineCallbacks
+    def listSegments(self, fullpath, upload):
+        """ Returns a deferred that fires with the names of the segments of
+            an upload, in the segment container
+        """
+        container, path = obj_to_path(fullpath)
+        prefix = segment_prefix(path, upload)
+        names = []
+        marker = None
+        while True:
+            try:
+                _, files = yield self.swiftconn.get_container(
+                    segment_container(container), prefix=prefix,
+                    marker=marker)
+            except NotFound:
+                break
+            if len(files) == 0:
+                break
+            for f in files:
+                name = f['name'].encode('utf-8')
+                if name[len(prefix):].isdigit():
+                    names.append(name)
+            marker = files[-1]['name']
+        defer.returnValue(names)
+
+    @defer.inlineCallbacks
+    def copySegments(self, fullpath, upload, new_upload):
+        " Copies the segments of an upload into another upload "
+        container, path = obj_to_path(fullpath)
+        seg_container = segment_container(container)
+        names = yield self.listSegments(fullpath, upload)
+        for name in names:
+            offset = int(name[len(segment_prefix(path, upload)):])
+            yield self.copyFile(
+                '/'.join((seg_container, name)),
+                self.segmentPath(fullpath, new_upload, offset))
+
+    @defer.inlineCallbacks
+    def deleteSegments(self, fullpath, upload):
+        " Deletes the segments of an upload "
+        container, _ = obj_to_path(fullpath)
+        seg_container = segment_container(container)
+        names = yield self.listSegments(fullpath, upload)
+        for name in names:
+            try:
+                yield self.swiftconn.delete_object(seg_container, name)
+            except NotFound:
+                pass
+
+    def getAccountStats(self):
+        """ Returns a deferred that fires with the account headers as parsed
+            by cb_parse_account_headers (plus 'objects' and 'quota'). The
+            result is reused for `account_stats_ttl` seconds.
+        """
+        now = self.clock.seconds()
+        if self._account_stats is not None and \
+                now < self._account_stats_expires:
+            return defer.succeed(self._account_stats)
+
+        def cb(headers):
+            stats = cb_parse_account_headers(headers)
+            stats['objects'] = headers.get('x-account-object-count', 0)
+            stats['quota'] = headers.get('x-account-meta-quota-bytes')
+            self._account_stats = stats
+            self._account_stats_expires = now + self.account_stats_ttl
+            return stats
+
+        d = self.swiftconn.head_account()
+        d.addCallback(cb)
+        return d
+
     @defer.inlineCallbacks
     def getAttrs(self, fullpath):
         container, path = obj_to_path(fullpath)
@@ -249,7 +691,7 @@ class SwiftFileSystem(object):
             structure. Works for account, container and object prefix listings.
 
 
-            @returns dict of {name: property} values
+            @returns dict of {name: ListingEntry} values
         """
         container, path = obj_to_path(fullpath)
         if container:
@@ -257,6 +699,7 @@ class SwiftFileSystem(object):
         else:
             return self.get_account_listing()
 
+    @defer.inlineCallbacks
     def get_container_listing(self, container, path, marker=None,
                               all_files=None):
         if all_files is None:
@@ -264,43 +707,31 @@ class SwiftFileSystem(object):
         prefix = None
         if path:
             prefix = "%s/" % path
-        d = self.swiftconn.get_container(
-            container, prefix=prefix, delimiter='/', marker=marker)
-
-        def cb(results):
-            _, files = results
-            next_marker = None
+        while True:
+            # Pages are converted into ListingEntry objects one at a time so
+            # that only a single page of decoded JSON is alive at once.
+            _, files = yield self.swiftconn.get_container(
+                container, prefix=prefix, delimiter='/', marker=marker)
+            if len(files) == 0:
+                break
             for f in files:
-                if 'subdir' in f:
-                    f['name'] = f['subdir']
-                    f['content-type'] = 'application/directory'
-                f['formatted_name'] = os.path.basename(
-                    f['name'].encode("utf-8").rstrip('/'))
-                all_files[f['formatted_name']] = f
-                next_marker = f['name']
-            if len(files) > 0:
-                return self.get_container_listing(
-                    container, path, marker=next_marker, all_files=all_files)
-            return all_files
-        d.addCallback(cb)
-        return d
+                entry = ListingEntry.from_object(f)
+                all_files[entry.name] = entry
+            marker = files[-1].get('subdir') or files[-1]['name']
+            del files
+        defer.returnValue(all_files)
 
+    @defer.inlineCallbacks
     def get_account_listing(self, marker=None, all_files=None):
         if all_files is None:
             all_files = OrderedDict()
-        d = self.swiftconn.get_account(marker=marker)
-
-        def cb(results):
-            _, files = results
-            next_marker = None
+        while True:
+            _, files = yield self.swiftconn.get_account(marker=marker)
+            if len(files) == 0:
+                break
             for f in files:
-                f['content-type'] = 'application/directory'
-                f['formatted_name'] = f['name'].encode("utf-8")
-                all_files[f['formatted_name']] = f
-                next_marker = f['name']
-            if len(files) > 0:
-                return self.get_account_listing(
-                    marker=next_marker, all_files=all_files)
-            return all_files
-        d.addCallback(cb)
-        return d
+                entry = ListingEntry.from_container(f)
+                all_files[entry.name] = entry
+            marker = files[-1]['name']
+            del files
+        defer.returnValue(all_files)
@@ -6,9 +6,10 @@ from twisted.trial import unittest
 from mock import patch, MagicMock
 from twisted.cred.credentials import UsernamePassword
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from swftp.auth import SwiftBasedAuthDB
+from swftp.auth import (
+    SwiftBasedAuthDB, AdmissionControlledChecker, LoginRejected)
 from swftp.swift import UnAuthenticated
 
 
@@ -73,12 +74,27 @@ class AuthenticateTest(unittest.TestCase):
             self.assertEquals(conn.pool.maxPersistentPerHost, 2)
             self.assertEquals(conn.pool.persistent, False)
             self.assertEquals(conn.locks, [])
+            self.assertEquals(conn.scheduler, None)
+            self.assertEquals(conn.metadata_locks, None)
 
         creds = UsernamePassword('username', 'password')
         d = auth_db.requestAvatarId(creds)
         d.addCallback(check_connection)
         return d
 
+    @patch('swftp.auth.ThrottledSwiftConnection.authenticate',
+           authenticate_good)
+    def test_shared_scheduler(self):
+        creds = UsernamePassword('username', 'password')
+        conn1 = self.successResultOf(self.auth_db.requestAvatarId(creds))
+        conn2 = self.successResultOf(self.auth_db.requestAvatarId(creds))
+        self.assertIdentical(conn1.scheduler, self.auth_db.scheduler)
+        self.assertIdentical(conn2.scheduler, self.auth_db.scheduler)
+        self.assertEqual(self.auth_db.scheduler.max_concurrency, 100)
+        self.assertEqual(conn1.pool.maxPersistentPerHost, 12)
+        self.assertEqual(len(conn1.metadata_locks), 1)
+        self.assertNotIdentical(conn1.locks[0], conn2.locks[0])
+
     @patch('swftp.auth.ThrottledSwiftConnection.authenticate',
            authenticate_bad)
     def test_request_avatar_id_fail(self):
@@ -146,3 +162,61 @@ class StorageUrlRewriteTest(unittest.TestCase):
 
         self.assertEquals(swift_conn.storage_url,
                           'https://hostname:1234/v1/AUTH_12345')
+
+
+class StubChecker(object):
+    credentialInterfaces = SwiftBasedAuthDB.credentialInterfaces
+
+    def __init__(self):
+        self.pending = []
+
+    def requestAvatarId(self, c):
+        d = defer.Deferred()
+        self.pending.append((c.username, d))
+        return d
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = StubChecker()
+        self.checker = AdmissionControlledChecker(
+            self.stub, max_in_flight=1, max_queued=1, queue_timeout=10,
+            clock=self.clock)
+
+    def login(self, username):
+        return self.checker.requestAvatarId(
+            UsernamePassword(username, 'password'))
+
+    def test_queue(self):
+        first = self.login('first')
+        second = self.login('second')
+        self.assertEqual([u for u, _ in self.stub.pending], ['first'])
+        self.assertEqual(len(self.checker.queue), 1)
+
+        # The queued login starts once the first one is done
+        self.clock.advance(2)
+        self.stub.pending.pop(0)[1].callback('first')
+        self.assertEqual(self.successResultOf(first), 'first')
+        self.assertEqual([u for u, _ in self.stub.pending], ['second'])
+        self.assertEqual(len(self.checker.queue), 0)
+
+        self.stub.pending.pop(0)[1].errback(UnauthorizedLogin())
+        self.failureResultOf(second, UnauthorizedLogin)
+        self.assertEqual(self.checker.in_flight, 0)
+
+    def test_queue_full(self):
+        self.login('first')
+        self.login('second')
+        self.failureResultOf(self.login('third'), LoginRejected)
+
+    def test_queue_timeout(self):
+        self.login('first')
+        second = self.login('second')
+        self.clock.advance(10)
+        self.failureResultOf(second, LoginRejected)
+        self.assertEqual(len(self.checker.queue), 0)
+
+        # The timed out login is not started later
+        self.stub.pending.pop(0)[1].callback('first')
+        self.assertEqual(self.stub.pending, [])
@@ -0,0 +1,22 @@
+"""
+See COPYING for license information.
+"""
+from twisted.trial import unittest
+
+from swftp.buffers import BufferGovernor
+
+
+class BufferGovernorTest(unittest.TestCase):
+    def test_wait_for_space(self):
+        governor = BufferGovernor(100, resume_ratio=0.5)
+        governor.reserve(60)
+        self.assertTrue(governor.waitForSpace().called)
+
+        governor.reserve(40)
+        self.assertTrue(governor.full())
+        d = governor.waitForSpace()
+        governor.release(40)
+        self.assertFalse(d.called)
+        governor.release(20)
+        self.assertTrue(d.called)
+        self.assertEqual(governor.used, 40)
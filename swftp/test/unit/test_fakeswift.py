@@ -0,0 +1,149 @@
+"""
+See COPYING for license information.
+"""
+import hashlib
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.web.client import FileBodyProducer, HTTPConnectionPool
+from StringIO import StringIO
+
+from swftp.fakeswift import (
+    FakeSwift, FakeSwiftSite, HTTPError, listing, parse_range)
+from swftp.swift import (
+    SwiftConnection, cb_recv_resp, NotFound, Conflict, RequestError,
+    UnAuthenticated)
+
+
+class ListingTest(unittest.TestCase):
+    names = ['a', 'b/1', 'b/2', 'b/c/3', 'c']
+
+    def test_prefix_delimiter(self):
+        self.assertEqual(
+            listing(self.names, {'delimiter': ['/']}),
+            ['a', (True, 'b/'), 'c'])
+        self.assertEqual(
+            listing(self.names, {'prefix': ['b/'], 'delimiter': ['/']}),
+            ['b/1', 'b/2', (True, 'b/c/')])
+        self.assertEqual(listing(self.names, {'path': ['b']}), ['b/1', 'b/2'])
+
+    def test_marker_limit(self):
+        self.assertEqual(
+            listing(self.names, {'marker': ['b/1'], 'limit': ['2']}),
+            ['b/2', 'b/c/3'])
+        self.assertEqual(
+            listing(self.names, {'marker': ['a'], 'end_marker': ['b/2']}),
+            ['b/1'])
+        self.assertEqual(
+            listing(self.names, {'marker': ['b/'], 'delimiter': ['/']}),
+            ['c'])
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 100))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 100))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 100))
+        self.assertEqual(parse_range('bytes=0-1,5-6', 100), None)
+        self.assertEqual(parse_range('bytes=0-', 0), None)
+        self.assertRaises(HTTPError, parse_range, 'bytes=100-', 100)
+
+
+class FakeSwiftTest(unittest.TestCase):
+    " Drives the fake with the swift client over loopback "
+    def setUp(self):
+        self.swift = FakeSwift()
+        self.port = reactor.listenTCP(
+            0, FakeSwiftSite(self.swift), interface='127.0.0.1')
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.conn = SwiftConnection(
+            'http://127.0.0.1:%s/auth/v1.0' % self.port.getHost().port,
+            'test:tester', 'testing', pool=self.pool)
+        self.addCleanup(self.port.stopListening)
+        return self.conn.authenticate()
+
+    def put(self, container, name, data, headers=None, params=None):
+        body = FileBodyProducer(StringIO(data))
+        d = self.conn.make_request(
+            'PUT', '%s/%s' % (container, name), params=params,
+            headers=headers, body=body)
+        d.addCallback(cb_recv_resp, load_body=True)
+        return d
+
+    def get(self, container, name, headers=None, params=None):
+        d = self.conn.make_request(
+            'GET', '%s/%s' % (container, name), params=params,
+            headers=headers)
+        d.addCallback(cb_recv_resp, load_body=True)
+        return d
+
+    @defer.inlineCallbacks
+    def test_auth(self):
+        self.assertEqual(self.swift.accounts.keys(), ['AUTH_test'])
+        self.assertTrue(self.conn.storage_url.endswith('/v1/AUTH_test'))
+        self.swift.users = {'test:tester': 'other'}
+        yield self.assertFailure(self.conn.authenticate(), UnAuthenticated)
+
+    @defer.inlineCallbacks
+    def test_crud(self):
+        yield self.conn.put_container('c')
+        resp, _ = yield self.put('c', 'dir/o', 'data',
+                                 headers={'X-Object-Meta-Color': 'blue'})
+        self.assertEqual(resp.code, 201)
+        self.assertEqual(resp.headers['etag'], hashlib.md5('data').hexdigest())
+
+        resp, body = yield self.get('c', 'dir/o')
+        self.assertEqual(body, 'data')
+        self.assertEqual(resp.headers['x-object-meta-color'], 'blue')
+
+        _, objects = yield self.conn.get_container('c', delimiter='/')
+        self.assertEqual(objects, [{'subdir': 'dir/'}])
+        headers = yield self.conn.head_account()
+        self.assertEqual(headers['x-account-bytes-used'], '4')
+
+        yield self.assertFailure(self.conn.delete_container('c'), Conflict)
+        yield self.conn.delete_object('c', 'dir/o')
+        yield self.assertFailure(self.get('c', 'dir/o'), NotFound)
+        yield self.conn.delete_container('c')
+
+    @defer.inlineCallbacks
+    def test_range_and_copy(self):
+        yield self.conn.put_container('c')
+        yield self.put('c', 'o', '0123456789')
+        resp, body = yield self.get('c', 'o', headers={'Range': 'bytes=2-4'})
+        self.assertEqual((resp.code, body), (206, '234'))
+        self.assertEqual(resp.headers['content-range'], 'bytes 2-4/10')
+        yield self.assertFailure(
+            self.get('c', 'o', headers={'Range': 'bytes=20-'}), RequestError)
+
+        yield self.conn.put_object(
+            'c', 'copy', headers={'X-Copy-From': '/c/o'})
+        _, body = yield self.get('c', 'copy')
+        self.assertEqual(body, '0123456789')
+
+    @defer.inlineCallbacks
+    def test_large_objects(self):
+        yield self.conn.put_container('c')
+        yield self.put('c', 'seg/1', 'abc')
+        yield self.put('c', 'seg/2', 'def')
+        yield self.conn.put_object(
+            'c', 'dlo', headers={'X-Object-Manifest': 'c/seg/'})
+        _, body = yield self.get('c', 'dlo')
+        self.assertEqual(body, 'abcdef')
+
+        manifest = [
+            {'path': '/c/seg/2', 'etag': hashlib.md5('def').hexdigest(),
+             'size_bytes': 3},
+            {'path': '/c/seg/1', 'etag': None, 'size_bytes': None}]
+        params = {'multipart-manifest': 'put'}
+        yield self.put('c', 'slo', json.dumps(manifest), params=params)
+        resp, body = yield self.get('c', 'slo', headers={'Range': 'bytes=2-'})
+        self.assertEqual(body, 'fabc')
+        self.assertEqual(resp.headers['x-static-large-object'], 'True')
+
+        manifest[1]['size_bytes'] = 4
+        yield self.assertFailure(
+            self.put('c', 'slo', json.dumps(manifest), params=params),
+            RequestError)
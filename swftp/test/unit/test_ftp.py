@@ -3,10 +3,24 @@ See COPYING for license information.
 """
 import os.path
 import socket
+import time
 
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.protocols.ftp import (
+    DTP, FTPFactory, CmdNotImplementedForArgError)
+from twisted.cred.portal import Portal
+from twisted.python.filepath import Permissions
+from twisted.test.proto_helpers import StringTransport
 
+from swftp.auth import SwiftBasedAuthDB, LoginRejected
 from swftp.ftp.service import makeService, Options
+from swftp.realm import SwftpRealm
+from swftp.ftp.server import (
+    ListFormatter, ListingProducer, FactsFormatter, SwftpFTPProtocol,
+    SwiftFTPShell, stat_format)
+from swftp.swiftfilesystem import ListingEntry
+from swftp.utils import OrderedDict
 
 
 TEST_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -28,3 +42,279 @@ class FTPServiceTest(unittest.TestCase):
     def test_service_listen(self):
         sock = socket.socket()
         sock.connect(('127.0.0.1', 6021))
+
+
+LIST_KEYS = ('size', 'directory', 'permissions', 'hardlinks', 'modified',
+             'owner', 'group')
+
+
+class StubConsumer(object):
+    def __init__(self):
+        self.data = []
+        self.producer = None
+        self.unregistered = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.unregistered = True
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class ListFormatterTest(unittest.TestCase):
+    entries = [
+        ListingEntry('dir'),
+        ListingEntry('file', content_type='text/plain', size=1234567890,
+                     last_modified='2008-04-10T13:30:00.1234'),
+        ListingEntry('recent', content_type='text/plain', size=1,
+                     last_modified=time.strftime(
+                         '%Y-%m-%dT%H:%M:%S', time.gmtime())),
+    ]
+
+    def test_matches_dtp(self):
+        formatter = ListFormatter()
+        for entry in self.entries:
+            size, directory, mode, hardlinks, modified, owner, group = \
+                stat_format(LIST_KEYS, entry)
+            expected = DTP()._formatOneListResponse(
+                entry.name, size, directory, Permissions(mode), hardlinks,
+                modified, owner, group)
+            self.assertEqual(formatter.line(entry.name, entry), expected)
+
+
+class ListingProducerTest(unittest.TestCase):
+    def test_blocks(self):
+        listing = OrderedDict(
+            ('name%s' % i, ListingEntry('name%s' % i)) for i in range(1000))
+        consumer = StubConsumer()
+        producer = ListingProducer(
+            listing, lambda name, entry: name, consumer)
+        producer.block_size = 1024
+        d = producer.start()
+        self.assertEqual(consumer.producer, producer)
+        while not d.called:
+            producer.resumeProducing()
+        self.assertTrue(consumer.unregistered)
+        self.assertTrue(len(consumer.data) > 1)
+        self.assertEqual(''.join(consumer.data),
+                         ''.join('%s\r\n' % name for name in listing))
+        return d
+
+    def test_stop(self):
+        consumer = StubConsumer()
+        producer = ListingProducer(
+            OrderedDict([('a', ListingEntry('a'))]),
+            lambda name, entry: name, consumer)
+        d = producer.start()
+        producer.stopProducing()
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class FactsFormatterTest(unittest.TestCase):
+    def test_file(self):
+        entry = ListingEntry(
+            'file', content_type='text/plain', size=12,
+            last_modified='2008-04-10T13:30:00.1234',
+            hash='4281c348eaf83e70ddce0e07221c3d28')
+        self.assertEqual(
+            FactsFormatter().line(entry.name, entry),
+            'type=file;size=12;perm=rwfd;media-type=text/plain;'
+            'x.md5=4281c348eaf83e70ddce0e07221c3d28;'
+            'modify=20080410133000; file')
+
+    def test_manifest(self):
+        # A DLO manifest lists the MD5 of its empty body, an SLO the ETag of
+        # its manifest. Neither is the MD5 of the content.
+        for item in [
+                {'name': 'file', 'bytes': 0, 'content_type': 'text/plain',
+                 'hash': 'd41d8cd98f00b204e9800998ecf8427e',
+                 'last_modified': '2008-04-10T13:30:00.1234'},
+                {'name': 'file', 'bytes': 12, 'content_type': 'text/plain',
+                 'hash': '"4281c348eaf83e70ddce0e07221c3d28"',
+                 'slo_etag': '"4281c348eaf83e70ddce0e07221c3d28"',
+                 'last_modified': '2008-04-10T13:30:00.1234'}]:
+            entry = ListingEntry.from_object(item)
+            self.assertNotIn(
+                'x.md5', FactsFormatter().line(entry.name, entry))
+
+    def test_directory(self):
+        entry = ListingEntry('dir', last_modified='2008-04-10T13:30:00')
+        self.assertEqual(
+            FactsFormatter().line(entry.name, entry),
+            'type=dir;perm=elcmfd;modify=20080410133000; dir')
+
+
+class StubShell(object):
+    def __init__(self, props):
+        self.props = props
+        self.stats = []
+
+    def stat(self, path, keys=()):
+        self.stats.append(path)
+        return defer.succeed(stat_format(keys, self.props))
+
+
+class MLSTTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = SwftpFTPProtocol()
+        self.transport = StringTransport()
+        self.protocol.transport = self.transport
+        self.protocol.workingDirectory = ['container']
+        self.protocol.shell = StubShell({
+            'size': '12', 'content_type': 'text/plain',
+            'last_modified': 'Thu, 10 Apr 2008 13:30:00 GMT',
+            'hash': '4281c348eaf83e70ddce0e07221c3d28'})
+
+    def test_mlst(self):
+        d = self.protocol.ftp_MLST('file')
+
+        def check(result):
+            self.assertEqual(self.protocol.shell.stats,
+                             [['container', 'file']])
+            self.assertEqual(
+                self.transport.value(),
+                '250- Listing /container/file\r\n'
+                ' type=file;size=12;perm=rwfd;media-type=text/plain;'
+                'x.md5=4281c348eaf83e70ddce0e07221c3d28;'
+                'modify=20080410133000; /container/file\r\n')
+            self.assertEqual(result[0], '250')
+        d.addCallback(check)
+        return d
+
+    def test_feat(self):
+        self.assertIn(FactsFormatter.FEATURE, SwftpFTPProtocol.FEATURES)
+
+
+class StubSwiftConnection(object):
+    username = 'user'
+
+    def __init__(self):
+        self.heads = []
+
+    def get_container(self, container, marker=None, **kwargs):
+        if marker:
+            return defer.succeed((None, []))
+        return defer.succeed((None, [
+            {u'name': u'file', u'bytes': 12, u'content_type': u'text/plain',
+             u'last_modified': u'2008-04-10T13:30:00'}]))
+
+    def head_object(self, container, path):
+        self.heads.append(path)
+        return defer.succeed({
+            'content-length': '12', 'content-type': 'text/plain',
+            'last-modified': 'Thu, 10 Apr 2008 13:30:00 GMT',
+            'etag': '4281c348eaf83e70ddce0e07221c3d28'})
+
+
+class ShellStatTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = StubSwiftConnection()
+        self.shell = SwiftFTPShell(self.conn)
+
+    @defer.inlineCallbacks
+    def test_stat_after_list(self):
+        yield self.shell.listing(['container'])
+        result = yield self.shell.stat(['container', 'file'], ('size',))
+        self.assertEqual(result, [12])
+        self.assertEqual(self.conn.heads, [])
+
+    @defer.inlineCallbacks
+    def test_stat_miss(self):
+        yield self.shell.listing(['container'])
+        result = yield self.shell.stat(['other', 'file'], ('size',))
+        self.assertEqual(result, [12])
+        self.assertEqual(self.conn.heads, ['file'])
+
+    @defer.inlineCallbacks
+    def test_invalidated_by_writes(self):
+        yield self.shell.listing(['container'])
+        yield self.shell.openForWriting(['container', 'file'])
+        yield self.shell.stat(['container', 'file'], ('size',))
+        self.assertEqual(self.conn.heads, ['file'])
+
+
+class HashTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = SwftpFTPProtocol()
+        self.transport = StringTransport()
+        self.protocol.transport = self.transport
+        self.protocol.workingDirectory = ['container']
+        self.conn = StubSwiftConnection()
+        self.protocol.shell = SwiftFTPShell(self.conn)
+
+    @defer.inlineCallbacks
+    def test_hash(self):
+        result = yield self.protocol.ftp_HASH('file')
+        self.protocol.reply(*result)
+        self.assertEqual(
+            self.transport.value(),
+            '213 MD5 0-12 4281c348eaf83e70ddce0e07221c3d28 file\r\n')
+
+    @defer.inlineCallbacks
+    def test_xmd5(self):
+        yield self.protocol.ftp_XMD5('file')
+        self.assertEqual(
+            self.transport.value(),
+            '250 4281c348eaf83e70ddce0e07221c3d28\r\n')
+
+
+class StubWriteShell(object):
+    def __init__(self):
+        self.opened = []
+
+    def openForWriting(self, path, offset=0):
+        self.opened.append((path, offset))
+        return defer.fail(CmdNotImplementedForArgError('stub'))
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = SwftpFTPProtocol()
+        self.protocol.transport = StringTransport()
+        self.protocol.factory = FTPFactory()
+        self.protocol.factory.timeOut = None
+        self.protocol.workingDirectory = ['container']
+        self.protocol.dtpInstance = DTP()
+        self.protocol.shell = StubWriteShell()
+
+    @defer.inlineCallbacks
+    def test_rest_stor(self):
+        self.protocol.ftp_REST('10')
+        yield self.protocol.ftp_STOR('file')
+        yield self.protocol.ftp_STOR('file')
+        self.assertEqual(self.protocol.shell.opened, [
+            (['container', 'file'], 10), (['container', 'file'], 0)])
+
+    @defer.inlineCallbacks
+    def test_appe(self):
+        yield self.protocol.ftp_APPE('file')
+        self.assertEqual(self.protocol.shell.opened, [
+            (['container', 'file'], None)])
+
+
+class RejectingChecker(object):
+    credentialInterfaces = SwiftBasedAuthDB.credentialInterfaces
+
+    def requestAvatarId(self, c):
+        return defer.fail(LoginRejected('Too many logins in progress'))
+
+
+class LoginRejectedTest(unittest.TestCase):
+    def test_rejected(self):
+        portal = Portal(SwftpRealm())
+        portal.registerChecker(RejectingChecker())
+        protocol = SwftpFTPProtocol()
+        protocol.factory = FTPFactory(portal)
+        protocol.portal = portal
+        protocol.transport = StringTransport()
+        protocol.ftp_USER('user')
+        protocol.transport.clear()
+        d = protocol.ftp_PASS('password')
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(
+            protocol.transport.value(),
+            '421 Service not available, closing control connection.\r\n')
+        self.assertTrue(protocol.transport.disconnecting)
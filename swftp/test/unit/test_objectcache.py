@@ -0,0 +1,160 @@
+"""
+See COPYING for license information.
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+from twisted.web.http_headers import Headers
+
+from swftp.objectcache import ObjectCache
+from swftp.swift import NotModified
+from swftp.swiftfilesystem import SwiftFileSystem
+
+
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = ObjectCache(4, max_object_size=3,
+                                 directory=self.directory, disk_size=5)
+
+    def test_too_large(self):
+        self.cache.put('a', 'etag', 'abcd')
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_tiers(self):
+        self.cache.put('a', 'etag-a', 'aaa')
+        self.cache.put('b', 'etag-b', 'bb')
+        self.assertEqual(self.cache.memory.keys(), ['b'])
+        self.assertEqual(self.cache.disk.keys(), ['a'])
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        self.assertEqual(self.cache.get('a'), ('etag-a', 'aaa'))
+        self.assertEqual(self.cache.memory.keys(), ['a'])
+        self.assertEqual(self.cache.disk.keys(), ['b'])
+
+        self.cache.put('c', 'etag-c', 'ccc')
+        self.cache.put('d', 'etag-d', 'ddd')
+        # 'b' was the least recently used entry on disk
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.disk_used, 3)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_discard(self):
+        self.cache.put('a', 'etag-a', 'aaa')
+        self.cache.put('b', 'etag-b', 'bb')
+        self.cache.discard('a')
+        self.cache.discard('b')
+        self.assertEqual((self.cache.memory_used, self.cache.disk_used),
+                         (0, 0))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_missing_file(self):
+        self.cache.put('a', 'etag-a', 'aaa')
+        self.cache.put('b', 'etag-b', 'bb')
+        os.unlink(self.cache._diskPath('a'))
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.disk_used, 0)
+        self.cache.put('a', 'etag-a', 'aaa')
+        os.unlink(self.cache._diskPath('b'))
+        self.cache.discard('b')
+        self.assertEqual(self.cache.disk.keys(), [])
+
+    def test_write_error(self):
+        os.rmdir(self.directory)
+        self.cache.put('a', 'etag-a', 'aaa')
+        self.cache.put('b', 'etag-b', 'bb')
+        self.assertEqual(self.cache.disk.keys(), [])
+        self.assertEqual(self.cache.get('a'), None)
+        os.mkdir(self.directory)
+
+    def test_clear_directory(self):
+        self.cache.put('a', 'etag-a', 'aaa')
+        self.cache.put('b', 'etag-b', 'bb')
+        open(os.path.join(self.directory, 'other'), 'w').close()
+        ObjectCache(4, directory=self.directory, disk_size=5)
+        self.assertEqual(os.listdir(self.directory), ['other'])
+
+
+class StubResponse(object):
+    def __init__(self, code, headers=None):
+        self.code = code
+        self.headers = Headers(headers or {})
+
+
+class StubBodyConnection(object):
+    storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+
+    def __init__(self, response, body=''):
+        self.response = response
+        self.body = body
+        self.requests = []
+
+    def get_object(self, container, path, headers=None, receiver=None,
+                   if_none_match=None):
+        self.requests.append(if_none_match)
+        if self.response.code == 304:
+            return defer.fail(NotModified(304, ''))
+        receiver.makeConnection(None)
+        if self.body:
+            receiver.dataReceived(self.body)
+        receiver.connectionLost(Failure(ResponseDone()))
+        return defer.succeed(self.response)
+
+
+class StubDownload(Protocol):
+    def __init__(self):
+        self.data = []
+        self.finished = defer.Deferred()
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.finished.callback(''.join(self.data))
+
+
+class CachingReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ObjectCache(1024)
+        self.fs = SwiftFileSystem(None)
+        self.fs.object_cache = self.cache
+        self.key = (StubBodyConnection.storage_url, '/c/obj')
+
+    def download(self, response, body=''):
+        self.fs.swiftconn = StubBodyConnection(response, body)
+        consumer = StubDownload()
+        self.fs.startFileDownload('/c/obj', consumer)
+        return consumer.finished
+
+    @defer.inlineCallbacks
+    def test_miss(self):
+        response = StubResponse(200, {
+            'etag': ['"abc"'], 'content-length': ['4']})
+        data = yield self.download(response, 'data')
+        self.assertEqual(data, 'data')
+        self.assertEqual(self.fs.swiftconn.requests, [None])
+        self.assertEqual(self.cache.get(self.key), ('abc', 'data'))
+
+    @defer.inlineCallbacks
+    def test_not_modified(self):
+        self.cache.put(self.key, 'abc', 'cached')
+        data = yield self.download(StubResponse(304))
+        self.assertEqual(data, 'cached')
+        self.assertEqual(self.fs.swiftconn.requests, ['abc'])
+
+    @defer.inlineCallbacks
+    def test_modified(self):
+        self.cache.put(self.key, 'abc', 'cached')
+        response = StubResponse(200, {
+            'etag': ['def'], 'content-length': ['3'],
+            'x-object-manifest': ['c_segments/obj//']})
+        data = yield self.download(response, 'new')
+        self.assertEqual(data, 'new')
+        self.assertEqual(self.cache.get(self.key), None)
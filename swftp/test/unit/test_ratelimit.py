@@ -0,0 +1,87 @@
+"""
+See COPYING for license information.
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from swftp.ratelimit import (
+    TokenBucket, Throttle, RateLimiter, ThrottledConsumer)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_consume(self):
+        clock = task.Clock()
+        bucket = TokenBucket(100, clock=clock)
+        self.assertEqual(bucket.consume(100), 0)
+        self.assertEqual(bucket.consume(50), 0.5)
+
+        clock.advance(1)
+        self.assertEqual(bucket.consume(50), 0)
+
+    def test_burst(self):
+        clock = task.Clock()
+        bucket = TokenBucket(100, burst=200, clock=clock)
+        clock.advance(10)
+        self.assertEqual(bucket.consume(200), 0)
+        self.assertEqual(bucket.consume(100), 1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_unlimited(self):
+        throttle = RateLimiter().throttle('user')
+        self.assertEqual(throttle.buckets, [])
+        self.assertIdentical(throttle.consume(1024), None)
+
+    def test_user_buckets(self):
+        limiter = RateLimiter(
+            1000, user_rate=100, user_rates={'backup': 500, 'admin': 0})
+        user = limiter.throttle('user')
+        self.assertEqual([b.rate for b in user.buckets], [1000, 100])
+        # Transfers of a user share a bucket
+        self.assertIdentical(
+            limiter.throttle('user').buckets[1], user.buckets[1])
+        self.assertEqual(
+            [b.rate for b in limiter.throttle('backup').buckets], [1000, 500])
+        self.assertEqual(
+            [b.rate for b in limiter.throttle('admin').buckets], [1000])
+
+
+class StubProducer(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class ThrottledConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = StringTransport()
+        self.consumer = ThrottledConsumer(
+            self.transport,
+            Throttle([TokenBucket(100, clock=self.clock)], clock=self.clock))
+        self.producer = StubProducer()
+        self.consumer.registerProducer(self.producer, True)
+
+    def test_throttle(self):
+        self.consumer.write('x' * 100)
+        self.assertFalse(self.producer.paused)
+        self.consumer.write('x' * 50)
+        self.assertTrue(self.producer.paused)
+        self.assertEqual(len(self.transport.value()), 150)
+
+        self.clock.advance(0.5)
+        self.assertFalse(self.producer.paused)
+
+    def test_consumer_paused(self):
+        self.consumer.write('x' * 150)
+        self.consumer.pauseProducing()
+        self.clock.advance(0.5)
+        # Still paused by the consumer
+        self.assertTrue(self.producer.paused)
+        self.consumer.resumeProducing()
+        self.assertFalse(self.producer.paused)
@@ -0,0 +1,65 @@
+"""
+See COPYING for license information.
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+
+from swftp.scheduler import FairScheduler
+
+
+class FairSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.started = []
+
+    def request(self, scheduler, user, priority='transfer'):
+        d = scheduler.acquire(user, priority)
+        d.addCallback(lambda _: self.started.append(user))
+
+    def test_limit(self):
+        scheduler = FairScheduler(2, clock=self.clock)
+        for _ in range(3):
+            self.request(scheduler, 'user')
+        self.assertEqual(self.started, ['user', 'user'])
+        self.assertEqual(scheduler.waiting, 1)
+
+        scheduler.release()
+        self.assertEqual(len(self.started), 3)
+        self.assertEqual(scheduler.in_flight, 2)
+        self.assertEqual(scheduler.waiting, 0)
+
+    def test_round_robin(self):
+        scheduler = FairScheduler(1, clock=self.clock)
+        self.request(scheduler, 'heavy')
+        for _ in range(3):
+            self.request(scheduler, 'heavy')
+        self.request(scheduler, 'light')
+        for _ in range(5):
+            scheduler.release()
+        self.assertEqual(
+            self.started, ['heavy', 'heavy', 'light', 'heavy', 'heavy'])
+
+    def test_priority(self):
+        scheduler = FairScheduler(1, clock=self.clock)
+        self.request(scheduler, 'user')
+        self.request(scheduler, 'user', 'transfer')
+        self.request(scheduler, 'other', 'metadata')
+        scheduler.release()
+        scheduler.release()
+        self.assertEqual(self.started, ['user', 'other', 'user'])
+
+    def test_weights(self):
+        scheduler = FairScheduler(
+            1, weights={'backup': 2, 'guest': 0.5}, clock=self.clock)
+        self.request(scheduler, 'first')
+        for _ in range(4):
+            self.request(scheduler, 'backup')
+            self.request(scheduler, 'guest')
+        for _ in range(5):
+            scheduler.release()
+        # The guest gets a turn every other round
+        self.assertEqual(self.started, [
+            'first', 'backup', 'backup', 'backup', 'backup', 'guest'])
+
+    def test_invalid_weight(self):
+        self.assertRaises(ValueError, FairScheduler, 1, weights={'user': 0})
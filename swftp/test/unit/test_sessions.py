@@ -0,0 +1,180 @@
+"""
+See COPYING for license information.
+"""
+import os
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from swftp.sessions import (
+    LocalSessionCounter, SessionCountServerProtocol, RemoteSessionCounter,
+    SessionCountServerFactory, SharedSessionCounter, TCPSessionCounter,
+    SessionCounterFull)
+
+
+class LocalSessionCounterTest(unittest.TestCase):
+    def test_acquire_release(self):
+        counter = LocalSessionCounter()
+        self.assertEqual(self.successResultOf(counter.acquire('user')), 1)
+        self.assertEqual(self.successResultOf(counter.acquire('user')), 2)
+        counter.release('user')
+        counter.release('user')
+        self.assertEqual(counter.counts, {})
+
+
+class RemoteSessionCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.counter = LocalSessionCounter()
+        self.server = SessionCountServerProtocol(self.counter)
+        self.server_transport = StringTransport()
+        self.server.makeConnection(self.server_transport)
+        self.remote = RemoteSessionCounter()
+        self.remote_transport = StringTransport()
+        self.remote.makeConnection(self.remote_transport)
+
+    def exchange(self):
+        " Delivers the requests and the answers that are in flight "
+        request = self.remote_transport.value()
+        self.remote_transport.clear()
+        self.server.dataReceived(request)
+        answer = self.server_transport.value()
+        self.server_transport.clear()
+        self.remote.dataReceived(answer)
+
+    def test_acquire_release(self):
+        d1 = self.remote.acquire('user')
+        d2 = self.remote.acquire('user')
+        self.exchange()
+        self.assertEqual(self.successResultOf(d1), 1)
+        self.assertEqual(self.successResultOf(d2), 2)
+
+        self.remote.release('user')
+        self.exchange()
+        self.assertEqual(self.counter.counts, {'user': 1})
+
+    def test_release_on_disconnect(self):
+        self.remote.acquire('user')
+        self.remote.acquire('other')
+        self.exchange()
+        self.assertEqual(self.counter.counts, {'user': 1, 'other': 1})
+
+        self.server.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.counter.counts, {})
+
+    def test_unknown_release(self):
+        self.remote.release('user')
+        self.exchange()
+        self.assertEqual(self.counter.counts, {})
+
+    def test_connection_lost(self):
+        d = self.remote.acquire('user')
+        self.remote.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        self.successResultOf(self.remote.lost)
+        self.failureResultOf(self.remote.acquire('user'), ConnectionLost)
+
+
+class SharedSessionCounterTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def test_shared(self):
+        counter = SharedSessionCounter(self.path, slots=4)
+        other = SharedSessionCounter(self.path, slots=4)
+        self.assertEqual(self.successResultOf(counter.acquire('user')), 1)
+        self.assertEqual(self.successResultOf(other.acquire('user')), 2)
+        self.assertEqual(self.successResultOf(other.acquire('other')), 1)
+        counter.release('user')
+        self.assertEqual(self.successResultOf(counter.acquire('user')), 2)
+
+    def test_full(self):
+        counter = SharedSessionCounter(self.path, slots=1)
+        counter.acquire('user')
+        self.failureResultOf(counter.acquire('user'), SessionCounterFull)
+        counter.release('user')
+        self.successResultOf(counter.acquire('user'))
+
+    def test_dead_process(self):
+        counter = SharedSessionCounter(self.path, slots=2)
+        counter.acquire('user')
+        # A session of a process that has exited
+        dead_pid = 2 ** 31 - 1
+        entry = counter.map[:counter.slot.size]
+        counter.map[:counter.slot.size] = counter.slot.pack(
+            dead_pid, counter.slot.unpack(entry)[1])
+        self.assertEqual(self.successResultOf(counter.acquire('user')), 1)
+        self.successResultOf(counter.acquire('user'))
+
+
+class TCPSessionCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.counter = LocalSessionCounter()
+        self.port = reactor.listenTCP(
+            0, SessionCountServerFactory(self.counter),
+            interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+    def connect(self):
+        factory = TCPSessionCounter()
+        connected = defer.Deferred()
+
+        def counterConnected(counter):
+            TCPSessionCounter.counterConnected(factory, counter)
+            connected.callback(counter)
+        factory.counterConnected = counterConnected
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        return connected.addCallback(lambda _: factory)
+
+    @defer.inlineCallbacks
+    def test_lease(self):
+        factory = yield self.connect()
+        self.assertEqual((yield factory.acquire('user')), 1)
+        self.assertEqual(self.counter.counts, {'user': 1})
+
+        # The sessions are released with the connection
+        factory.stopTrying()
+        lost = factory.counter.lost
+        factory.counter.transport.loseConnection()
+        yield lost
+        while self.counter.counts:
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+
+    def test_not_connected(self):
+        factory = TCPSessionCounter()
+        self.failureResultOf(factory.acquire('user'), ConnectionLost)
+
+    def test_failed_acquire(self):
+        factory = TCPSessionCounter()
+        counter = factory.buildProtocol(None)
+        counter.makeConnection(StringTransport())
+        d = factory.acquire('user')
+        self.assertEqual(dict(factory.held), {})
+        counter.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        # The session isn't counted again after reconnecting
+        self.assertEqual(dict(factory.held), {})
+
+        counter = factory.buildProtocol(None)
+        counter.makeConnection(StringTransport())
+        d = factory.acquire('user')
+        counter.lineReceived('1')
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(dict(factory.held), {'user': 1})
+
+    def test_reconnect(self):
+        # Sessions that are still open are counted again
+        factory = TCPSessionCounter()
+        factory.held['user'] = 2
+        counter = factory.buildProtocol(None)
+        transport = StringTransport()
+        counter.makeConnection(transport)
+        self.assertEqual(transport.value(), 'ACQUIRE user\nACQUIRE user\n')
+        self.assertIdentical(factory.counter, counter)
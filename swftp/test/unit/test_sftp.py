@@ -3,11 +3,39 @@ See COPYING for license information.
 """
 import os.path
 import socket
+import struct
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from twisted.conch import ls
+from twisted.conch.ssh.common import NS
+from twisted.conch.ssh.factory import SSHFactory
+from twisted.conch.ssh.keys import Key
+from twisted.conch.ssh.transport import SSHClientTransport
+from twisted.conch.ssh.filetransfer import (
+    SFTPError, FX_FILE_ALREADY_EXISTS, FX_PERMISSION_DENIED, FXF_READ,
+    FXF_WRITE)
 
 from twisted.trial import unittest
-from twisted.internet import threads, defer
+from twisted.internet import threads, defer, task, reactor, protocol
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
 
-from swftp.sftp.service import makeService, Options
+from swftp.buffers import BufferGovernor
+from swftp.ratelimit import Throttle, TokenBucket
+from swftp.sftp.service import makeService, Options, parse_algorithms
+from swftp.sftp import server as sftp_server
+from swftp.sftp.server import (
+    SFTPServerForSwiftConchUser, SwiftSSHServerTransport)
+from swftp.sftp.swiftfile import (
+    SwiftFile, SwiftFileWriter, SwiftFileReceiver, SwiftFileSender,
+    ReadAheadBudget)
+from swftp.swift import NotFound
+from swftp.sftp.swiftdirectory import LsLineRenderer, SwiftDirectory
+from swftp.swiftfilesystem import (
+    ListingEntry, SwiftFileSystem, SwiftWriteFile)
 
 
 TEST_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -36,3 +64,536 @@ class SFTPServiceTest(unittest.TestCase):
 
     def test_service_listen(self):
         return threads.deferToThread(self._defer_test_service_listen)
+
+
+class LsLineRendererTest(unittest.TestCase):
+    entries = [
+        ListingEntry('dir'),
+        ListingEntry('container', count=123456, size=10),
+        ListingEntry('file', content_type='text/plain', size=1234567890,
+                     last_modified='2008-04-10T13:30:00.1234'),
+        ListingEntry('recent', content_type='text/plain', size=1,
+                     last_modified=time.strftime(
+                         '%Y-%m-%dT%H:%M:%S', time.localtime())),
+    ]
+
+    def test_matches_lsLine(self):
+        renderer = LsLineRenderer()
+        for entry in self.entries:
+            name, longname, attrs = renderer.render(entry.name, entry)
+            self.assertEqual(name, entry.name)
+            self.assertEqual(longname, ls.lsLine(entry.name, entry.stat()))
+            self.assertEqual(attrs['size'], entry.stat().st_size)
+            self.assertEqual(attrs['permissions'], entry.stat().st_mode)
+
+    def test_directory_pages(self):
+        directory = SwiftDirectory(None, '/container')
+        directory.page_size = 3
+        for entry in self.entries:
+            directory.files[entry.name] = entry
+        names = [name for name, _, _ in directory]
+        self.assertEqual(
+            names, ['.', '..', 'dir', 'container', 'file', 'recent'])
+
+
+class StubHeadConnection(object):
+    def __init__(self, headers, account_headers=None):
+        self.headers = headers
+        self.account_headers = account_headers or {}
+        self.puts = []
+        self.account_heads = 0
+
+    def head_object(self, container, path):
+        if self.headers is None:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed(self.headers)
+
+    def head_account(self):
+        self.account_heads += 1
+        return defer.succeed(self.account_headers)
+
+    def put_object(self, container, path, headers=None, body=None):
+        self.puts.append((container, path, headers))
+        return defer.succeed(None)
+
+
+class StubAvatar(object):
+    conn = None
+
+    def __init__(self, swiftconn):
+        self.swiftconn = swiftconn
+
+    def log_command(self, *args):
+        pass
+
+
+class ExtendedRequestTest(unittest.TestCase):
+    md5 = '4281c348eaf83e70ddce0e07221c3d28'
+
+    def server(self, headers):
+        avatar = StubAvatar(StubHeadConnection(headers))
+        return SFTPServerForSwiftConchUser(avatar)
+
+    @defer.inlineCallbacks
+    def test_check_file_name(self):
+        server = self.server({'content-length': '14', 'etag': self.md5})
+        result = yield server.extendedRequest(
+            'check-file-name', NS('/container/obj') + NS('sha1,md5') +
+            struct.pack('!QQL', 0, 0, 0))
+        self.assertEqual(
+            result, NS('check-file') + NS('md5') + self.md5.decode('hex'))
+
+    @defer.inlineCallbacks
+    def test_md5_hash(self):
+        server = self.server({'content-length': '14', 'etag': self.md5})
+        result = yield server.extendedRequest(
+            'md5-hash', NS('/container/obj') + struct.pack('!QQ', 0, 0) +
+            NS(''))
+        self.assertEqual(result, NS('md5-hash') + NS(self.md5.decode('hex')))
+
+    def test_manifest(self):
+        server = self.server({
+            'etag': '"%s"' % self.md5, 'x-static-large-object': 'True'})
+        d = server.extendedRequest(
+            'md5-hash', NS('/container/obj') + struct.pack('!QQ', 0, 0) +
+            NS(''))
+        return self.assertFailure(d, SFTPError)
+
+    def test_unknown(self):
+        server = self.server({})
+        self.assertRaises(
+            NotImplementedError, server.extendedRequest, 'unknown', '')
+
+
+class CopyTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = StubHeadConnection(None)
+        self.server = SFTPServerForSwiftConchUser(StubAvatar(self.conn))
+
+    @defer.inlineCallbacks
+    def test_copy_file(self):
+        result = yield self.server.extendedRequest(
+            'copy-file', NS('/c1/a b') + NS('/c2/dst') + '\x00')
+        self.assertEqual(result, None)
+        self.assertEqual(self.conn.puts, [
+            ('c2', 'dst', {'X-Copy-From': '/c1/a%20b'})])
+
+    def test_copy_file_exists(self):
+        self.conn.headers = {'content-length': '1'}
+        d = self.server.extendedRequest(
+            'copy-file', NS('/c1/src') + NS('/c2/dst') + '\x00')
+
+        def check(failure):
+            self.assertEqual(failure.code, FX_FILE_ALREADY_EXISTS)
+            self.assertEqual(self.conn.puts, [])
+        return self.assertFailure(d, SFTPError).addCallback(check)
+
+    @defer.inlineCallbacks
+    def test_copy_data(self):
+        src = SwiftFile(self.server, '/c1/src', flags=FXF_READ)
+        src.props = {'size': '10'}
+        dst = SwiftFile(self.server, '/c1/dst', flags=FXF_WRITE)
+        yield self.server.copyData(src, 0, 10, dst, 0)
+        self.assertEqual(self.conn.puts, [
+            ('c1', 'dst', {'X-Copy-From': '/c1/src'})])
+
+    def test_copy_data_partial(self):
+        src = SwiftFile(self.server, '/c1/src', flags=FXF_READ)
+        src.props = {'size': '10'}
+        dst = SwiftFile(self.server, '/c1/dst', flags=FXF_WRITE)
+        self.assertRaises(
+            SFTPError, self.server.copyData, src, 0, 5, dst, 0)
+        self.assertRaises(
+            SFTPError, self.server.copyData, src, 5, 0, dst, 0)
+        # The size of a file that was created on open isn't known
+        src.props = None
+        self.assertRaises(
+            SFTPError, self.server.copyData, src, 0, 5, dst, 0)
+        self.assertEqual(self.conn.puts, [])
+
+    def test_copy_data_modes(self):
+        src = SwiftFile(self.server, '/c1/src', flags=FXF_WRITE)
+        src.props = {'size': '10'}
+        dst = SwiftFile(self.server, '/c1/dst', flags=FXF_READ)
+        e = self.assertRaises(
+            SFTPError, self.server.copyData, src, 0, 0, dst, 0)
+        self.assertEqual(e.code, FX_PERMISSION_DENIED)
+        src.flags = dst.flags = FXF_READ
+        e = self.assertRaises(
+            SFTPError, self.server.copyData, src, 0, 0, dst, 0)
+        self.assertEqual(e.code, FX_PERMISSION_DENIED)
+        self.assertEqual(self.conn.puts, [])
+
+
+class StatVFSTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_statvfs(self):
+        conn = StubHeadConnection(None, {
+            'x-account-bytes-used': '4096',
+            'x-account-object-count': '3',
+            'x-account-meta-quota-bytes': '40960'})
+        server = SFTPServerForSwiftConchUser(StubAvatar(conn))
+        result = yield server.extendedRequest('statvfs@openssh.com', NS('/'))
+        values = struct.unpack('!11Q', result)
+        self.assertEqual(values[:5], (4096, 4096, 10, 9, 9))
+        self.assertEqual(values[5] - values[6], 3)
+
+        # Account stats are cached
+        yield server.extendedRequest('statvfs@openssh.com', NS('/'))
+        self.assertEqual(conn.account_heads, 1)
+
+
+class StubUploadConsumer(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class StubUploadFileSystem(SwiftFileSystem):
+    def __init__(self, swiftconn):
+        SwiftFileSystem.__init__(self, swiftconn)
+        self.uploads = {}
+
+    def newUpload(self):
+        return 'u'
+
+    def startFileUpload(self, fullpath):
+        writer = SwiftWriteFile()
+        self.uploads[fullpath] = consumer = StubUploadConsumer()
+        return writer.startProducing(consumer), writer
+
+    def uploaded(self):
+        return dict((path, ''.join(consumer.data))
+                    for path, consumer in self.uploads.iteritems())
+
+
+class StubSegmentConnection(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.requests = []
+
+    def head_object(self, container, path):
+        return defer.succeed(self.headers)
+
+    def get_container(self, container, **kwargs):
+        return defer.succeed((None, []))
+
+    def put_container(self, container):
+        return defer.succeed(None)
+
+    def put_object(self, container, path, headers=None, body=None):
+        self.requests.append((container, path, headers))
+        return defer.succeed(None)
+
+
+class SwiftFileWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = StubSegmentConnection()
+        self.fs = StubUploadFileSystem(self.conn)
+
+    def writer(self, **kwargs):
+        writer = SwiftFileWriter(self.fs, '/c/obj', None, **kwargs)
+        writer.write_window = 4
+        return writer
+
+    @defer.inlineCallbacks
+    def test_reordered(self):
+        writer = self.writer()
+        writer.write(4, 'efgh')
+        writer.write(0, 'abcd')
+        yield writer.close()
+        self.assertEqual(self.fs.uploaded(), {'/c/obj': 'abcdefgh'})
+        self.assertEqual(self.conn.requests, [])
+
+    @defer.inlineCallbacks
+    def test_segments(self):
+        writer = self.writer()
+        writer.write(0, 'ab')
+        writer.write(4, 'efgh')
+        writer.write(8, 'i')
+        writer.write(2, 'cd')
+        self.conn.headers = {'content-length': '2'}
+        yield writer.close()
+        self.assertEqual(self.fs.uploaded(), {
+            '/c/obj': 'ab',
+            'c_segments/obj//u/0000000000000002': 'cd',
+            'c_segments/obj//u/0000000000000004': 'efghi'})
+        self.assertEqual(self.conn.requests, [
+            ('c_segments', 'obj//u/0000000000000000',
+             {'X-Copy-From': '/c/obj'}),
+            ('c', 'obj', {'X-Object-Manifest': 'c_segments/obj//u/'})])
+
+    def test_overwrite(self):
+        writer = self.writer()
+        writer.write(0, 'abcd')
+        self.assertRaises(SFTPError, writer.write, 2, 'cd')
+        return writer.close()
+
+    def test_gap(self):
+        writer = self.writer()
+        writer.write(0, 'ab')
+        writer.write(4, 'ef')
+        return self.assertFailure(writer.close(), SFTPError)
+
+    @defer.inlineCallbacks
+    def test_append(self):
+        writer = self.writer(size=3, append=True)
+        writer.write(0, 'def')
+        self.conn.headers = {'content-length': '3'}
+        yield writer.close()
+        self.assertEqual(self.fs.uploaded(), {
+            'c_segments/obj//u/0000000000000003': 'def'})
+        self.assertEqual(self.conn.requests, [
+            ('c_segments', 'obj//u/0000000000000000',
+             {'X-Copy-From': '/c/obj'}),
+            ('c', 'obj', {'X-Object-Manifest': 'c_segments/obj//u/'})])
+
+
+class StubSession(object):
+    buf = ''
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class ReadAheadTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.budget = ReadAheadBudget(1000)
+        self.patch(SwiftFileReceiver, 'readahead', self.budget)
+        self.patch(SwiftFileReceiver, 'download_buffer_limit', 100)
+        self.patch(SwiftFileReceiver, 'max_download_buffer', 800)
+        self.receiver = SwiftFileReceiver(
+            10000, StubSession(), clock=self.clock)
+        self.receiver.makeConnection(StubTransport())
+
+    def test_window_grows(self):
+        self.clock.advance(1)
+        self.receiver.dataReceived('x' * 200)
+        self.assertTrue(self.receiver.transport.paused)
+
+        # The client reads 200 bytes/second with 1 second latency
+        self.receiver.read(0, 100)
+        self.clock.advance(1)
+        self.receiver.read(100, 100)
+        self.assertEqual(self.receiver.window, 400)
+        self.assertEqual(self.budget.used, 300)
+        self.assertFalse(self.receiver.transport.paused)
+
+        self.receiver.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.budget.used, 0)
+
+    def test_window_released(self):
+        self.clock.advance(1)
+        self.receiver.dataReceived('x' * 300)
+        self.receiver.read(0, 100)
+        self.clock.advance(1)
+        self.receiver.read(100, 100)
+        self.receiver.connectionLost(Failure(ResponseDone()))
+        # Reading what is left doesn't grow the window again
+        self.clock.advance(1)
+        self.receiver.read(200, 100)
+        self.receiver.close()
+        self.assertEqual(self.budget.used, 0)
+
+    def test_window_released_on_close(self):
+        self.clock.advance(1)
+        self.receiver.dataReceived('x' * 200)
+        self.receiver.read(0, 100)
+        self.clock.advance(1)
+        self.receiver.read(100, 100)
+        self.assertEqual(self.budget.used, 300)
+        self.receiver.close()
+        self.assertEqual(self.budget.used, 0)
+        self.receiver.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.budget.used, 0)
+
+    def test_budget(self):
+        self.budget.used = 950
+        self.clock.advance(1)
+        self.receiver.dataReceived('x' * 200)
+        self.receiver.read(0, 100)
+        self.clock.advance(1)
+        self.receiver.read(100, 100)
+        self.assertEqual(self.receiver.window, 150)
+
+    def test_governor(self):
+        governor = BufferGovernor(150)
+        self.patch(SwiftFileReceiver, 'governor', governor)
+        self.receiver.dataReceived('x' * 50)
+        self.assertFalse(self.receiver.transport.paused)
+        self.receiver.dataReceived('x' * 100)
+        self.assertTrue(self.receiver.transport.paused)
+
+        self.receiver.read(0, 100)
+        self.assertFalse(self.receiver.transport.paused)
+        self.assertEqual(governor.used, 50)
+        self.receiver.close()
+        self.assertEqual(governor.used, 0)
+        self.assertTrue(self.receiver.transport.stopped)
+
+    def test_throttle(self):
+        self.receiver.throttle = Throttle(
+            [TokenBucket(100, clock=self.clock)], clock=self.clock)
+        self.receiver.dataReceived('x' * 50)
+        self.assertFalse(self.receiver.transport.paused)
+        self.receiver.dataReceived('x' * 100)
+        self.assertTrue(self.receiver.transport.paused)
+
+        # Reading doesn't resume swift before the debt is paid off
+        self.receiver.read(0, 100)
+        self.assertTrue(self.receiver.transport.paused)
+        self.clock.advance(0.5)
+        self.assertFalse(self.receiver.transport.paused)
+
+    def test_throttle_charges_paused(self):
+        bucket = TokenBucket(100, clock=self.clock)
+        self.receiver.throttle = Throttle([bucket], clock=self.clock)
+        self.receiver.dataReceived('x' * 150)
+        self.assertTrue(self.receiver.transport.paused)
+        # Data still in flight when swift was paused is charged as well
+        self.receiver.dataReceived('x' * 100)
+        self.assertEqual(bucket.tokens, -150)
+
+
+class StubSSHConnection(object):
+    " session.conn.transport.transport of an SFTP session "
+    def __init__(self):
+        self.transport = self
+        self.conn = self
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class SenderThrottleTest(unittest.TestCase):
+    def test_throttle_charges_paused(self):
+        clock = task.Clock()
+        session = StubSSHConnection()
+        bucket = TokenBucket(1000, clock=clock)
+        sender = SwiftFileSender(
+            None, '/c/obj', session, ready=defer.Deferred(),
+            throttle=Throttle([bucket], clock=clock))
+        writes = [sender.write('x' * 1024) for _ in range(10)]
+        self.assertTrue(session.paused)
+        self.assertEqual(bucket.tokens, 1000 - 10 * 1024)
+
+        sender.stopProducing()
+        for d in writes:
+            self.assertFailure(d, SFTPError)
+        return defer.gatherResults(writes)
+
+
+class KeyExchangeClient(SSHClientTransport):
+    def verifyHostKey(self, hostKey, fingerprint):
+        return defer.succeed(True)
+
+    def connectionSecure(self):
+        self.factory.secure.callback(
+            (self.kexAlg, self.keyAlg, self.nextEncryptions.outCipType))
+        self.loseConnection()
+
+    def connectionLost(self, reason):
+        SSHClientTransport.connectionLost(self, reason)
+        if not self.factory.secure.called:
+            self.factory.secure.errback(reason)
+
+
+class KeyExchangeTest(unittest.TestCase):
+    def setUp(self):
+        key = Key(rsa.generate_private_key(65537, 1024, default_backend()))
+        factory = SSHFactory()
+        factory.protocol = SwiftSSHServerTransport
+        factory.noisy = False
+        factory.publicKeys = {'ssh-rsa': key.public()}
+        factory.privateKeys = {'ssh-rsa': key}
+        self.factory = factory
+        factory.primes = {2048: [(2, int(
+            'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+            '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+            '4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+            'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05'
+            '98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB'
+            '9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+            'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718'
+            '3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF',
+            16))]}
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+    def exchange(self, kexAlg):
+        factory = protocol.ClientFactory()
+        factory.protocol = KeyExchangeClient
+        factory.noisy = False
+        factory.secure = defer.Deferred()
+        self.patch(KeyExchangeClient, 'supportedKeyExchanges', [kexAlg])
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        return factory.secure
+
+    @defer.inlineCallbacks
+    def test_offloaded(self):
+        threads = []
+        original = sftp_server.kex_reply
+
+        def kex_reply(*args):
+            threads.append(threading.current_thread())
+            return original(*args)
+        self.patch(sftp_server, 'kex_reply', kex_reply)
+        for kexAlg in ['diffie-hellman-group14-sha1',
+                       'diffie-hellman-group-exchange-sha256']:
+            self.assertEqual((yield self.exchange(kexAlg))[0], kexAlg)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    @defer.inlineCallbacks
+    def test_conch(self):
+        # Without cryptography or twisted.conch.ssh._kex
+        self.patch(sftp_server, 'kex_reply', None)
+        for kexAlg in ['diffie-hellman-group1-sha1',
+                       'diffie-hellman-group-exchange-sha256']:
+            self.assertEqual((yield self.exchange(kexAlg))[0], kexAlg)
+
+    @defer.inlineCallbacks
+    def test_reactor_thread(self):
+        self.patch(SwiftSSHServerTransport, 'offloadKeyExchange', False)
+        kexAlg, _, _ = yield self.exchange('diffie-hellman-group1-sha1')
+        self.assertEqual(kexAlg, 'diffie-hellman-group1-sha1')
+
+    @defer.inlineCallbacks
+    def test_preferences(self):
+        key = Key(ec.generate_private_key(ec.SECP256R1(), default_backend()))
+        self.factory.publicKeys['ecdsa-sha2-nistp256'] = key.public()
+        self.factory.privateKeys['ecdsa-sha2-nistp256'] = key
+        self.patch(KeyExchangeClient, 'supportedPublicKeys',
+                   ['ecdsa-sha2-nistp256', 'ssh-rsa'])
+        self.patch(SwiftSSHServerTransport, 'supportedCiphers',
+                   ['aes128-ctr'])
+        _, keyAlg, cipher = yield self.exchange('diffie-hellman-group14-sha1')
+        self.assertEqual(keyAlg, 'ecdsa-sha2-nistp256')
+        self.assertEqual(cipher, 'aes128-ctr')
+
+    def test_parse_algorithms(self):
+        self.assertEqual(
+            parse_algorithms(' aes256-ctr,chacha20-poly1305@openssh.com,'
+                             'aes128-ctr', ['aes128-ctr', 'aes256-ctr'],
+                             'ciphers'),
+            ['aes256-ctr', 'aes128-ctr'])
+        self.assertRaises(ValueError, parse_algorithms,
+                          'aes128-gcm@openssh.com', ['aes128-ctr'], 'ciphers')
@@ -0,0 +1,150 @@
+"""
+See COPYING for license information.
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from swftp.spool import UploadSpool
+from swftp.swift import NotFound
+from swftp.swiftfilesystem import SwiftFileSystem, SwiftWriteFile
+
+
+class StubProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class StubManifestConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def head_object(self, container, path):
+        return defer.fail(NotFound(404, 'Not Found'))
+
+    def get_container(self, container, **kwargs):
+        return defer.succeed((None, []))
+
+    def put_container(self, container):
+        return defer.succeed(None)
+
+    def put_object(self, container, path, headers=None, body=None):
+        self.requests.append((container, path, headers))
+        return defer.succeed(None)
+
+
+class StubSpoolFileSystem(SwiftFileSystem):
+    def __init__(self, swiftconn):
+        SwiftFileSystem.__init__(self, swiftconn)
+        self.uploads = {}
+        self.pending = None
+        self.error = None
+
+    def newUpload(self):
+        return 'u'
+
+    def uploadFile(self, fullpath, f):
+        if self.error is not None:
+            return defer.fail(self.error)
+        self.uploads[fullpath] = f.read()
+        if self.pending is not None:
+            d = defer.Deferred()
+            self.pending.append(d)
+            return d
+        return defer.succeed(None)
+
+
+class SpooledUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = UploadSpool(self.directory, 100, segment_size=4)
+        self.conn = StubManifestConnection()
+        self.fs = StubSpoolFileSystem(self.conn)
+        self.fs.spool = self.spool
+
+    def upload(self, fullpath, *chunks):
+        d, upload = self.fs.startFileUpload(fullpath)
+        upload.registerProducer(StubProducer(), True)
+        for chunk in chunks:
+            upload.write(chunk)
+        upload.unregisterProducer()
+        return d
+
+    @defer.inlineCallbacks
+    def test_small(self):
+        yield self.upload('/c/obj', 'ab', 'c')
+        self.assertEqual(self.fs.uploads, {'/c/obj': 'abc'})
+        self.assertEqual(self.conn.requests, [])
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @defer.inlineCallbacks
+    def test_segments(self):
+        yield self.upload('/c/obj', 'abc', 'def', 'gh')
+        self.assertEqual(self.fs.uploads, {
+            'c_segments/obj//u/%016d' % 0: 'abcdef',
+            'c_segments/obj//u/%016d' % 6: 'gh',
+        })
+        self.assertEqual(self.conn.requests, [
+            ('c', 'obj', {'X-Object-Manifest': 'c_segments/obj//u/'})])
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        self.fs.error = NotFound(404, 'Not Found')
+        yield self.assertFailure(
+            self.upload('/c/obj', 'abc', 'def', 'gh'), NotFound)
+        self.assertEqual(self.conn.requests, [])
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_full(self):
+        self.fs.pending = []
+        self.spool.max_size = 4
+        d, upload = self.fs.startFileUpload('/c/obj')
+        producer = StubProducer()
+        upload.registerProducer(producer, True)
+        upload.write('abcdef')
+        self.assertTrue(producer.paused)
+        _, writer = self.fs.startFileUpload('/c/other')
+        self.assertIsInstance(writer, SwiftWriteFile)
+
+        self.fs.pending.pop().callback(None)
+        self.assertFalse(producer.paused)
+        self.assertEqual(self.spool.used, 0)
+        upload.unregisterProducer()
+        self.assertEqual(self.fs.uploads.keys(),
+                         ['c_segments/obj//u/%016d' % 0])
+        return d
+
+    def test_full_segment(self):
+        self.fs.pending = []
+        self.spool.max_size = 4
+        d, upload = self.fs.startFileUpload('/c/obj')
+        upload.registerProducer(StubProducer(), True)
+        upload.write('abcd')
+        segment = self.spool.startUpload(self.fs, '/c_segments/obj//x/0')
+        producer = StubProducer()
+        segment.registerProducer(producer, True)
+        segment.write('efghij')
+        # Segments are never split, they wait for other uploads instead
+        self.assertTrue(producer.paused)
+        self.assertEqual(self.fs.uploads.keys(),
+                         ['c_segments/obj//u/%016d' % 0])
+
+        self.fs.pending.pop().callback(None)
+        self.assertFalse(producer.paused)
+        segment.write('k')
+        self.assertFalse(producer.paused)
+        self.assertEqual(self.spool.used, 7)
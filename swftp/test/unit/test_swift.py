@@ -13,7 +13,8 @@ from twisted.web import error
 from swftp.swift import (
     SwiftConnection, ThrottledSwiftConnection, ResponseReceiver,
     ResponseIgnorer, cb_recv_resp, cb_process_resp, NotFound, UnAuthenticated,
-    UnAuthorized, Conflict, RequestError)
+    UnAuthorized, Conflict, RequestError, NotModified)
+from swftp.scheduler import FairScheduler
 
 
 class StubWebAgent(protocol.Protocol):
@@ -79,6 +80,18 @@ class SwiftConnectionTest(unittest.TestCase):
         self.assertIsNotNone(conn.agent)
         self.assertEqual(conn.pool, pool)
 
+    def test_http_backend(self):
+        backend = MagicMock()
+
+        class Connection(SwiftConnection):
+            http_backend = backend
+
+        conn = Connection(
+            'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key',
+            pool='pool', proxy='proxy:8080')
+        backend.assert_called_once_with(pool='pool', proxy='proxy:8080')
+        self.assertIdentical(conn.agent, backend.return_value)
+
     def test_make_request(self):
         make_request = self.conn.make_request('method', 'path/to/resource',
                                               params={'param': 'value'},
@@ -513,6 +526,24 @@ class SwiftConnectionTest(unittest.TestCase):
         received.addCallback(cbCheckResponseBody)
         return defer.gatherResults([make_request, received])
 
+    def test_get_object_not_modified(self):
+        receiver = MagicMock()
+        make_request = self.conn.get_object(
+            'container', 'object', receiver=receiver,
+            if_none_match='8a964ee2a5e88be344f36c22562a6486',
+            if_modified_since=1276350018)
+        d, args, kwargs = self.agent.requests[0]
+        self.assertEqual(args[2], Headers({
+            'user-agent': ['Twisted Swift'],
+            'x-auth-token': ['TOKEN_123'],
+            'extra': ['header'],
+            'if-none-match': ['"8a964ee2a5e88be344f36c22562a6486"'],
+            'if-modified-since': ['Sat, 12 Jun 2010 13:40:18 GMT']}))
+
+        d.callback(StubResponse(304))
+        self.assertFalse(receiver.makeConnection.called)
+        return self.assertFailure(make_request, NotModified)
+
     def test_put_object(self):
         make_request = self.conn.put_object('container', 'object')
         self.assertEqual(len(self.agent.requests), 1)
@@ -615,6 +646,65 @@ class ThrottledSwiftConnectionTest(unittest.TestCase):
         self.assertEqual(lock.locked, 0)
         self.assertEqual(sem.tokens, 2)
 
+    def test_metadata_locks(self):
+        lock = defer.DeferredLock()
+        metadata_lock = defer.DeferredLock()
+        conn = ThrottledSwiftConnection(
+            [lock], 'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        conn.metadata_locks = [metadata_lock]
+        conn.agent = self.agent
+        conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        conn.auth_token = 'TOKEN_123'
+
+        # A stat doesn't wait for the upload
+        conn.put_object('container', 'object', body=MagicMock())
+        conn.head_object('container', 'object')
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(lock.locked, 1)
+        self.assertEqual(metadata_lock.locked, 1)
+
+        d, args, kwargs = self.agent.requests[1]
+        d.callback(StubResponse(200))
+        self.assertEqual(lock.locked, 1)
+        self.assertEqual(metadata_lock.locked, 0)
+
+    def test_request_class(self):
+        conn = ThrottledSwiftConnection(
+            [], 'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        self.assertEqual(conn.request_class('GET'), 'transfer')
+        self.assertEqual(
+            conn.request_class('PUT', body=MagicMock()), 'transfer')
+        self.assertEqual(
+            conn.request_class('GET', params={'format': 'json'}), 'metadata')
+        self.assertEqual(conn.request_class('HEAD'), 'metadata')
+        self.assertEqual(conn.request_class('DELETE'), 'metadata')
+        self.assertEqual(
+            conn.request_class('PUT', headers={'Content-Length': '0'}),
+            'metadata')
+        self.assertEqual(
+            conn.request_class('PUT', headers={'X-Copy-From': '/c/o'}),
+            'transfer')
+
+    def test_scheduler(self):
+        conn = ThrottledSwiftConnection(
+            [], 'http://127.0.0.1:8080/auth/v1.0', 'username', 'api_key')
+        conn.scheduler = FairScheduler(1)
+        conn.agent = self.agent
+        conn.storage_url = 'http://127.0.0.1:8080/v1/AUTH_user'
+        conn.auth_token = 'TOKEN_123'
+
+        conn.get_object('container', 'object')
+        conn.get_object('container', 'object')
+        conn.get_container('container')
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(conn.scheduler.waiting, 2)
+
+        # The listing goes ahead of the download
+        d, args, kwargs = self.agent.requests[0]
+        d.callback(StubResponse(200))
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertIn('format=json', self.agent.requests[1][1][1])
+
 
 class HelpersTest(unittest.TestCase):
 
@@ -638,6 +728,10 @@ class HelpersTest(unittest.TestCase):
         # > 409 raises Conflict
         self.assertRaises(Conflict, cb_process_resp, None, StubResponse(409))
 
+        # > 304 raises NotModified
+        self.assertRaises(
+            NotModified, cb_process_resp, None, StubResponse(304))
+
         # > 300-399 raises a RequestError
         self.assertRaises(
             error.PageRedirect, cb_process_resp, None, StubResponse(300))
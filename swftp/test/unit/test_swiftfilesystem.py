@@ -0,0 +1,257 @@
+"""
+See COPYING for license information.
+"""
+import os
+import stat
+import time
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from swftp.swiftfilesystem import (
+    SwiftFileSystem, ListingEntry, ListingCache, swift_stat)
+from swftp.swift import NotFound
+from swftp.utils import OrderedDict
+
+
+class StubListingConnection(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.markers = []
+
+    def get_container(self, container, marker=None, **kwargs):
+        self.markers.append(marker)
+        return defer.succeed((None, self.pages[len(self.markers) - 1]))
+
+    def get_account(self, marker=None, **kwargs):
+        return self.get_container(None, marker=marker)
+
+
+class ListingEntryTest(unittest.TestCase):
+    def setUp(self):
+        os.environ['TZ'] = 'GMT'
+        time.tzset()
+
+    def test_from_object(self):
+        entry = ListingEntry.from_object({
+            u'name': u'dir/test_obj_1',
+            u'hash': u'4281c348eaf83e70ddce0e07221c3d28',
+            u'bytes': 14,
+            u'content_type': u'application/octet-stream',
+            u'last_modified': u'2009-02-03T05:26:32.612278'})
+        self.assertEqual(entry.name, 'test_obj_1')
+        self.assertEqual(entry.size, 14)
+        self.assertEqual(entry.hash, '4281c348eaf83e70ddce0e07221c3d28')
+        self.assertEqual(entry.content_type, 'application/octet-stream')
+        st = entry.stat()
+        self.assertEqual(st.st_size, 14)
+        self.assertEqual(st.st_mtime, 1233638792.0)
+        self.assertTrue(stat.S_ISREG(st.st_mode))
+
+    def test_from_subdir(self):
+        entry = ListingEntry.from_object({u'subdir': u'dir/sub\u2603/'})
+        self.assertEqual(entry.name, u'sub\u2603'.encode('utf-8'))
+        self.assertTrue(stat.S_ISDIR(entry.stat().st_mode))
+
+    def test_from_container(self):
+        entry = ListingEntry.from_container(
+            {u'name': u'container', u'count': 3, u'bytes': 12})
+        self.assertEqual(entry.name, 'container')
+        st = entry.stat()
+        self.assertEqual(st.st_nlink, 3)
+        self.assertEqual(st.st_size, 12)
+        self.assertTrue(stat.S_ISDIR(st.st_mode))
+
+    def test_mapping(self):
+        entry = ListingEntry('name', size=10, last_modified='2012-04-10')
+        self.assertEqual(entry['size'], 10)
+        self.assertEqual(entry.get('missing', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: entry['missing'])
+        self.assertEqual(swift_stat(**entry), entry.stat())
+
+    def test_slots(self):
+        entry = ListingEntry('name')
+        self.assertRaises(AttributeError, setattr, entry, 'other', 1)
+
+
+class ListingTest(unittest.TestCase):
+    def test_container_listing_pages(self):
+        conn = StubListingConnection([
+            [{u'name': u'dir/a', u'bytes': 1},
+             {u'name': u'dir/b', u'bytes': 2,
+              u'content_type': u'text/plain'}],
+            [{u'subdir': u'dir/b/'}],
+            [],
+        ])
+        fs = SwiftFileSystem(conn)
+        d = fs.get_full_listing('/container/dir')
+
+        def check(listing):
+            self.assertEqual(conn.markers, [None, u'dir/b', u'dir/b/'])
+            self.assertEqual(listing.keys(), ['a', 'b'])
+            # Directories win over objects of the same name
+            self.assertEqual(listing['b'].content_type,
+                             'application/directory')
+        d.addCallback(check)
+        return d
+
+    def test_account_listing(self):
+        conn = StubListingConnection([
+            [{u'name': u'c1', u'count': 1, u'bytes': 1}], []])
+        fs = SwiftFileSystem(conn)
+        d = fs.get_full_listing('/')
+
+        def check(listing):
+            self.assertEqual(conn.markers, [None, u'c1'])
+            self.assertEqual(listing.keys(), ['c1'])
+        d.addCallback(check)
+        return d
+
+
+class ListingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ListingCache(ttl=10, clock=self.clock)
+        self.listing = OrderedDict([('a', ListingEntry('a', size=1))])
+
+    def test_lookup(self):
+        self.cache.store('/container/dir/', self.listing)
+        self.assertEqual(self.cache.lookup('container/dir/a').size, 1)
+        self.assertEqual(self.cache.lookup('/container/dir/b'), None)
+        self.assertEqual(self.cache.lookup('/container/a'), None)
+        self.assertEqual(self.cache.lookup('/container/dir'), None)
+
+    def test_account(self):
+        self.cache.store('/', self.listing)
+        self.assertEqual(self.cache.lookup('/a').size, 1)
+        self.assertEqual(self.cache.lookup('/'), None)
+
+    def test_expires(self):
+        self.cache.store('/container', self.listing)
+        self.clock.advance(9)
+        self.assertNotEqual(self.cache.lookup('/container/a'), None)
+        self.clock.advance(1)
+        self.assertEqual(self.cache.lookup('/container/a'), None)
+        self.assertEqual(self.cache.listing, None)
+
+    def test_disabled(self):
+        cache = ListingCache(ttl=0, clock=self.clock)
+        cache.store('/container', self.listing)
+        self.assertEqual(cache.lookup('/container/a'), None)
+
+
+class StubObjectConnection(object):
+    def __init__(self, headers=None, segments=()):
+        self.headers = headers
+        self.segments = list(segments)
+        self.requests = []
+
+    def get_container(self, container, prefix=None, marker=None, **kwargs):
+        if marker:
+            return defer.succeed((None, []))
+        return defer.succeed((None, [
+            {u'name': name} for name in self.segments
+            if name.startswith(prefix.decode('utf-8'))]))
+
+    def delete_object(self, container, path):
+        self.requests.append(('DELETE', container, path))
+        return defer.succeed(None)
+
+    def head_object(self, container, path):
+        if self.headers is None:
+            return defer.fail(NotFound(404, 'Not Found'))
+        return defer.succeed(self.headers)
+
+    def put_container(self, container):
+        self.requests.append(('PUT', container))
+        return defer.succeed(None)
+
+    def put_object(self, container, path, headers=None, body=None):
+        self.requests.append(('PUT', container, path, headers))
+        return defer.succeed(None)
+
+
+class StubUploadIdFileSystem(SwiftFileSystem):
+    def newUpload(self):
+        return 'new'
+
+
+class AppendTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_object(self):
+        conn = StubObjectConnection(
+            {'content-length': '10', 'content-type': 'text/plain'})
+        path = yield StubUploadIdFileSystem(conn).prepareAppend('/c/a b')
+        self.assertEqual(path, 'c_segments/a b//new/0000000000000010')
+        self.assertEqual(conn.requests, [
+            ('PUT', 'c_segments'),
+            ('PUT', 'c_segments', 'a b//new/0000000000000000',
+             {'X-Copy-From': '/c/a%20b'}),
+            ('PUT', 'c', 'a b', {
+                'X-Object-Manifest': 'c_segments/a%20b//new/',
+                'Content-Type': 'text/plain'}),
+        ])
+
+    @defer.inlineCallbacks
+    def test_segmented_object(self):
+        conn = StubObjectConnection({
+            'content-length': '20',
+            'x-object-manifest': 'c_segments/a%20b//old/'})
+        path = yield SwiftFileSystem(conn).prepareAppend('/c/a b', 20)
+        self.assertEqual(path, 'c_segments/a b//old/0000000000000020')
+        self.assertEqual(conn.requests, [])
+
+    @defer.inlineCallbacks
+    def test_missing(self):
+        conn = StubObjectConnection()
+        path = yield SwiftFileSystem(conn).prepareAppend('/c/obj')
+        self.assertEqual(path, '/c/obj')
+        self.assertEqual(conn.requests, [])
+
+    def test_wrong_offset(self):
+        conn = StubObjectConnection({'content-length': '10'})
+        d = SwiftFileSystem(conn).prepareAppend('/c/obj', 5)
+        return self.assertFailure(d, NotImplementedError)
+
+    def test_foreign_manifest(self):
+        conn = StubObjectConnection({
+            'content-length': '10', 'x-object-manifest': 'other/obj'})
+        d = SwiftFileSystem(conn).prepareAppend('/c/obj')
+        return self.assertFailure(d, NotImplementedError)
+
+
+class ManifestTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_replace(self):
+        # Only the segments of the replaced upload are deleted, not the ones
+        # of other uploads of the same path
+        conn = StubObjectConnection(
+            {'content-length': '10',
+             'x-object-manifest': 'c_segments/o//old/'},
+            segments=[u'o//old/0000000000000000', u'o//other/0000000000000000',
+                      u'o//new/0000000000000000'])
+        yield SwiftFileSystem(conn).writeManifest('/c/o', 'new')
+        self.assertEqual(conn.requests, [
+            ('PUT', 'c_segments'),
+            ('PUT', 'c', 'o', {'X-Object-Manifest': 'c_segments/o//new/'}),
+            ('DELETE', 'c_segments', 'o//old/0000000000000000'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_keep_current(self):
+        conn = StubObjectConnection(
+            {'content-length': '10',
+             'x-object-manifest': 'c_segments/o//old/'},
+            segments=[u'o//old/0000000000000000', u'o//old/0000000000000005'])
+        yield SwiftFileSystem(conn).writeManifest(
+            '/c/o', 'new', keep_current=True)
+        self.assertEqual(conn.requests, [
+            ('PUT', 'c_segments'),
+            ('PUT', 'c_segments', 'o//new/0000000000000000',
+             {'X-Copy-From': '/c_segments/o//old/0000000000000000'}),
+            ('PUT', 'c_segments', 'o//new/0000000000000005',
+             {'X-Copy-From': '/c_segments/o//old/0000000000000005'}),
+            ('PUT', 'c', 'o', {'X-Object-Manifest': 'c_segments/o//new/'}),
+            ('DELETE', 'c_segments', 'o//old/0000000000000000'),
+            ('DELETE', 'c_segments', 'o//old/0000000000000005'),
+        ])
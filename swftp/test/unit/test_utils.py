@@ -99,6 +99,29 @@ class DateTimeParseTest(unittest.TestCase):
         result = try_datetime_parse("2012-04-10")
         self.assertEqual(result, 1334016000.0)
 
+    def test_invalid_fields(self):
+        self.assertIsNone(try_datetime_parse("2008-13-10T13:30:00"))
+        self.assertIsNone(try_datetime_parse("Thu, 10 Foo 2008 13:30:00 GMT"))
+        self.assertIsNone(try_datetime_parse("2008-04-10T13:30:00Z"))
+
+    def test_cached(self):
+        first = try_datetime_parse("2008-04-10T13:30:00.000001")
+        second = try_datetime_parse("2008-04-10T13:30:00.999999")
+        self.assertEqual(first, second)
+        self.assertEqual(first, 1207834200.0)
+
+    def test_timezone_change(self):
+        self.assertEqual(try_datetime_parse("2008-04-10T13:30:00"),
+                         1207834200.0)
+        os.environ['TZ'] = 'EST+05EDT,M4.1.0,M10.5.0'
+        time.tzset()
+        try:
+            self.assertEqual(try_datetime_parse("2008-04-10T13:30:00"),
+                             1207848600.0)
+        finally:
+            os.environ['TZ'] = 'GMT'
+            time.tzset()
+
 
 class ParseKeyValueConfigTest(unittest.TestCase):
     def test_single(self):
@@ -0,0 +1,87 @@
+"""
+See COPYING for license information.
+"""
+import os
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python import log
+
+from swftp import workers
+
+from swftp.ftp.service import Options
+from swftp.logging import WorkerLogObserver
+from swftp.workers import (
+    WorkerLog, WorkerProcess, WorkerSupervisor, worker_arguments,
+    worker_share, LOG_FD)
+
+
+class WorkerLogTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+
+    def test_arguments(self):
+        options = Options()
+        options.parseOptions(['--port=5021'])
+        args = worker_arguments('swftp.ftp.service', options, 1)
+        self.assertIn('--log_fd=%s' % LOG_FD, args)
+
+    def test_forward(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        obs = WorkerLogObserver(w)
+        self.addCleanup(obs.pipe.close)
+        obs.emit({'message': ('line\none',), 'isError': 0})
+        obs.emit({'message': ('oops',), 'isError': 1})
+        obs.emit({'message': (), 'isError': 0})
+
+        WorkerLog(2).dataReceived(os.read(r, 4096))
+        self.assertEqual(
+            [(e['message'], e['system'], e['isError'])
+             for e in self.events],
+            [(('line\none',), 'SwFTP worker 2', False),
+             (('oops',), 'SwFTP worker 2', True)])
+
+    def test_not_json(self):
+        WorkerLog(1).dataReceived('plain text\n')
+        self.assertEqual(self.events[0]['message'], ('plain text',))
+
+
+class WorkerShareTest(unittest.TestCase):
+    def test_share(self):
+        self.assertEqual(worker_share('/spool', 100, None, 4), ('/spool', 100))
+        self.assertEqual(
+            worker_share('/spool', 100, '2', 4), ('/spool/worker2', 25))
+
+
+class StubProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+    def test_stop(self):
+        clock = task.Clock()
+        self.patch(workers, 'reactor', clock)
+        supervisor = WorkerSupervisor('swftp.ftp.service', None, None, 2)
+        for index in range(2):
+            worker = WorkerProcess(supervisor, index, None)
+            supervisor.processes[index] = (worker, StubProcessTransport())
+        supervisor.running = True
+        d = supervisor.stopService()
+
+        (first, first_transport), (second, second_transport) = \
+            supervisor.processes.values()
+        first.ended.callback(None)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(supervisor.stop_timeout)
+        self.assertEqual(first_transport.signals, ['TERM'])
+        self.assertEqual(second_transport.signals, ['TERM', 'KILL'])
+        second.ended.callback(None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        return d
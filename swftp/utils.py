@@ -25,27 +25,118 @@ GLOBAL_METRICS = [
     'num_clients',
     'auth.succeed',
     'auth.fail',
+    'auth.queued',
+    'auth.queue_wait_ms',
+    'auth.rejected',
+    'swift.queued',
+    'swift.queue_wait_ms.metadata',
+    'swift.queue_wait_ms.transfer',
     'transfer.egress_bytes',
     'transfer.ingress_bytes',
+    'spool.bytes',
+    'object_cache.hit',
+    'object_cache.miss',
 ]
 
 
+MONTHS = dict((month, i + 1) for i, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+# Parsed timestamps keyed by their second-resolution prefix. Entries in one
+# listing tend to share timestamps, so this is cleared rather than evicted.
+DATE_CACHE_SIZE = 65536
+_date_cache = {}
+_date_cache_tz = [None]
+_date_formats = list(DATE_FORMATS)
+
+
+def _is_fraction(value):
+    return value == '' or (value[0] == '.' and value[1:].isdigit())
+
+
+def _fast_date_key(datetime_str):
+    """
+    Splits Swift's ISO 8601 and HTTP (RFC 1123) timestamps into a cache key
+    and a time tuple without using strptime.
+
+    returns (key, time_tuple) or None if the string isn't in either format
+    """
+    try:
+        if datetime_str[4:5] == '-' and datetime_str[10:11] in ('T', ' ') \
+                and _is_fraction(datetime_str[19:]):
+            # 2008-04-10T13:30:00.12345 or 2008-04-10 13:30:00
+            key = datetime_str[:19]
+            return key, (
+                int(key[0:4]), int(key[5:7]), int(key[8:10]),
+                int(key[11:13]), int(key[14:16]), int(key[17:19]),
+                0, 1, -1)
+        parts = datetime_str.split(' ')
+        if len(parts) == 6 and parts[0][-1:] == ',' \
+                and parts[5] in ('GMT', 'UTC') \
+                and _is_fraction(parts[4][8:]):
+            # Thu, 10 Apr 2008 13:30:00 GMT
+            clock = parts[4][:8]
+            key = ' '.join((parts[1], parts[2], parts[3], clock))
+            return key, (
+                int(parts[3]), MONTHS[parts[2]], int(parts[1]),
+                int(clock[0:2]), int(clock[3:5]), int(clock[6:8]),
+                0, 1, 0)
+    except (ValueError, KeyError):
+        pass
+    return None
+
+
+def _valid_time_tuple(t):
+    return 1 <= t[1] <= 12 and 1 <= t[2] <= 31 and t[3] <= 23 \
+        and t[4] <= 59 and t[5] <= 61
+
+
+def _strptime_parse(datetime_str):
+    " Slow path. Tries the format that matched last time first. "
+    for date_format in _date_formats:
+        try:
+            mtime_tuple = time.strptime(datetime_str, date_format)
+        except ValueError:
+            continue
+        if _date_formats[0] != date_format:
+            _date_formats.remove(date_format)
+            _date_formats.insert(0, date_format)
+        return time.mktime(tuple(mtime_tuple))
+    return None
+
+
 def try_datetime_parse(datetime_str):
     """
     Tries to parse the datetime and return the UNIX epoch version of the time.
 
     returns timestamp(float) or None
     """
-    mtime = None
-    if datetime_str:
-        for date_format in DATE_FORMATS:
-            try:
-                mtime_tuple = time.strptime(datetime_str, date_format)
-                mtime = time.mktime(tuple(mtime_tuple))
-            except ValueError:
-                pass
-            else:
-                break
+    if not datetime_str:
+        return None
+
+    # mktime depends on the local timezone
+    if _date_cache_tz[0] != time.timezone:
+        _date_cache.clear()
+        _date_cache_tz[0] = time.timezone
+
+    fast = _fast_date_key(datetime_str)
+    key = datetime_str
+    if fast is not None:
+        key = fast[0]
+    try:
+        return _date_cache[key]
+    except KeyError:
+        pass
+
+    if fast is not None and _valid_time_tuple(fast[1]):
+        mtime = time.mktime(fast[1])
+    else:
+        mtime = _strptime_parse(datetime_str)
+
+    if len(_date_cache) >= DATE_CACHE_SIZE:
+        _date_cache.clear()
+    _date_cache[key] = mtime
     return mtime
 
 
@@ -0,0 +1,277 @@
+"""
+Runs the FTP/SFTP server in several worker processes. The supervisor binds
+the listening socket and hands it to each worker, so the kernel spreads new
+connections over them. Workers that exit are restarted. Per-user session
+counts are held by the supervisor (see swftp.sessions). Workers send their log
+to the supervisor, so it ends up wherever the log of the supervisor goes.
+
+See COPYING for license information.
+"""
+import json
+import os
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, reactor, protocol
+from twisted.internet.stdio import StandardIO
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from swftp.sessions import (
+    LocalSessionCounter, SessionCountServerProtocol, RemoteSessionCounter)
+
+# Options that the supervisor uses to tell a worker what to do
+WORKER_OPTIONS = ['listen_fd', 'session_fds', 'log_fd', 'worker']
+# File descriptors of the workers: the listening socket, the pipes that
+# session counting requests are read from and answered on and the pipe that
+# the log is sent to the supervisor on
+LISTEN_FD = 3
+SESSION_FDS = (4, 5)
+LOG_FD = 6
+
+
+def address_family(interface):
+    if ':' in interface:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def listen(port, interface='', backlog=50):
+    " Returns a listening socket that can be handed to worker processes "
+    sock = socket.socket(address_family(interface), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def worker_arguments(module, options, index):
+    """ Returns the command line that starts a worker of the given service
+        module with the same options as the supervisor
+    """
+    args = [sys.executable, '-c', 'from %s import run; run()' % module]
+    for key, value in sorted(options.items()):
+        if key in WORKER_OPTIONS or not value:
+            continue
+        if key in dict((flag[0], None) for flag in options.optFlags):
+            args.append('--%s' % key)
+        else:
+            args.append('--%s=%s' % (key, value))
+    args.extend([
+        '--listen_fd=%s' % LISTEN_FD,
+        '--session_fds=%s,%s' % SESSION_FDS,
+        '--log_fd=%s' % LOG_FD,
+        '--worker=%s' % index,
+    ])
+    return args
+
+
+def worker_share(directory, size, worker, workers):
+    """ Returns the directory and the number of bytes of disk space that a
+        worker may use for its spool or object cache. Every worker gets its
+        own subdirectory, so workers never touch each other's files, and an
+        equal share of the space.
+
+    :param str directory: configured directory
+    :param int size: configured number of bytes for all workers
+    :param worker: index of the worker, None when there are no workers
+    :param int workers: number of workers
+
+    """
+    if worker is None:
+        return directory, size
+    return (os.path.join(directory, 'worker%s' % worker),
+            size // max(workers, 1))
+
+
+class ChildPipe(object):
+    " Transport that writes to a pipe of a child process "
+    def __init__(self, process, fd):
+        self.process = process
+        self.fd = fd
+
+    def write(self, data):
+        self.process.writeToChild(self.fd, data)
+
+    def loseConnection(self):
+        self.process.closeChildFD(self.fd)
+
+
+class WorkerLog(LineReceiver):
+    """ Logs what a worker sends on its log pipe (see
+        swftp.logging.WorkerLogObserver) in the log of the supervisor
+    """
+    delimiter = '\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, index):
+        self.system = 'SwFTP worker %s' % index
+
+    def lineReceived(self, line):
+        try:
+            event = json.loads(line)
+            message = event['message'].encode('utf-8')
+        except (ValueError, KeyError, AttributeError):
+            message, event = line, {}
+        log.msg(message, system=self.system,
+                isError=bool(event.get('isError')))
+
+    def lineLengthExceeded(self, line):
+        log.msg('%s...' % line[:1024], system=self.system)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """ Answers the session counting requests of a worker and logs what it
+        sends. Its sessions are released when it exits.
+    """
+    def __init__(self, supervisor, index, session_counter):
+        self.supervisor = supervisor
+        self.index = index
+        self.sessions = SessionCountServerProtocol(session_counter)
+        self.worker_log = WorkerLog(index)
+        self.ended = defer.Deferred()
+
+    def connectionMade(self):
+        self.sessions.makeConnection(
+            ChildPipe(self.transport, SESSION_FDS[0]))
+
+    def childDataReceived(self, fd, data):
+        if fd == SESSION_FDS[1]:
+            self.sessions.dataReceived(data)
+        elif fd == LOG_FD:
+            self.worker_log.dataReceived(data)
+
+    def processEnded(self, reason):
+        self.sessions.connectionLost(reason)
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """ Starts and restarts the worker processes
+
+    :param str module: service module of the workers, which must have a run()
+        function (e.g. swftp.ftp.service)
+    :param options: parsed command line options of the supervisor
+    :param sock: listening socket that the workers serve (see listen())
+    :param int workers: number of worker processes
+    :param session_counter: holds the session counts of all workers
+
+    """
+    restart_delay = 1
+    stop_timeout = 10
+
+    def __init__(self, module, options, sock, workers, session_counter=None):
+        self.module = module
+        self.options = options
+        self.sock = sock
+        self.workers = workers
+        self.session_counter = session_counter or LocalSessionCounter()
+        self.processes = {}  # index -> (WorkerProcess, IProcessTransport)
+
+    def startService(self):
+        service.Service.startService(self)
+        reactor.callWhenRunning(self._spawnAll)
+
+    def _spawnAll(self):
+        for index in xrange(self.workers):
+            if self.running and index not in self.processes:
+                self.spawn(index)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        waiting = []
+        for worker, transport in self.processes.values():
+            waiting.append(worker.ended)
+            transport.signalProcess('TERM')
+            kill = reactor.callLater(
+                self.stop_timeout, self._kill, worker, transport)
+            worker.ended.addBoth(self._cancelKill, kill)
+        return defer.DeferredList(waiting)
+
+    def _kill(self, worker, transport):
+        if not worker.ended.called:
+            transport.signalProcess('KILL')
+
+    def _cancelKill(self, result, kill):
+        if kill.active():
+            kill.cancel()
+        return result
+
+    def spawn(self, index):
+        " Starts the worker with the given index "
+        worker = WorkerProcess(self, index, self.session_counter)
+        transport = reactor.spawnProcess(
+            worker, sys.executable,
+            worker_arguments(self.module, self.options, index),
+            env=os.environ,
+            childFDs={
+                0: 'w', 1: 1, 2: 2,
+                LISTEN_FD: self.sock.fileno(),
+                SESSION_FDS[0]: 'w',
+                SESSION_FDS[1]: 'r',
+                LOG_FD: 'r'})
+        self.processes[index] = (worker, transport)
+        log.msg('Started worker %s (pid %s)' % (index, transport.pid))
+
+    def workerEnded(self, worker, reason):
+        del self.processes[worker.index]
+        log.msg('Worker %s exited: %s' % (worker.index, reason.value))
+        if self.running:
+            reactor.callLater(self.restart_delay, self._respawn, worker.index)
+
+    def _respawn(self, index):
+        if self.running and index not in self.processes:
+            self.spawn(index)
+
+
+class WorkerService(service.Service):
+    """ Serves connections on the listening socket that was inherited from
+        the supervisor and counts sessions with the supervisor. The worker
+        exits when the supervisor goes away.
+
+    :param factory: protocol factory for the connections
+    :param int listen_fd: file descriptor of the listening socket
+    :param family: address family of the listening socket
+    :param session_fds: file descriptors of the pipes to and from the
+        supervisor's session counter
+    :param protocol_class: protocol class that counts sessions with its
+        sessionCounter attribute
+    :param bool count_sessions: whether sessions are counted by the
+        supervisor rather than a shared session counter
+
+    """
+    def __init__(self, factory, listen_fd, family, session_fds,
+                 protocol_class, count_sessions=True):
+        self.factory = factory
+        self.listen_fd = listen_fd
+        self.family = family
+        self.session_fds = session_fds
+        self.protocol_class = protocol_class
+        self.count_sessions = count_sessions
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        counter = RemoteSessionCounter()
+        StandardIO(counter, stdin=self.session_fds[0],
+                   stdout=self.session_fds[1])
+        counter.lost.addCallback(self._supervisorLost)
+        if self.count_sessions:
+            self.protocol_class.sessionCounter = counter
+
+        self.port = reactor.adoptStreamPort(
+            self.listen_fd, self.family, self.factory)
+        os.close(self.listen_fd)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            return self.port.stopListening()
+
+    def _supervisorLost(self, ignored):
+        if reactor.running:
+            log.msg('Lost the supervisor, exiting')
+            reactor.stop()